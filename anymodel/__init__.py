@@ -1,10 +1,11 @@
 from sqlmodel import Field
 
-from .mapper import Mapper
+from .mapper import AsyncMapper, Mapper
 from .storages.memory import MemoryStorage
 from .types import Collection, Entity, OneToManyRelation
 
 __all__ = [
+    "AsyncMapper",
     "Collection",
     "Entity",
     "Field",
@@ -2,21 +2,55 @@
 
 This module provides the Mapper class which handles the persistence of entities
 to various storage backends while maintaining separation between domain logic
-and storage concerns.
+and storage concerns, and its asyncio counterpart, AsyncMapper, for async
+storages.
 """
 
-from functools import cached_property
-from typing import TYPE_CHECKING, Iterable, Mapping, Optional, Type
-
+import inspect
+from contextlib import AbstractAsyncContextManager
+from functools import cached_property, partial
+from itertools import batched
+from types import NoneType, UnionType
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Iterable,
+    Mapping,
+    Optional,
+    Sequence,
+    Type,
+    Union,
+    get_args,
+    get_origin,
+)
+
+from pydantic import TypeAdapter
 from pyheck import snake
 
 from anymodel.types.collections import Collection
-from anymodel.types.entity import Entity
+from anymodel.types.entity import Entity, Hydrator
+from anymodel.types.mappings import Identity, project
+from anymodel.types.queries import (
+    Aggregates,
+    Condition,
+    Criteria,
+    Expression,
+    FieldRef,
+    OrderBy,
+    and_,
+    decode_cursor,
+    encode_cursor,
+    keyset,
+    parse_order_by,
+)
+from anymodel.types.relations import LoadStrategy, check_load_strategy
 from anymodel.types.utils import getmeta
-from anymodel.utilities.identity_map import IdentityMap
+from anymodel.utilities.caches import BoundedCache
+from anymodel.utilities.identity_map import IdentityMap, RefreshPolicy, check_refresh_policy
+from anymodel.utilities.loaders import BatchLoader
 
 if TYPE_CHECKING:
-    from anymodel.storages import Storage
+    from anymodel.storages import AsyncStorage, Storage
     from anymodel.types.relations import Relation
 
 
@@ -25,6 +59,11 @@ class Mapper[TMappedEntity]:
 
     The Mapper class handles all persistence operations for a specific entity type,
     including CRUD operations, identity mapping, and relation management.
+
+    The identity map (``cache``) only holds entities referenced elsewhere. A second-level cache (a
+    :class:`anymodel.utilities.caches.BoundedCache`, which mappers can share) keeps the rows of entities found by
+    primary key, so that finding them again does not query the storage. Rows are evicted when entities are saved or
+    deleted through a mapper, changes made to the storage by other means are only seen once they expire.
     """
 
     __type__: Type[TMappedEntity] = None
@@ -32,9 +71,19 @@ class Mapper[TMappedEntity]:
 
     relations: Mapping[str, "Relation"] = None
 
+    # number of entities whose relations are loaded at once, by eager load strategies
+    eager_batch_size: int = 100
+
+    # what happens to identity mapped entities found again by a query, see RefreshPolicy
+    refresh: RefreshPolicy = "keep"
+
+    # seconds rows stay in the second-level cache, defaults to the ttl of the cache
+    second_level_cache_ttl: Optional[float] = None
+
     storage: "Storage"
 
     _cache: Optional[IdentityMap] = None
+    _second_level_cache: Optional[BoundedCache] = None
 
     def __new__(cls, *args, **kwargs):
         new_object = super().__new__(cls)
@@ -50,6 +99,7 @@ class Mapper[TMappedEntity]:
         relations: Optional[Mapping[str, "Relation"]] = None,
         storage: "Storage",
         cache: Optional[IdentityMap] = None,
+        second_level_cache: Optional[BoundedCache] = None,
     ):
         self.__type__ = self.__type__ or entity_type
         if self.__type__ is None:
@@ -62,21 +112,38 @@ class Mapper[TMappedEntity]:
         self.storage = storage
 
         self._cache = cache
+        self._second_level_cache = second_level_cache
 
         # XXX should the mapper do this ? why this and not migrations ?
         self.storage.add_table(self)
 
     @cached_property
     def fields(self):
-        return self.__type__.model_fields.keys()
+        """Fields stored in the mapper's table (relations are not, they are stored by the related mappers)."""
+        return [k for k in self.__type__.model_fields if k not in self.relations]
 
     @cached_property
     def primary_key(self):
         def is_primary_key(x):
-            return getattr(x, "primary_key", False)
+            # sqlmodel's FieldInfo uses PydanticUndefined (which is truthy) for unset attributes
+            return getattr(x, "primary_key", None) is True
 
         return tuple((k for k, v in self.__type__.model_fields.items() if is_primary_key(v)))
 
+    @cached_property
+    def indexes(self) -> Mapping[str, bool]:
+        """Indexed fields (declared using ``Field(index=True)`` or ``Field(unique=True)``), mapped to whether the index
+        is unique or not."""
+
+        def is_set(x, attr):
+            return getattr(x, attr, None) is True
+
+        return {
+            k: is_set(v, "unique")
+            for k, v in self.__type__.model_fields.items()
+            if is_set(v, "index") or is_set(v, "unique")
+        }
+
     def save(self, entity: TMappedEntity) -> TMappedEntity:
         """Saves an entity to the database, either inserting (if not mapped yet) or updating it (if a mapping identity
         is present)."""
@@ -85,74 +152,520 @@ class Mapper[TMappedEntity]:
 
         identity = entity.__state__.identity
         if identity is not None:
-            # existing object, update
-            self.storage.update(self.__tablename__, identity, values)
-            entity.__pydantic_fields_set__ = entity.__pydantic_fields_set__.difference(values.keys())
+            # existing object, update (if anything really changed)
+            if values:
+                self.storage.update(self.__tablename__, identity, values)
+                self._evict_row(entity)
+            self._set_stored(entity, values)
         else:
             # new object, insert
             new_identity = self.storage.insert(self.__tablename__, values)
-            entity.__state__.identity = new_identity
-            entity.__state__.set_clean()
+            entity.__state__.identity = Identity.of(new_identity, self.primary_key)
+            entity.__state__.set_clean({**values, **new_identity})
 
-        for _field, _related_entities in related_values.items():
-            relation = self.relations[_field]
-            for _related_entity in _related_entities:
-                relation.save(self, entity, _related_entity)
+        self._save_related_values(entity, related_values)
 
         return self._mapped(entity)
 
-    def find_one_by_pk(self, *pk) -> TMappedEntity:
-        """Find an entity by its primary key."""
-
-        if len(pk) != len(self.primary_key):
-            raise ValueError(f"Expected {len(self.primary_key)} arguments, got {len(pk)}.")
-
-        # xxx this may be a bit naive, cast all into string will show limits (maybe)
-        pk = tuple(map(str, pk))
-        if self._cache is not None and (cached := self._cache.get(pk)) is not None:
+    def save_many(self, entities: Iterable[TMappedEntity]) -> list[TMappedEntity]:
+        """Saves many entities at once. New entities are inserted in one batch using the storage's bulk insert, and the
+        changes of already mapped entities are written in another one (entities without changes are not written).
+        Returns the entities in the same order as given."""
+        entities = list(entities)
+        related_values = [self._get_known_modified_related_values(entity) for entity in entities]
+        new_entities = [entity for entity in entities if entity.__state__.identity is None]
+        stored_entities = [entity for entity in entities if entity.__state__.identity is not None]
+
+        if new_entities:
+            self._insert_many(new_entities)
+        if stored_entities:
+            self._update_many(stored_entities)
+        for entity, _related_values in zip(entities, related_values):
+            self._save_related_values(entity, _related_values)
+
+        return [self._mapped(entity) for entity in entities]
+
+    def is_dirty(self, entity: TMappedEntity) -> bool:
+        """Whether saving the entity would write anything: it is new, or the values of some of its fields differ from
+        the ones it was loaded or saved with (fields set back to their stored value do not count), or some relations
+        were set, or entities were added to or removed from its related collections, or some related entities are
+        dirty."""
+        if entity.__state__.transient or self._get_known_modified_values(entity):
+            return True
+        for k, related in self._get_known_modified_related_values(entity).items():
+            if k in entity.__pydantic_fields_set__:
+                return True
+            _, saved, removed = self._get_related_changes(self.relations[k], related, replaced=False)
+            if saved or removed:
+                return True
+        return False
+
+    def delete(self, entity: TMappedEntity) -> TMappedEntity:
+        """Deletes a mapped entity from the storage. The entity is detached, and becomes transient again."""
+        if (identity := entity.__state__.identity) is None:
+            raise ValueError("Cannot delete a transient entity.")
+
+        self.storage.delete(self.__tablename__, identity)
+        self._evict_row(entity)
+        if self._cache is not None:
+            self._cache.delete(self._get_cache_key(entity))
+        entity.__state__.detach()
+
+        return entity
+
+    def find_one_by_pk(
+        self,
+        *pk,
+        load: Optional[str | Mapping[str, str]] = None,
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+    ) -> TMappedEntity:
+        """Find an entity by its primary key. See :meth:`find` for ``load``, ``only`` and ``defer``."""
+
+        identity = self._get_pk(pk)
+        if self._cache is not None and (cached := self._cache.get(identity)) is not None:
             return cached
-        identity = dict(zip(self.primary_key, pk))
 
-        # find, return None if not found
-        if (row := self.storage.find_one(self.__tablename__, identity)) is None:
-            return None
+        strategies, fields = self._get_strategies(load), self._get_fields(only, defer)
+        if (cached_row := self._get_cached_row(identity)) is not None:
+            # joined relations of cached rows are loaded with a separate query
+            rows, joins = [(project(cached_row, fields) if fields is not None else cached_row, {})], {}
+        elif joins := self._get_joins(strategies):
+            rows = self.storage.find_many_joined(self.__tablename__, identity, joins, limit=1, fields=fields)
+        elif fields is not None:
+            rows = ((row, {}) for row in self.storage.find_many(self.__tablename__, identity, limit=1, fields=fields))
+        elif (row := self.storage.find_one(self.__tablename__, identity)) is not None:
+            rows = [(row, {})]
+        else:
+            rows = []
 
-        relations = {k: Collection(relation.get_find_callback_for(self, row)) for k, relation in self.relations.items()}
+        # find, return None if not found
+        for row, related in rows:
+            if cached_row is None and fields is None:
+                self._cache_row(identity, row)
+            related.update(self._find_related(strategies, joins, [row])[0])
+            return self._load(row, identity, related=related, deferred=self._get_deferred(fields))
+        return None
+
+    def find_many_by_pks(self, pks: Iterable) -> list[Optional[TMappedEntity]]:
+        """Find entities by primary keys (values, or tuples of values for composite primary keys), returned in the same
+        order (None for the missing ones). Entities of the identity map (and rows of the second-level cache) are used
+        as they are, the others are found with one storage call (an ``IN`` query for sql storages). Eager relations
+        are loaded with one query each."""
+        pks = self._get_pks(pks)
+        entities, rows, missing = self._partition_pks(pks)
+        if missing:
+            found = self.storage.find_by_identities(self.__tablename__, missing)
+            self._set_found_rows(rows, missing, found)
+
+        related = self._find_related(self._get_strategies(None), {}, list(rows.values()))
+        entities.update((pk, self._load(row, related=_related)) for (pk, row), _related in zip(rows.items(), related))
+        return [entities.get(pk) for pk in pks]
+
+    def find(
+        self,
+        *expressions: Expression,
+        load: Optional[str | Mapping[str, str]] = None,
+        order_by: Optional[str | FieldRef | Sequence[str | FieldRef]] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        after: Optional[str] = None,
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        refresh: Optional[RefreshPolicy] = None,
+        **criteria,
+    ) -> Iterable[TMappedEntity]:
+        """Find the entities matching the given criteria: query expressions (see :func:`anymodel.types.queries.field`)
+        and keyword criteria (values or predicates), all of which must match. ``order_by`` is a field name or a
+        sequence of field names, prefixed with a dash for a descending order.
+
+        ``load`` overrides the load strategy of the relations for this call, either for all of them (``"lazy"``,
+        ``"selectin"`` or ``"joined"``) or for some of them (a mapping of relation names to strategies). Eager
+        strategies load the related entities of ``eager_batch_size`` entities at once.
+
+        ``limit`` and ``offset`` restrict the results to a page of entities. For deep pages, keyset pagination is much
+        cheaper than offsets: ``after`` is a cursor (see :meth:`cursor`) for the last entity of the previous page, and
+        only entities coming after it, in the same order, are found. Pages are also ordered by primary key, so that
+        the order is total.
+
+        ``only`` restricts the fields fetched from the storage to the given ones (and the primary key), ``defer``
+        excludes the given ones. The other fields are deferred: they are all loaded with one query when one of them
+        is first accessed (or by :meth:`undefer`), and are never saved unless modified.
+
+        Entities already in the identity map are returned as they are, without building new instances, unless
+        ``refresh`` (which defaults to the mapper's ``refresh`` policy) is ``"refresh_clean"`` (their stored fields are
+        updated, unless they have unsaved changes) or ``"overwrite"`` (their stored fields are updated, discarding
+        unsaved changes).
+        """
+        strategies, fields = self._get_strategies(load), self._get_fields(only, defer)
+        refresh = check_refresh_policy(refresh or self.refresh)
+        criteria, options = self._get_query(expressions, criteria, order_by, limit, offset, after)
+        deferred = self._get_deferred(fields)
+        if joins := self._get_joins(strategies):
+            rows = self.storage.find_many_joined(self.__tablename__, criteria, joins, fields=fields, **options)
+        else:
+            rows = ((row, {}) for row in self.storage.find_many(self.__tablename__, criteria, fields=fields, **options))
 
-        entity = self.__type__.model_construct(**row, **relations)
-        entity.__state__.store = getmeta(row, "store")
-        entity.__state__.identity = identity
-        entity.__state__.set_clean()
+        if not self._get_selectin(strategies, joins):
+            for row, related in rows:
+                yield self._load(row, related=related, deferred=deferred, refresh=refresh)
+            return
 
-        return self._mapped(entity)
+        for page in batched(rows, self.eager_batch_size):
+            for (row, related), more_related in zip(page, self._find_related(strategies, joins, [r for r, _ in page])):
+                yield self._load(row, related={**related, **more_related}, deferred=deferred, refresh=refresh)
 
-    def find(self, **criteria) -> Iterable[TMappedEntity]:
-        for row in self.storage.find_many(self.__tablename__, criteria):
-            entity = self.__type__.model_construct(**row)
-            entity.__state__.store = getmeta(row, "store")
-            entity.__state__.identity = {k: row[k] for k in self.primary_key}
-            entity.__state__.set_clean()
-            yield self._mapped(entity)
+    def count(self, *expressions: Expression, **criteria) -> int:
+        """Number of entities matching the given criteria (see :meth:`find`), counted by the storage without loading
+        any of them."""
+        return self.storage.count(self.__tablename__, self._get_criteria(expressions, criteria))
 
-    ### rework needed
+    def exists(self, *expressions: Expression, **criteria) -> bool:
+        """Whether any entity matches the given criteria (see :meth:`find`)."""
+        return self.storage.exists(self.__tablename__, self._get_criteria(expressions, criteria))
 
-    def delete(self, entity: TMappedEntity):
-        return self.storage.delete(entity)
+    def aggregate(
+        self,
+        *expressions: Expression,
+        group_by: Optional[str | Sequence[str]] = None,
+        sum: Optional[str | Sequence[str]] = None,
+        min: Optional[str | Sequence[str]] = None,
+        max: Optional[str | Sequence[str]] = None,
+        avg: Optional[str | Sequence[str]] = None,
+        **criteria,
+    ) -> dict | list[dict]:
+        """Aggregate the entities matching the given criteria (see :meth:`find`), computed by the storage without
+        loading any of them. The result has a ``count`` of entities, and a ``<function>_<field>`` value for each
+        field given to the ``sum``, ``min``, ``max`` and ``avg`` arguments (None values are ignored, like in SQL).
+
+        Without ``group_by``, a single dict is returned. Otherwise, a list of dicts is returned, one for each group
+        of entities sharing the same values for the ``group_by`` fields (which are included), ordered by those
+        values.
+        """
+        group_by, aggregates = self._get_aggregates(group_by, {"sum": sum, "min": min, "max": max, "avg": avg})
+        criteria = self._get_criteria(expressions, criteria)
+        results = self.storage.aggregate(self.__tablename__, criteria, group_by=group_by, aggregates=aggregates)
+        return results if group_by else results[0]
+
+    def undefer(self, entity: TMappedEntity) -> TMappedEntity:
+        """Load the deferred fields of an entity, if any (with one query)."""
+        entity.__state__.load_deferred()
+        return entity
+
+    def cursor(
+        self, entity: TMappedEntity, order_by: Optional[str | FieldRef | Sequence[str | FieldRef]] = None
+    ) -> str:
+        """Opaque cursor pointing after the given entity, to find the next page of entities (with the same
+        ``order_by``), see :meth:`find`."""
+        order = self._get_order(order_by, paginated=True)
+        return encode_cursor(order, [getattr(entity, k) for k, _ in order])
+
+    def transaction(self):
+        """Context manager running every storage operation of the block within one storage transaction (one pinned
+        connection and one commit for sql storages). Nested blocks use savepoints."""
+        return self.storage.transaction()
 
     ### (semi) private, don't use out of this class
 
+    def _get_pk(self, pk: tuple) -> Identity:
+        """Identity of a primary key, its values being validated as values of the primary key fields (so that a "1"
+        string finds the entity of integer id 1). Values of the field types already are used as they are."""
+        if len(pk) != len(self.primary_key):
+            raise ValueError(f"Expected {len(self.primary_key)} arguments, got {len(pk)}.")
+        return Identity(
+            {
+                k: value if type(value) is _type else self._field_adapters[k].validate_python(value)
+                for k, _type, value in zip(self.primary_key, self._primary_key_types, pk)
+            }
+        )
+
+    def _get_pks(self, pks: Iterable) -> list[Identity]:
+        """Identities of primary keys given as values, tuples of values (for composite primary keys) or identities."""
+        return [pk if isinstance(pk, Identity) else self._get_pk(pk if isinstance(pk, tuple) else (pk,)) for pk in pks]
+
+    @cached_property
+    def _primary_key_types(self) -> tuple[Optional[type], ...]:
+        """Types of the primary key fields, for the ones annotated with a class (optional or not)."""
+
+        def get_type(annotation) -> Optional[type]:
+            if get_origin(annotation) in (Union, UnionType):
+                types = [x for x in get_args(annotation) if x is not NoneType]
+                annotation = types[0] if len(types) == 1 else None
+            return annotation if isinstance(annotation, type) else None
+
+        return tuple(get_type(self.__type__.model_fields[k].annotation) for k in self.primary_key)
+
+    def _partition_pks(self, pks: Iterable[Identity]) -> tuple[dict, dict, list]:
+        """Identity mapped entities and second-level cached rows of the given primary keys, by primary key, and the
+        other primary keys (without duplicates)."""
+        entities, rows, missing = {}, {}, []
+        for pk in dict.fromkeys(pks):
+            if self._cache is not None and (entity := self._cache.get(pk)) is not None:
+                entities[pk] = entity
+            elif (row := self._get_cached_row(pk)) is not None:
+                rows[pk] = row
+            else:
+                missing.append(pk)
+        return entities, rows, missing
+
+    def _set_found_rows(self, rows: dict, pks: Sequence[Identity], found: Iterable[Optional[Mapping]]):
+        for pk, row in zip(pks, found):
+            if row is not None:
+                rows[pk] = row
+                self._cache_row(pk, row)
+
+    def _get_query(self, expressions, criteria, order_by, limit, offset, after) -> tuple[Criteria, dict]:
+        """Storage criteria, and ordering and paging options, of a find query."""
+        order = self._get_order(order_by, paginated=limit is not None or offset is not None or after is not None)
+        if after is not None:
+            values = decode_cursor(after, order)
+            values = [self._field_adapters[k].validate_python(value) for (k, _), value in zip(order, values)]
+            expressions = (*expressions, keyset(order, values))
+        order_by = [f"-{k}" if descending else k for k, descending in order] or None
+        return self._get_criteria(expressions, criteria), {"order_by": order_by, "limit": limit, "offset": offset}
+
+    def _get_order(self, order_by, *, paginated: bool) -> OrderBy:
+        """Order as (field, descending) pairs, pages being ordered by primary key too."""
+        order = parse_order_by(order_by)
+        if paginated:
+            ordered = {k for k, _ in order}
+            order = (*order, *((k, False) for k in self.primary_key if k not in ordered))
+        for k, _ in order:
+            if k not in self.fields:
+                raise ValueError(f'Unknown field "{k}" for {type(self).__name__}.')
+        return order
+
+    @cached_property
+    def _field_adapters(self) -> dict[str, TypeAdapter]:
+        return {k: TypeAdapter(Optional[self.__type__.model_fields[k].annotation]) for k in self.fields}
+
+    @staticmethod
+    def _get_criteria(expressions: Sequence[Expression], criteria: dict) -> Criteria:
+        """Storage criteria: the keyword criteria mapping as is, or an expression if there are query expressions."""
+        if not expressions:
+            return criteria
+        if not all(isinstance(expression, Expression) for expression in expressions):
+            raise TypeError("Positional criteria must be query expressions, use keyword arguments for values.")
+        return and_(*expressions, *(Condition(k, v) for k, v in criteria.items()))
+
+    def _get_aggregates(
+        self, group_by: Optional[str | Sequence[str]], functions: Mapping[str, Optional[str | Sequence[str]]]
+    ) -> tuple[tuple[str, ...], Aggregates]:
+        """Storage group_by fields and aggregates, from the arguments of :meth:`aggregate`."""
+        group_by = (group_by,) if isinstance(group_by, str) else tuple(group_by or ())
+        aggregates = {"count": ("count", None)}
+        for function, fields in functions.items():
+            for k in (fields,) if isinstance(fields, str) else fields or ():
+                aggregates[f"{function}_{k}"] = (function, k)
+        for k in (*group_by, *(k for _, k in aggregates.values() if k is not None)):
+            if k not in self.fields:
+                raise ValueError(f'Unknown field "{k}" for {type(self).__name__}.')
+        return group_by, aggregates
+
+    def _get_fields(self, only: Optional[Iterable[str]], defer: Optional[Iterable[str]]) -> Optional[list[str]]:
+        """Fields to fetch from the storage, or None for all of them. The primary key is always fetched."""
+        if only is None and defer is None:
+            return None
+        only, defer = ((x,) if isinstance(x, str) else tuple(x or ()) for x in (only, defer))
+        for k in (*only, *defer):
+            if k not in self.fields:
+                raise ValueError(f'Unknown field "{k}" for {type(self).__name__}.')
+        return [k for k in self.fields if k in self.primary_key or ((not only or k in only) and k not in defer)]
+
+    def _get_deferred(self, fields: Optional[list[str]]) -> list[str]:
+        return [k for k in self.fields if k not in fields] if fields is not None else []
+
+    def _load_deferred(self, entity: TMappedEntity, fields: set[str]) -> Mapping:
+        for row in self.storage.find_many(
+            self.__tablename__, entity.__state__.identity, limit=1, fields=[*self.primary_key, *fields]
+        ):
+            return row
+        raise ValueError("Row not found, cannot load deferred fields.")
+
+    def _get_strategies(self, load: Optional[str | Mapping[str, str]]) -> dict[str, LoadStrategy]:
+        """Load strategy of each relation, the relation default unless overriden by ``load``."""
+        strategies = {k: relation.strategy for k, relation in self.relations.items()}
+        if isinstance(load, str):
+            load = dict.fromkeys(strategies, load)
+        for k, strategy in (load or {}).items():
+            if k not in self.relations:
+                raise ValueError(f'Unknown relation "{k}" for {type(self).__name__}.')
+            strategies[k] = check_load_strategy(strategy)
+        return strategies
+
+    def _get_joins(self, strategies: Mapping[str, LoadStrategy]) -> dict[str, tuple[str, str]]:
+        """Relations to load by joining tables, as (related table, foreign key) pairs. Only possible if the storage
+        supports joins, for related mappers using the same storage."""
+        if not getattr(self.storage, "supports_joins", False):
+            return {}
+        return {
+            k: (relation.mapper.__tablename__, relation.get_foreign_key(self))
+            for k, relation in self.relations.items()
+            if strategies[k] == "joined" and relation.mapper.storage is self.storage
+        }
+
+    def _get_selectin(self, strategies: Mapping[str, LoadStrategy], joins: Mapping) -> list[str]:
+        """Relations to load with one query per page of entities (joined relations that cannot be joined as well)."""
+        return [k for k, strategy in strategies.items() if strategy != "lazy" and k not in joins]
+
+    def _find_related(self, strategies, joins, rows: Sequence[Mapping]) -> list[dict[str, list]]:
+        """Related rows of the given rows, for relations loaded with one query for all the rows."""
+        related = [{} for _ in rows]
+        for k in self._get_selectin(strategies, joins):
+            relation = self.relations[k]
+            related_rows = relation.mapper.storage.find_many(
+                relation.mapper.__tablename__, relation.get_related_criteria(self, rows)
+            )
+            for _related, group in zip(related, relation.group_related(self, rows, related_rows)):
+                _related[k] = group
+        return related
+
+    def _load(
+        self,
+        row: Mapping,
+        identity: Optional[Identity] = None,
+        *,
+        related=None,
+        deferred: Sequence[str] = (),
+        refresh: Optional[RefreshPolicy] = None,
+    ) -> TMappedEntity:
+        """Entity for a storage row: the identity mapped instance, if any (refreshed or not, depending on the refresh
+        policy, defaulting to the mapper's one), or a new one (see :meth:`_to_entity`)."""
+        identity = identity if identity is not None else Identity.of(row, self.primary_key)
+        if self._cache is None or (entity := self._cache.get(identity)) is None:
+            return self._mapped(self._to_entity(row, identity, related=related, deferred=deferred))
+
+        refresh = refresh or self.refresh
+        if refresh == "overwrite" or (refresh == "refresh_clean" and entity.__state__.clean):
+            values = {k: row[k] for k in self.fields if k in row}
+            entity.__dict__.update(values)
+            for k, related_rows in (related or {}).items():
+                entity.__dict__[k] = Collection(self.relations[k].mapper._load(r) for r in related_rows)
+            entity.__state__.set_stored(values)
+            entity.__pydantic_fields_set__ = entity.__pydantic_fields_set__.difference(related or ())
+        return entity
+
+    def _to_entity(
+        self, row: Mapping, identity: Optional[Identity] = None, *, related=None, deferred: Sequence[str] = ()
+    ) -> TMappedEntity:
+        """Build a clean entity from a storage row. Relations get a lazy loading collection, unless their related rows
+        were loaded already (``related``, mapping relation names to lists of rows). ``deferred`` fields, missing from
+        the row, are loaded on first access."""
+        relations = {}
+        for k, relation in self.relations.items():
+            if related and k in related:
+                relations[k] = Collection(relation.mapper._load(related_row) for related_row in related[k])
+            else:
+                relations[k] = relation.get_collection_for(self, row)
+
+        identity = identity if identity is not None else Identity.of(row, self.primary_key)
+        entity = self._hydrator(row, identity, relations, store=getmeta(row, "store"))
+        if deferred:
+            entity.__state__.defer(deferred, partial(self._load_deferred, entity))
+        return entity
+
+    @cached_property
+    def _hydrator(self) -> Hydrator:
+        return Hydrator(self.__type__, self.relations)
+
     def _mapped(self, entity: TMappedEntity) -> TMappedEntity:
         """Make sure an entity is present in the cache."""
-        pk = tuple((str(getattr(entity, x)) for x in self.primary_key))
-        return self._cache.set(pk, entity) if self._cache is not None else entity
+        return self._cache.set(self._get_cache_key(entity), entity) if self._cache is not None else entity
+
+    def _get_cache_key(self, entity: TMappedEntity) -> Identity:
+        return entity.__state__.identity
+
+    def _get_cached_row(self, identity: Identity) -> Optional[Mapping]:
+        if self._second_level_cache is not None:
+            return self._second_level_cache.get((self.__tablename__, identity))
+        return None
+
+    def _cache_row(self, identity: Identity, row: Mapping):
+        if self._second_level_cache is not None:
+            self._second_level_cache.set((self.__tablename__, identity), row, ttl=self.second_level_cache_ttl)
+
+    def _evict_row(self, entity: TMappedEntity):
+        if self._second_level_cache is not None:
+            self._second_level_cache.delete((self.__tablename__, entity.__state__.identity))
 
     def _get_known_modified_values(self, entity: TMappedEntity) -> dict:
         """Gets a dict of changed values for the given entity, but limited to the fields we know about."""
-        return {k: getattr(entity, k) for k in entity.model_fields_set if k in self.fields}
+        return entity.__state__.changes(self.fields)
 
-    def _get_known_modified_related_values(self, entity: TMappedEntity) -> Mapping[str, Entity]:
-        """Gets a dict of changed values for the given entity, but limited to the fields we know about."""
-        return {k: getattr(entity, k) for k in entity.model_fields_set if k in self.relations}
+    def _insert_many(self, entities: Sequence[TMappedEntity]):
+        """Insert new entities with one storage call (their related entities are not saved)."""
+        values = [self._get_known_modified_values(entity) for entity in entities]
+        for entity, _values, new_identity in zip(
+            entities, values, self.storage.insert_many(self.__tablename__, values)
+        ):
+            entity.__state__.identity = Identity.of(new_identity, self.primary_key)
+            entity.__state__.set_clean({**_values, **new_identity})
+
+    def _update_many(self, entities: Sequence[TMappedEntity]):
+        """Write the changes of stored entities with one storage call (their related entities are not saved)."""
+        changes = [(entity, self._get_known_modified_values(entity)) for entity in entities]
+        if rows := [(entity.__state__.identity, values) for entity, values in changes if values]:
+            self.storage.update_many(self.__tablename__, rows)
+        for entity, values in changes:
+            if values:
+                self._evict_row(entity)
+            self._set_stored(entity, values)
+
+    def _set_stored(self, entity: TMappedEntity, values: Mapping):
+        """Mark the fields of a saved entity as not modified, the written ``values`` being the stored ones now."""
+        fields_set = entity.__pydantic_fields_set__
+        entity.__state__.set_stored({**{k: getattr(entity, k) for k in self.fields if k in fields_set}, **values})
+
+    def _get_known_modified_related_values(self, entity: TMappedEntity) -> Mapping[str, Collection]:
+        """Gets the related collections of the given entity that may have changes to save: the ones that were set, and
+        the ones that were loaded or modified (related collections that were not are left alone)."""
+        related_values = {}
+        for k in self.relations:
+            value = entity.__dict__.get(k)
+            if k in entity.__pydantic_fields_set__:
+                related_values[k] = value if isinstance(value, Collection) else Collection(value or ())
+            elif isinstance(value, Collection) and (value.loaded or value.changed):
+                related_values[k] = value
+        return related_values
+
+    def _get_related_changes(
+        self, relation: "Relation", related: Collection, *, replaced: bool
+    ) -> tuple[list[Entity], list[Entity], list[Entity]]:
+        """Changes of a related collection: the entities to link to the parent entity (new or added ones, or all of
+        them if the collection was ``replaced``), the entities to save (the linked ones, and the dirty ones), and the
+        stored entities removed from the collection. Only the added entities of a collection that is not loaded are
+        considered (the others cannot have been modified)."""
+        added = {id(related_entity) for related_entity in related.added}
+        linked, saved = [], []
+        for related_entity in related if related.loaded else related.added:
+            if replaced or id(related_entity) in added or related_entity.__state__.transient:
+                linked.append(related_entity)
+                saved.append(related_entity)
+            elif relation.mapper.is_dirty(related_entity):
+                saved.append(related_entity)
+        removed = [related_entity for related_entity in related.removed if not related_entity.__state__.transient]
+        return linked, saved, removed
+
+    def _save_related_values(self, entity: TMappedEntity, related_values: Mapping[str, Collection]):
+        """Save the changes of the related collections of a saved entity: linked and dirty entities in one batch,
+        detached or deleted orphans, depending on the relation's policy. Clean related entities are not written."""
+        for _field, _related in related_values.items():
+            relation = self.relations[_field]
+            linked, saved, removed = self._get_related_changes(
+                relation, _related, replaced=_field in entity.__pydantic_fields_set__
+            )
+            for _related_entity in linked:
+                relation.link(self, entity, _related_entity)
+            if relation.orphans == "delete":
+                for _related_entity in removed:
+                    relation.mapper.delete(_related_entity)
+            else:
+                for _related_entity in removed:
+                    relation.unlink(self, entity, _related_entity)
+                saved += removed
+            relation.mapper.save_many(saved)
+            _related.reset_changes()
+        entity.__pydantic_fields_set__ = entity.__pydantic_fields_set__.difference(related_values)
 
     @classmethod
     def _infer_type_if_possible_and_necessary(cls, new_object):
@@ -162,8 +675,280 @@ class Mapper[TMappedEntity]:
             inferred_type = None
         if (
             new_object.__type__ is None
-            and inferred_type
-            and (inferred_type is not TMappedEntity)
+            and isinstance(inferred_type, type)  # not a type parameter, for generic subclasses
             and issubclass(inferred_type, Entity)
         ):
             new_object.__type__ = inferred_type
+
+
+class AsyncMapper[TMappedEntity](Mapper[TMappedEntity]):
+    """Maps entities to async storage backends (see :class:`anymodel.storages.AsyncStorage`).
+
+    Same as :class:`Mapper`, but storage operations are coroutines (``await mapper.save(entity)``, ``await
+    mapper.find_one_by_pk(pk)``), ``find`` is an async iterator, and relations of the entities it loads are collections
+    to load with ``await collection.aload()``.
+
+    Primary key lookups of concurrent coroutines can be batched, setting ``lookup_batch_delay``: the ``find_one_by_pk``
+    calls issued within one event loop tick (0) or within this many seconds are then resolved with one ``In`` query
+    (each primary key being looked up once), their results going through the identity map as usual. Lookups with
+    ``load``, ``only`` or ``defer`` options are not batched.
+    """
+
+    storage: "AsyncStorage"
+
+    # seconds during which primary key lookups are collected to be found with one query (0 for the lookups of one event
+    # loop tick), None to find each of them with its own query
+    lookup_batch_delay: Optional[float] = None
+
+    async def save(self, entity: TMappedEntity) -> TMappedEntity:
+        values = self._get_known_modified_values(entity)
+        related_values = self._get_known_modified_related_values(entity)
+
+        identity = entity.__state__.identity
+        if identity is not None:
+            if values:
+                await self.storage.update(self.__tablename__, identity, values)
+                self._evict_row(entity)
+            self._set_stored(entity, values)
+        else:
+            new_identity = await self.storage.insert(self.__tablename__, values)
+            entity.__state__.identity = Identity.of(new_identity, self.primary_key)
+            entity.__state__.set_clean({**values, **new_identity})
+
+        await self._save_related_values(entity, related_values)
+
+        return self._mapped(entity)
+
+    async def save_many(self, entities: Iterable[TMappedEntity]) -> list[TMappedEntity]:
+        entities = list(entities)
+        related_values = [self._get_known_modified_related_values(entity) for entity in entities]
+        new_entities = [entity for entity in entities if entity.__state__.identity is None]
+        stored_entities = [entity for entity in entities if entity.__state__.identity is not None]
+
+        if new_entities:
+            await self._insert_many(new_entities)
+        if stored_entities:
+            await self._update_many(stored_entities)
+        for entity, _related_values in zip(entities, related_values):
+            await self._save_related_values(entity, _related_values)
+
+        return [self._mapped(entity) for entity in entities]
+
+    async def delete(self, entity: TMappedEntity) -> TMappedEntity:
+        if (identity := entity.__state__.identity) is None:
+            raise ValueError("Cannot delete a transient entity.")
+
+        await self.storage.delete(self.__tablename__, identity)
+        self._evict_row(entity)
+        if self._cache is not None:
+            self._cache.delete(self._get_cache_key(entity))
+        entity.__state__.detach()
+
+        return entity
+
+    async def find_one_by_pk(
+        self,
+        *pk,
+        load: Optional[str | Mapping[str, str]] = None,
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+    ) -> TMappedEntity:
+        identity = self._get_pk(pk)
+        if self._cache is not None and (cached := self._cache.get(identity)) is not None:
+            return cached
+        if self.lookup_batch_delay is not None and load is None and only is None and defer is None:
+            return await self._lookups.load(identity)
+
+        strategies, fields = self._get_strategies(load), self._get_fields(only, defer)
+        if (cached_row := self._get_cached_row(identity)) is not None:
+            rows, joins = [(project(cached_row, fields) if fields is not None else cached_row, {})], {}
+        elif joins := self._get_joins(strategies):
+            rows = [
+                item
+                async for item in self.storage.find_many_joined(
+                    self.__tablename__, identity, joins, limit=1, fields=fields
+                )
+            ]
+        elif fields is not None:
+            rows = [
+                (row, {}) async for row in self.storage.find_many(self.__tablename__, identity, limit=1, fields=fields)
+            ]
+        elif (row := await self.storage.find_one(self.__tablename__, identity)) is not None:
+            rows = [(row, {})]
+        else:
+            rows = []
+
+        for row, related in rows:
+            if cached_row is None and fields is None:
+                self._cache_row(identity, row)
+            related.update((await self._find_related(strategies, joins, [row]))[0])
+            return self._load(row, identity, related=related, deferred=self._get_deferred(fields))
+        return None
+
+    async def find_many_by_pks(self, pks: Iterable) -> list[Optional[TMappedEntity]]:
+        pks = self._get_pks(pks)
+        entities, rows, missing = self._partition_pks(pks)
+        if missing:
+            found = await self.storage.find_by_identities(self.__tablename__, missing)
+            self._set_found_rows(rows, missing, found)
+
+        related = await self._find_related(self._get_strategies(None), {}, list(rows.values()))
+        entities.update((pk, self._load(row, related=_related)) for (pk, row), _related in zip(rows.items(), related))
+        return [entities.get(pk) for pk in pks]
+
+    async def find(
+        self,
+        *expressions: Expression,
+        load: Optional[str | Mapping[str, str]] = None,
+        order_by: Optional[str | FieldRef | Sequence[str | FieldRef]] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        after: Optional[str] = None,
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        refresh: Optional[RefreshPolicy] = None,
+        **criteria,
+    ) -> AsyncIterator[TMappedEntity]:
+        """Same as :meth:`Mapper.find`, except that deferred fields must be loaded with :meth:`undefer` before being
+        accessed."""
+        strategies, fields = self._get_strategies(load), self._get_fields(only, defer)
+        refresh = check_refresh_policy(refresh or self.refresh)
+        criteria, options = self._get_query(expressions, criteria, order_by, limit, offset, after)
+        deferred = self._get_deferred(fields)
+        if joins := self._get_joins(strategies):
+            rows = self.storage.find_many_joined(self.__tablename__, criteria, joins, fields=fields, **options)
+        else:
+            rows = (
+                (row, {})
+                async for row in self.storage.find_many(self.__tablename__, criteria, fields=fields, **options)
+            )
+
+        if not self._get_selectin(strategies, joins):
+            async for row, related in rows:
+                yield self._load(row, related=related, deferred=deferred, refresh=refresh)
+            return
+
+        page = []
+        async for item in rows:
+            page.append(item)
+            if len(page) >= self.eager_batch_size:
+                for entity in await self._to_entities(strategies, joins, page, deferred, refresh):
+                    yield entity
+                page = []
+        for entity in await self._to_entities(strategies, joins, page, deferred, refresh):
+            yield entity
+
+    async def count(self, *expressions: Expression, **criteria) -> int:
+        return await self.storage.count(self.__tablename__, self._get_criteria(expressions, criteria))
+
+    async def exists(self, *expressions: Expression, **criteria) -> bool:
+        return await self.storage.exists(self.__tablename__, self._get_criteria(expressions, criteria))
+
+    async def aggregate(
+        self,
+        *expressions: Expression,
+        group_by: Optional[str | Sequence[str]] = None,
+        sum: Optional[str | Sequence[str]] = None,
+        min: Optional[str | Sequence[str]] = None,
+        max: Optional[str | Sequence[str]] = None,
+        avg: Optional[str | Sequence[str]] = None,
+        **criteria,
+    ) -> dict | list[dict]:
+        group_by, aggregates = self._get_aggregates(group_by, {"sum": sum, "min": min, "max": max, "avg": avg})
+        criteria = self._get_criteria(expressions, criteria)
+        results = await self.storage.aggregate(self.__tablename__, criteria, group_by=group_by, aggregates=aggregates)
+        return results if group_by else results[0]
+
+    async def undefer(self, entity: TMappedEntity) -> TMappedEntity:
+        """Load the deferred fields of an entity, if any (with one query)."""
+        if fields := entity.__state__.deferred:
+            rows = self.storage.find_many(
+                self.__tablename__, entity.__state__.identity, limit=1, fields=[*self.primary_key, *fields]
+            )
+            async for row in rows:
+                entity.__state__.load_deferred(row)
+                break
+            else:
+                raise ValueError("Row not found, cannot load deferred fields.")
+        return entity
+
+    def transaction(self) -> AbstractAsyncContextManager:
+        """Async context manager running every storage operation of the block within one storage transaction."""
+        return self.storage.transaction()
+
+    def _load_deferred(self, entity: TMappedEntity, fields: set[str]) -> Mapping:
+        raise RuntimeError(
+            f"Deferred fields {sorted(fields)} of an async mapper entity must be loaded with mapper.undefer(entity)."
+        )
+
+    @cached_property
+    def _lookups(self) -> BatchLoader:
+        return BatchLoader(self.find_many_by_pks, delay=self.lookup_batch_delay)
+
+    async def _to_entities(
+        self,
+        strategies,
+        joins,
+        page: list[tuple[Mapping, dict]],
+        deferred: Sequence[str] = (),
+        refresh: Optional[RefreshPolicy] = None,
+    ) -> list[TMappedEntity]:
+        if not page:
+            return []
+        more_related = await self._find_related(strategies, joins, [row for row, _ in page])
+        return [
+            self._load(row, related={**related, **_more_related}, deferred=deferred, refresh=refresh)
+            for (row, related), _more_related in zip(page, more_related)
+        ]
+
+    async def _find_related(self, strategies, joins, rows: Sequence[Mapping]) -> list[dict[str, list]]:
+        related = [{} for _ in rows]
+        for k in self._get_selectin(strategies, joins):
+            relation = self.relations[k]
+            related_rows = relation.mapper.storage.find_many(
+                relation.mapper.__tablename__, relation.get_related_criteria(self, rows)
+            )
+            # related mappers may be sync or async ones
+            if hasattr(related_rows, "__aiter__"):
+                related_rows = [related_row async for related_row in related_rows]
+            for _related, group in zip(related, relation.group_related(self, rows, related_rows)):
+                _related[k] = group
+        return related
+
+    async def _insert_many(self, entities: Sequence[TMappedEntity]):
+        values = [self._get_known_modified_values(entity) for entity in entities]
+        new_identities = await self.storage.insert_many(self.__tablename__, values)
+        for entity, _values, new_identity in zip(entities, values, new_identities):
+            entity.__state__.identity = Identity.of(new_identity, self.primary_key)
+            entity.__state__.set_clean({**_values, **new_identity})
+
+    async def _update_many(self, entities: Sequence[TMappedEntity]):
+        changes = [(entity, self._get_known_modified_values(entity)) for entity in entities]
+        if rows := [(entity.__state__.identity, values) for entity, values in changes if values]:
+            await self.storage.update_many(self.__tablename__, rows)
+        for entity, values in changes:
+            if values:
+                self._evict_row(entity)
+            self._set_stored(entity, values)
+
+    async def _save_related_values(self, entity: TMappedEntity, related_values: Mapping[str, Collection]):
+        for _field, _related in related_values.items():
+            relation = self.relations[_field]
+            linked, saved, removed = self._get_related_changes(
+                relation, _related, replaced=_field in entity.__pydantic_fields_set__
+            )
+            for _related_entity in linked:
+                relation.link(self, entity, _related_entity)
+            # related mappers may be sync or async ones
+            if relation.orphans == "delete":
+                for _related_entity in removed:
+                    if inspect.isawaitable(result := relation.mapper.delete(_related_entity)):
+                        await result
+            else:
+                for _related_entity in removed:
+                    relation.unlink(self, entity, _related_entity)
+                saved += removed
+            if inspect.isawaitable(result := relation.mapper.save_many(saved)):
+                await result
+            _related.reset_changes()
+        entity.__pydantic_fields_set__ = entity.__pydantic_fields_set__.difference(related_values)
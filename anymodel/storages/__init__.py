@@ -4,8 +4,10 @@ This module provides various storage implementations for persisting entities.
 Available storage backends include in-memory, filesystem, and SQL database storage.
 """
 
-from anymodel.storages.base import Storage
+from anymodel.storages.base import AsyncStorage, AsyncStorageAdapter, Storage
 
 __all__ = [
+    "AsyncStorage",
+    "AsyncStorageAdapter",
     "Storage",
 ]
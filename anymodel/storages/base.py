@@ -1,9 +1,13 @@
-"""Base storage module defining the storage interface."""
+"""Base storage module defining the storage interfaces, synchronous and asynchronous."""
 
-from typing import Any, Iterable, Mapping, Optional
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from itertools import islice
+from typing import Any, AsyncIterator, Iterable, Mapping, Optional, Sequence
 
 from anymodel.mapper import Mapper
 from anymodel.types.mappings import ResultMapping
+from anymodel.types.queries import Aggregates, Criteria, aggregate_rows
 
 
 class Storage:
@@ -11,12 +15,218 @@ class Storage:
 
     All storage implementations must inherit from this class and implement
     the required methods for CRUD operations and schema management.
+
+    ``find_many`` returns only the given ``fields`` of each row, if any (criteria and ordering may still use the
+    others), so that storages able to do so fetch less data.
+
+    Storages able to load rows along with their related rows in one query set ``supports_joins``, and implement
+    ``find_many_joined``. Storages only able to find rows by identity (``find_many`` raising NotImplementedError)
+    set ``supports_queries`` to False.
     """
 
+    supports_joins: bool = False
+    supports_queries: bool = True
+
     def add_table(self, mapper: Mapper): ...
     def migrate(self, **kwargs): ...
     def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]: ...
-    def find_many(self, tablename: str, criteria: dict, *, limit=None, offset=None) -> Iterable[ResultMapping]: ...
+    def find_many(
+        self, tablename: str, criteria: Criteria, *, limit=None, offset=None, order_by=None, fields=None
+    ) -> Iterable[ResultMapping]: ...
     def insert(self, tablename: str, values: dict) -> ResultMapping: ...
     def update(self, tablename: str, identity: Mapping[str, Any], values: dict) -> None: ...
     def delete(self, tablename, identity: dict): ...
+
+    def find_many_joined(
+        self,
+        tablename: str,
+        criteria: Criteria,
+        joins: Mapping[str, tuple[str, str]],
+        *,
+        limit=None,
+        offset=None,
+        order_by=None,
+        fields=None,
+    ) -> Iterable[tuple[ResultMapping, dict[str, list[ResultMapping]]]]:
+        """Same as ``find_many``, also loading the related rows of each row, for each join (named, and given as a
+        (related table, foreign key referencing the row id) pair). Yields (row, {join name: related rows}) pairs."""
+        raise NotImplementedError(f"{type(self).__name__} does not support joins.")
+
+    def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        """Rows of the given identities, in the same order (None for the missing ones). Storages should override this
+        with a bulk implementation, the default falls back to one lookup per identity."""
+        return [self.find_one(tablename, dict(identity)) for identity in identities]
+
+    def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        """Insert many rows, returns the generated identities in the same order as the given rows. Storages should
+        override this with a batched implementation, the default falls back to one insert per row."""
+        return [self.insert(tablename, values) for values in rows]
+
+    def update_many(self, tablename: str, rows: Iterable[tuple[Mapping[str, Any], Mapping[str, Any]]]) -> None:
+        """Update many rows, given as (identity, values) pairs. Storages should override this with a batched
+        implementation, the default falls back to one update per row."""
+        for identity, values in rows:
+            self.update(tablename, identity, values)
+
+    def count(self, tablename: str, criteria: Criteria) -> int:
+        """Number of rows matching the criteria. Storages should override this (and ``exists`` and ``aggregate``)
+        when they can do better than the default, which scans the matching rows."""
+        return sum(1 for _ in self.find_many(tablename, criteria, fields=()))
+
+    def exists(self, tablename: str, criteria: Criteria) -> bool:
+        """Whether any row matches the criteria."""
+        return any(True for _ in self.find_many(tablename, criteria, limit=1, fields=()))
+
+    def aggregate(
+        self, tablename: str, criteria: Criteria, *, group_by: Sequence[str] = (), aggregates: Aggregates
+    ) -> list[dict[str, Any]]:
+        """Aggregates (by output name, a (function, field) pair, see :data:`anymodel.types.queries.Aggregates`) of
+        the rows matching the criteria, for each group of rows sharing the same ``group_by`` values."""
+        fields = [*group_by, *(field for _, field in aggregates.values() if field is not None)]
+        return aggregate_rows(self.find_many(tablename, criteria, fields=fields), group_by, aggregates)
+
+    @contextmanager
+    def transaction(self):
+        """Run the operations of the block as one unit of work (same connection, one commit) if the storage supports
+        it. Blocks can be nested. The default implementation has no transactional semantics and does nothing."""
+        yield self
+
+
+class AsyncStorage:
+    """Abstract base class for async storage backends, used by :class:`anymodel.mapper.AsyncMapper`.
+
+    Same interface as :class:`Storage`, except that operations are coroutines, ``find_many`` returns an async iterator
+    and ``transaction`` an async context manager. ``add_table`` stays synchronous, as mappers call it on
+    initialization.
+    """
+
+    supports_joins: bool = False
+
+    def add_table(self, mapper: Mapper): ...
+    async def migrate(self, **kwargs): ...
+    async def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]: ...
+    def find_many(
+        self, tablename: str, criteria: Criteria, *, limit=None, offset=None, order_by=None, fields=None
+    ) -> AsyncIterator[ResultMapping]: ...
+    async def insert(self, tablename: str, values: dict) -> ResultMapping: ...
+    async def update(self, tablename: str, identity: Mapping[str, Any], values: dict) -> None: ...
+    async def delete(self, tablename, identity: dict): ...
+
+    def find_many_joined(
+        self,
+        tablename: str,
+        criteria: Criteria,
+        joins: Mapping[str, tuple[str, str]],
+        *,
+        limit=None,
+        offset=None,
+        order_by=None,
+        fields=None,
+    ) -> AsyncIterator[tuple[ResultMapping, dict[str, list[ResultMapping]]]]:
+        raise NotImplementedError(f"{type(self).__name__} does not support joins.")
+
+    async def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        return [await self.find_one(tablename, dict(identity)) for identity in identities]
+
+    async def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        return [await self.insert(tablename, values) for values in rows]
+
+    async def update_many(self, tablename: str, rows: Iterable[tuple[Mapping[str, Any], Mapping[str, Any]]]) -> None:
+        for identity, values in rows:
+            await self.update(tablename, identity, values)
+
+    async def count(self, tablename: str, criteria: Criteria) -> int:
+        count = 0
+        async for _ in self.find_many(tablename, criteria, fields=()):
+            count += 1
+        return count
+
+    async def exists(self, tablename: str, criteria: Criteria) -> bool:
+        async for _ in self.find_many(tablename, criteria, limit=1, fields=()):
+            return True
+        return False
+
+    async def aggregate(
+        self, tablename: str, criteria: Criteria, *, group_by: Sequence[str] = (), aggregates: Aggregates
+    ) -> list[dict[str, Any]]:
+        fields = [*group_by, *(field for _, field in aggregates.values() if field is not None)]
+        rows = [row async for row in self.find_many(tablename, criteria, fields=fields)]
+        return aggregate_rows(rows, group_by, aggregates)
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self
+
+
+class AsyncStorageAdapter(AsyncStorage):
+    """Async interface over a synchronous storage.
+
+    Operations run in worker threads (one at a time per call, using :func:`asyncio.to_thread`) so that blocking I/O
+    does not block the event loop, unless ``threaded`` is false, for storages that do not block (``MemoryStorage``).
+    ``find_many`` reads the rows by chunks of ``chunk_size`` rows, one thread hop per chunk.
+    """
+
+    def __init__(self, storage: Storage, *, threaded: bool = True, chunk_size: int = 100):
+        self.storage = storage
+        self.threaded = threaded
+        self.chunk_size = chunk_size
+
+    def add_table(self, mapper: Mapper):
+        self.storage.add_table(mapper)
+
+    async def migrate(self, **kwargs):
+        await self._run(self.storage.migrate, **kwargs)
+
+    async def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]:
+        return await self._run(self.storage.find_one, tablename, criteria)
+
+    async def find_many(self, tablename: str, criteria: dict, **kwargs) -> AsyncIterator[ResultMapping]:
+        rows = iter(self.storage.find_many(tablename, criteria, **kwargs))
+        while chunk := await self._run(list, islice(rows, self.chunk_size)):
+            for row in chunk:
+                yield row
+
+    async def insert(self, tablename: str, values: dict) -> ResultMapping:
+        return await self._run(self.storage.insert, tablename, values)
+
+    async def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        return await self._run(self.storage.find_by_identities, tablename, list(identities))
+
+    async def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        return await self._run(self.storage.insert_many, tablename, list(rows))
+
+    async def update(self, tablename: str, identity: Mapping[str, Any], values: dict) -> None:
+        return await self._run(self.storage.update, tablename, identity, values)
+
+    async def delete(self, tablename, identity: dict):
+        return await self._run(self.storage.delete, tablename, identity)
+
+    async def update_many(self, tablename: str, rows: Iterable[tuple[Mapping[str, Any], Mapping[str, Any]]]) -> None:
+        return await self._run(self.storage.update_many, tablename, list(rows))
+
+    async def count(self, tablename: str, criteria: Criteria) -> int:
+        return await self._run(self.storage.count, tablename, criteria)
+
+    async def exists(self, tablename: str, criteria: Criteria) -> bool:
+        return await self._run(self.storage.exists, tablename, criteria)
+
+    async def aggregate(self, tablename: str, criteria: Criteria, **kwargs) -> list[dict[str, Any]]:
+        return await self._run(self.storage.aggregate, tablename, criteria, **kwargs)
+
+    @asynccontextmanager
+    async def transaction(self):
+        # worker threads run in a copy of the current context, so storages pinning state in context variables (like
+        # sql connections) see it there too.
+        with self.storage.transaction():
+            yield self
+
+    async def _run(self, func, /, *args, **kwargs):
+        if self.threaded:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        return func(*args, **kwargs)
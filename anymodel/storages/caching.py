@@ -0,0 +1,314 @@
+"""Read-through caching storage.
+
+This module provides a storage wrapping another one, caching the rows and the
+results of the queries it runs, and invalidating them when rows are written
+through it.
+"""
+
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Iterable, Mapping, Optional, Sequence
+from uuid import UUID
+
+from anymodel.mapper import Mapper
+from anymodel.types.mappings import ResultMapping, project
+from anymodel.types.queries import (
+    And,
+    Condition,
+    Criteria,
+    In,
+    Like,
+    Not,
+    Or,
+    Prefix,
+    Range,
+    parse_order_by,
+)
+from anymodel.utilities.caches import BoundedCache, Cache, CacheStats
+
+from .base import Storage
+
+_MISSING = object()
+
+
+class CachingStorage(Storage):
+    """Storage caching the rows and query results of another storage (the backend).
+
+    Rows are cached by primary key. ``find_one`` and ``find_many`` results are cached as lists of primary keys, by
+    normalized query (criteria, ordering, paging and fields), so that rows are cached once whatever the queries
+    finding them. Writes evict the rows they change, and invalidate all the cached queries of the table (by changing
+    its generation, a part of the keys of the queries kept as a version of the cache: stale entries are never read
+    again, and are evicted by the cache in due time). Rows written without a primary key criteria invalidate all the
+    cached rows of the table.
+
+    The cache defaults to an in-process :class:`anymodel.utilities.caches.BoundedCache`, and may be shared by several
+    processes (using a :class:`anymodel.utilities.caches.SqliteCache`). Only the writes going through a caching storage
+    invalidate the cache, other changes are only seen once the cached entries expire.
+
+    Queries using criteria the storage cannot normalize (custom predicates, values of unknown types), queries run
+    within a transaction, counts and aggregates, and joined queries go to the backend. ``stats`` counts the queries
+    served from the cache (hits) and the ones sent to the backend (misses).
+    """
+
+    def __init__(self, backend: Storage, cache: Optional[Cache] = None, *, ttl: Optional[float] = None):
+        self.backend = backend
+        self.cache = cache if cache is not None else BoundedCache(max_entries=10_000)
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._primary_keys: dict[str, tuple[str, ...]] = {}
+        # tables written within the current transaction, if any (to invalidate them again once it is over)
+        self._written: ContextVar[Optional[set[str]]] = ContextVar(f"{type(self).__name__}.written.{id(self)}")
+
+    @property
+    def supports_joins(self) -> bool:
+        return self.backend.supports_joins
+
+    @property
+    def supports_queries(self) -> bool:
+        return self.backend.supports_queries
+
+    def add_table(self, mapper: Mapper):
+        self._primary_keys[mapper.__tablename__] = mapper.primary_key
+        self.backend.add_table(mapper)
+
+    def migrate(self, **kwargs):
+        self.backend.migrate(**kwargs)
+
+    def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]:
+        if (pk := self._get_pk(tablename, criteria)) is not None:
+            # primary key lookups go straight to the rows cache
+            return self._get_rows(tablename, [pk])[0]
+        elif (key := self._get_query_key(tablename, "one", criteria)) is None:
+            self.stats.misses += 1
+            return self.backend.find_one(tablename, criteria)
+        elif (pks := self.cache.get(key)) is not None:
+            rows = [row for row in self._get_rows(tablename, pks) if row is not None]
+        else:
+            self.stats.misses += 1
+            row = self.backend.find_one(tablename, criteria)
+            self._set_rows(tablename, [row] if row is not None else [], key)
+            return row
+        return rows[0] if rows else None
+
+    def find_many(
+        self,
+        tablename: str,
+        criteria: Criteria,
+        *,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        order_by: Optional[str | Iterable[str]] = None,
+        fields: Optional[Sequence[str]] = None,
+    ) -> Iterable[ResultMapping]:
+        options = {"limit": limit, "offset": offset, "order_by": order_by, "fields": fields}
+        query = (criteria, limit, offset, parse_order_by(order_by), tuple(fields) if fields is not None else None)
+        if (key := self._get_query_key(tablename, "many", *query)) is None:
+            self.stats.misses += 1
+            return self.backend.find_many(tablename, criteria, **options)
+        if (pks := self.cache.get(key)) is not None:
+            rows = [row for row in self._get_rows(tablename, pks) if row is not None]
+            return [project(row, fields) for row in rows] if fields is not None else rows
+
+        self.stats.misses += 1
+        rows = list(self.backend.find_many(tablename, criteria, **options))
+        # projected rows only give the list of primary keys
+        self._set_rows(tablename, rows, key, full=fields is None)
+        return rows
+
+    def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        identities = list(identities)
+        pks = [self._get_pk(tablename, identity) for identity in identities]
+        if any(pk is None for pk in pks):
+            self.stats.misses += 1
+            return self.backend.find_by_identities(tablename, identities)
+        return self._get_rows(tablename, pks)
+
+    def find_many_joined(self, tablename: str, criteria: Criteria, joins: Mapping[str, tuple[str, str]], **kwargs):
+        self.stats.misses += 1
+        return self.backend.find_many_joined(tablename, criteria, joins, **kwargs)
+
+    def count(self, tablename: str, criteria: Criteria) -> int:
+        return self.backend.count(tablename, criteria)
+
+    def exists(self, tablename: str, criteria: Criteria) -> bool:
+        return self.backend.exists(tablename, criteria)
+
+    def aggregate(self, tablename: str, criteria: Criteria, **kwargs) -> list[dict[str, Any]]:
+        return self.backend.aggregate(tablename, criteria, **kwargs)
+
+    def insert(self, tablename: str, values: dict) -> ResultMapping:
+        return self.insert_many(tablename, (values,))[0]
+
+    def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        identities = self.backend.insert_many(tablename, rows)
+        self._invalidate(tablename, identities)
+        return identities
+
+    def update(self, tablename: str, identity: Mapping[str, Any], values: dict) -> None:
+        try:
+            return self.backend.update(tablename, identity, values)
+        finally:
+            self._invalidate(tablename, [identity])
+
+    def update_many(self, tablename: str, rows: Iterable[tuple[Mapping[str, Any], Mapping[str, Any]]]) -> None:
+        rows = list(rows)
+        try:
+            return self.backend.update_many(tablename, rows)
+        finally:
+            self._invalidate(tablename, [identity for identity, _ in rows])
+
+    def delete(self, tablename, identity: dict):
+        try:
+            return self.backend.delete(tablename, identity)
+        finally:
+            self._invalidate(tablename, [identity])
+
+    @contextmanager
+    def transaction(self):
+        """Backend transaction. Queries of the block bypass the cache, which must not see uncommitted rows, and the
+        tables written in the block are invalidated again once it is over, for the queries that may have cached their
+        previous rows meanwhile."""
+        if self._written.get(None) is not None:
+            with self.backend.transaction():
+                yield self
+            return
+
+        token = self._written.set(written := set())
+        try:
+            with self.backend.transaction():
+                yield self
+        finally:
+            self._written.reset(token)
+            for tablename in written:
+                self._invalidate(tablename, None)
+
+    ### (semi) private
+
+    def _get_pk(self, tablename: str, criteria: Criteria) -> Optional[tuple]:
+        """Primary key values of the criteria, if it only matches a primary key."""
+        primary_key = self._primary_keys.get(tablename)
+        if (
+            not primary_key
+            or not isinstance(criteria, Mapping)
+            or set(criteria) != set(primary_key)
+            or self._written.get(None) is not None
+            or not all(isinstance(criteria[k], _SCALARS) for k in primary_key)
+        ):
+            return None
+        return tuple(criteria[k] for k in primary_key)
+
+    def _get_query_key(self, tablename: str, kind: str, criteria: Criteria, *options) -> Optional[str]:
+        """Cache key of a query, or None if it cannot be cached."""
+        if self._written.get(None) is not None or (normalized := _normalize(criteria)) is None:
+            return None
+        if any(_normalize(option) is None and option is not None for option in options):
+            return None
+        generation = self._get_generation(tablename, "queries")
+        return repr(("query", tablename, generation, kind, normalized, *options))
+
+    def _get_row_key(self, tablename: str, pk: Sequence) -> str:
+        return repr(("row", tablename, self._get_generation(tablename, "rows"), tuple(pk)))
+
+    def _get_generation(self, tablename: str, kind: str) -> str:
+        """Current generation of the queries (or rows) of a table. Generations are random, so that a generation
+        evicted from the cache is never replaced by a previous one."""
+        key = repr(("generation", tablename, kind))
+        if (generation := self.cache.get_version(key)) is None:
+            generation = uuid.uuid4().hex
+            self.cache.set_version(key, generation)
+        return generation
+
+    def _get_rows(self, tablename: str, pks: Sequence[tuple]) -> list[Optional[ResultMapping]]:
+        """Rows for the given primary keys (values of the primary key fields, with their native types), in the same
+        order, from the cache or from the backend (with one call for all the missing rows). Rows deleted meanwhile
+        are None."""
+        rows = [self.cache.get(self._get_row_key(tablename, pk), _MISSING) for pk in pks]
+        if missing := [index for index, row in enumerate(rows) if row is _MISSING]:
+            self.stats.misses += 1
+            primary_key = self._primary_keys[tablename]
+            found = self.backend.find_by_identities(
+                tablename, [dict(zip(primary_key, pks[index])) for index in missing]
+            )
+            for index, row in zip(missing, found):
+                if row is not None:
+                    self.cache.set(self._get_row_key(tablename, pks[index]), dict(row), ttl=self.ttl)
+                rows[index] = row
+        else:
+            self.stats.hits += 1
+        return rows
+
+    def _set_rows(self, tablename: str, rows: Sequence[ResultMapping], key: str, *, full: bool = True):
+        primary_key = self._primary_keys.get(tablename)
+        if not primary_key or not all(k in row for row in rows for k in primary_key):
+            return
+        pks = [tuple(row[k] for k in primary_key) for row in rows]
+        if full:
+            for pk, row in zip(pks, rows):
+                self.cache.set(self._get_row_key(tablename, pk), dict(row), ttl=self.ttl)
+        self.cache.set(key, pks, ttl=self.ttl)
+
+    def _invalidate(self, tablename: str, identities: Optional[Iterable[Mapping]]):
+        """Invalidate the cached queries of a table, and the cached rows of the given identities (all the rows of the
+        table, if an identity is not a primary key, or if no identities are given)."""
+        if (written := self._written.get(None)) is not None:
+            written.add(tablename)
+        self.cache.set_version(repr(("generation", tablename, "queries")), uuid.uuid4().hex)
+        pks = [self._get_identity_pk(tablename, identity) for identity in identities or [None]]
+        if any(pk is None for pk in pks):
+            self.cache.set_version(repr(("generation", tablename, "rows")), uuid.uuid4().hex)
+            return
+        for pk in pks:
+            self.cache.delete(self._get_row_key(tablename, pk))
+
+    def _get_identity_pk(self, tablename: str, identity: Optional[Mapping]) -> Optional[tuple]:
+        primary_key = self._primary_keys.get(tablename)
+        if not primary_key or not isinstance(identity, Mapping) or set(identity) != set(primary_key):
+            return None
+        return tuple(identity[k] for k in primary_key)
+
+
+_SCALARS = (str, int, float, bool, bytes, Decimal, UUID, date, datetime, time, Enum)
+
+
+def _normalize(value) -> Any:
+    """Deterministic (with a stable ``repr``) form of criteria, or of values within criteria, equal for equivalent
+    criteria. None if the value cannot be normalized (custom predicates, objects of other types)."""
+    if value is None or isinstance(value, _SCALARS):
+        return value
+    if isinstance(value, Mapping):
+        # criteria mappings are conjunctions of conditions, like the expressions they are equivalent to
+        return _normalize(And(Condition(k, v) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        items = tuple(_normalize(item) for item in value)
+        return None if any(a is None and b is not None for a, b in zip(items, value)) else items
+    if isinstance(value, Range):
+        bounds = (_normalize(value.lower), _normalize(value.upper))
+        if any(a is None and b is not None for a, b in zip(bounds, (value.lower, value.upper))):
+            return None
+        return "range", *bounds, value.lower_inclusive, value.upper_inclusive
+    if isinstance(value, In):
+        items = [_normalize(item) for item in value.values]
+        return None if any(item is None for item in items) else ("in", tuple(sorted(items, key=repr)))
+    if isinstance(value, Like):
+        return "like", value.pattern
+    if isinstance(value, Prefix):
+        return "prefix", value.prefix
+    if isinstance(value, Condition):
+        normalized = _normalize(value.value)
+        return None if normalized is None and value.value is not None else ("condition", value.field, normalized)
+    if isinstance(value, (And, Or)):
+        items = [_normalize(item) for item in value.items]
+        if any(item is None for item in items):
+            return None
+        if len(items) == 1:
+            return items[0]
+        return type(value).__name__.lower(), tuple(sorted(items, key=repr))
+    if isinstance(value, Not):
+        return None if (item := _normalize(value.item)) is None else ("not", item)
+    return None
@@ -0,0 +1,273 @@
+"""Row codecs for the filesystem storage.
+
+This module provides the codecs used by FileSystemStorage to serialize rows to
+bytes and back: pickle (the default), JSON, and a schema-aware compact binary
+format, plus an optional compression wrapper using zlib or lzma.
+"""
+
+import lzma
+import pickle
+import struct
+import zlib
+from datetime import date, datetime
+from typing import TYPE_CHECKING, Any, Literal, Mapping, Optional, Sequence, TypedDict
+
+from pydantic import ConfigDict, TypeAdapter, ValidationError, with_config
+from pydantic_core import from_json, to_json
+
+if TYPE_CHECKING:
+    from anymodel.mapper import Mapper
+
+
+class Codec:
+    """Base class for row codecs.
+
+    Schema-aware codecs use ``bind`` to return a codec specialized for the fields of a mapper, storages call it when
+    a table is added. Codecs must still work unbound, for tables the storage knows nothing about.
+    """
+
+    def bind(self, mapper: "Mapper") -> "Codec":
+        return self
+
+    def encode(self, row: Mapping[str, Any]) -> bytes: ...
+    def decode(self, data: bytes) -> dict[str, Any]: ...
+
+
+class PickleCodec(Codec):
+    """Pickle codec, handles any python value. Fast, but only safe to load data from trusted sources with compatible
+    versions of the classes involved."""
+
+    def __init__(self, protocol: Optional[int] = None):
+        self.protocol = protocol
+
+    def encode(self, row: Mapping[str, Any]) -> bytes:
+        return pickle.dumps(row, protocol=self.protocol)
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        return pickle.loads(data)
+
+
+class JsonCodec(Codec):
+    """JSON codec, using pydantic-core's native serializer and parser.
+
+    Values without a JSON counterpart (datetimes, uuids, decimals ...) are stored as strings. Once bound to a mapper,
+    decoded rows are validated against the field annotations so that those values get their python type back (rows
+    that do not validate are returned as stored).
+    """
+
+    def __init__(self, adapter: Optional[TypeAdapter] = None):
+        self.adapter = adapter
+
+    def bind(self, mapper: "Mapper") -> "JsonCodec":
+        # stored rows are not validated on write, hence the permissive types (and the fallback in decode)
+        fields = {
+            k: Optional[mapper.__type__.model_fields[k].annotation]
+            for k in mapper.fields
+            if k not in (mapper.relations or ())
+        }
+        row_type = with_config(ConfigDict(extra="allow"))(TypedDict(f"{mapper.__tablename__}_row", fields, total=False))
+        return type(self)(TypeAdapter(row_type))
+
+    def encode(self, row: Mapping[str, Any]) -> bytes:
+        return to_json(row)
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        if self.adapter is not None:
+            try:
+                return self.adapter.validate_json(data)
+            except ValidationError:
+                pass
+        return from_json(data)
+
+
+class SchemaCodec(Codec):
+    """Compact binary codec, using the fields of the mapper it is bound to as a schema.
+
+    Known fields are encoded by position (no field names are stored) after a presence bitmap, each value being a
+    type tag followed by a compact payload (varints for integers and lengths, utf-8 strings, isoformat dates ...).
+    Fields unknown to the schema (or all fields, if the codec is not bound) are stored with their names. Values of
+    other types are pickled.
+    """
+
+    def __init__(self, fields: Sequence[str] = ()):
+        self.fields = tuple(fields)
+        self._positions = {field: position for position, field in enumerate(self.fields)}
+        self._bitmap_size = (len(self.fields) + 7) // 8
+
+    def bind(self, mapper: "Mapper") -> "SchemaCodec":
+        return type(self)([k for k in mapper.fields if k not in (mapper.relations or ())])
+
+    def encode(self, row: Mapping[str, Any]) -> bytes:
+        bitmap, known, extras = 0, bytearray(), {}
+        values = [_MISSING] * len(self.fields)
+        for k, v in row.items():
+            if (position := self._positions.get(k)) is not None:
+                values[position] = v
+            else:
+                extras[k] = v
+
+        for position, value in enumerate(values):
+            if value is not _MISSING:
+                bitmap |= 1 << position
+                _encode_value(known, value)
+
+        buffer = bytearray(bitmap.to_bytes(self._bitmap_size, "little"))
+        buffer += known
+        _encode_varint(buffer, len(extras))
+        for k, v in extras.items():
+            _encode_str(buffer, k)
+            _encode_value(buffer, v)
+        return bytes(buffer)
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        bitmap, offset = int.from_bytes(data[: self._bitmap_size], "little"), self._bitmap_size
+        row = {}
+        for position, field in enumerate(self.fields):
+            if bitmap >> position & 1:
+                row[field], offset = _decode_value(data, offset)
+
+        extras, offset = _decode_varint(data, offset)
+        for _ in range(extras):
+            k, offset = _decode_str(data, offset)
+            row[k], offset = _decode_value(data, offset)
+        return row
+
+
+class CompressedCodec(Codec):
+    """Compresses the output of another codec, using zlib or lzma from the standard library."""
+
+    def __init__(self, codec: Codec, method: Literal["zlib", "lzma"] = "zlib", level: Optional[int] = None):
+        self.codec = codec
+        self.method = method
+        self.level = level
+
+    def bind(self, mapper: "Mapper") -> "CompressedCodec":
+        return type(self)(self.codec.bind(mapper), self.method, self.level)
+
+    def encode(self, row: Mapping[str, Any]) -> bytes:
+        data = self.codec.encode(row)
+        if self.method == "lzma":
+            return lzma.compress(data, preset=self.level)
+        return zlib.compress(data, -1 if self.level is None else self.level)
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        return self.codec.decode(lzma.decompress(data) if self.method == "lzma" else zlib.decompress(data))
+
+
+_MISSING = object()
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _BYTES, _DATETIME, _DATE, _LIST, _DICT, _PICKLE = range(12)
+_DOUBLE = struct.Struct("<d")
+
+
+def _encode_varint(buffer: bytearray, value: int):
+    while value > 0x7F:
+        buffer.append(value & 0x7F | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _decode_varint(data: bytes, offset: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _encode_str(buffer: bytearray, value: str):
+    value = value.encode()
+    _encode_varint(buffer, len(value))
+    buffer += value
+
+
+def _decode_str(data: bytes, offset: int) -> tuple[str, int]:
+    size, offset = _decode_varint(data, offset)
+    return data[offset : offset + size].decode(), offset + size
+
+
+def _encode_value(buffer: bytearray, value: Any):
+    # exact type checks, subclasses (enums, ...) must go through pickle to be restored as they were
+    kind = type(value)
+    if value is None:
+        buffer.append(_NONE)
+    elif kind is bool:
+        buffer.append(_TRUE if value else _FALSE)
+    elif kind is int:
+        buffer.append(_INT)
+        _encode_varint(buffer, value << 1 if value >= 0 else (-value << 1) - 1)  # zigzag
+    elif kind is float:
+        buffer.append(_FLOAT)
+        buffer += _DOUBLE.pack(value)
+    elif kind is str:
+        buffer.append(_STR)
+        _encode_str(buffer, value)
+    elif kind is bytes:
+        buffer.append(_BYTES)
+        _encode_varint(buffer, len(value))
+        buffer += value
+    elif kind is datetime:
+        buffer.append(_DATETIME)
+        _encode_str(buffer, value.isoformat())
+    elif kind is date:
+        buffer.append(_DATE)
+        _encode_str(buffer, value.isoformat())
+    elif kind is list:
+        buffer.append(_LIST)
+        _encode_varint(buffer, len(value))
+        for item in value:
+            _encode_value(buffer, item)
+    elif kind is dict and all(type(k) is str for k in value):
+        buffer.append(_DICT)
+        _encode_varint(buffer, len(value))
+        for k, v in value.items():
+            _encode_str(buffer, k)
+            _encode_value(buffer, v)
+    else:
+        buffer.append(_PICKLE)
+        value = pickle.dumps(value)
+        _encode_varint(buffer, len(value))
+        buffer += value
+
+
+def _decode_value(data: bytes, offset: int) -> tuple[Any, int]:
+    tag, offset = data[offset], offset + 1
+    if tag == _NONE:
+        return None, offset
+    if tag == _FALSE or tag == _TRUE:
+        return tag == _TRUE, offset
+    if tag == _INT:
+        value, offset = _decode_varint(data, offset)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, offset)[0], offset + _DOUBLE.size
+    if tag == _STR:
+        return _decode_str(data, offset)
+    if tag == _DATETIME:
+        value, offset = _decode_str(data, offset)
+        return datetime.fromisoformat(value), offset
+    if tag == _DATE:
+        value, offset = _decode_str(data, offset)
+        return date.fromisoformat(value), offset
+    if tag == _LIST:
+        size, offset = _decode_varint(data, offset)
+        items = []
+        for _ in range(size):
+            item, offset = _decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == _DICT:
+        size, offset = _decode_varint(data, offset)
+        items = {}
+        for _ in range(size):
+            k, offset = _decode_str(data, offset)
+            items[k], offset = _decode_value(data, offset)
+        return items, offset
+
+    size, offset = _decode_varint(data, offset)
+    if tag == _BYTES:
+        return bytes(data[offset : offset + size]), offset + size
+    return pickle.loads(data[offset : offset + size]), offset + size
@@ -1,79 +1,235 @@
 """Filesystem-based storage implementation.
 
 This module provides a storage backend that persists entities as files
-on the filesystem, with hierarchical directory structure for efficient access.
+on the filesystem, using one of the layouts from :mod:`anymodel.storages.layouts`.
 """
 
-import os.path
-import pickle
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from heapq import nsmallest
+from itertools import islice
 from os import PathLike
 from pathlib import Path
-from typing import Iterable, Optional
-
-from anymodel.storages import Storage
-from anymodel.types.mappings import ResultMapping
-
-
-def _get_relative_path_from_criteria(criteria: dict) -> Path:
-    if len(criteria) != 1 or "id" not in criteria:
-        raise ValueError(f"Only 'id' criteria is supported for this storage type, got {criteria}.")
-
-    if not criteria["id"]:
-        raise ValueError(f"Empty 'id' criteria is not supported for this storage type, got {criteria}.")
-
-    pk = str(criteria["id"])
-
-    if len(pk) <= 4:
-        return Path("__") / pk
-    if len(pk) <= 6:
-        return Path(pk[:2]) / "__" / pk[2:]
-    return Path(pk[:2]) / pk[2:4] / pk[4:]
+from typing import Any, Iterable, Mapping, Optional, Sequence
+
+from anymodel.mapper import Mapper
+from anymodel.storages import AsyncStorageAdapter, Storage
+from anymodel.storages.codecs import Codec, PickleCodec
+from anymodel.storages.layouts import Durability, Layout, SegmentLayout, TreeLayout
+from anymodel.types.mappings import ResultMapping, project
+from anymodel.types.queries import (
+    Criteria,
+    In,
+    Predicate,
+    Prefix,
+    Range,
+    matcher,
+    parse_order_by,
+    sort_key,
+    split_criteria,
+)
+from anymodel.utilities.indexes import SqliteIndex
+
+LAYOUTS = {
+    "tree": TreeLayout,
+    "segments": SegmentLayout,
+}
 
 
 class FileSystemStorage(Storage):
     """Storage backend that persists entities to the filesystem.
 
-    Stores entities as pickled files in a hierarchical directory structure
-    based on entity IDs for efficient access to large numbers of entities.
+    Stores entities as rows serialized by a pluggable codec (pickle by default,
+    see :mod:`anymodel.storages.codecs`) that can be chosen per table, laid out on
+    disk by a pluggable layout:
+
+    * ``"tree"`` (default) stores one file per row, in a hierarchical directory
+      structure based on entity IDs for efficient access to large numbers of
+      entities.
+    * ``"segments"`` appends rows to per-table segment files, compacted in the
+      background, for fewer files and syscalls and sequential table scans.
+
+    Unless disabled, a persistent index (a sqlite side-file at the root of the
+    storage) maps the values of the indexed fields of each table (the primary key,
+    and fields declared with ``Field(index=True)``) to the row keys, so that
+    ``find_many`` only reads the rows it may return.
+
+    Writes are atomic, and are flushed to stable storage before returning depending
+    on ``durability``: ``"none"`` (default, left to the operating system),
+    ``"fsync"`` (each write is synced) or ``"group"`` (each write is synced, sharing
+    the syncs with the concurrent writes of other threads). Layouts passed as
+    instances are configured on their own.
     """
 
-    def __init__(self, path: str | PathLike):
+    # threads reading the rows of ``find_by_identities`` in parallel
+    read_workers: int = 8
+
+    def __init__(
+        self,
+        path: str | PathLike,
+        *,
+        layout: str | Layout = "tree",
+        index: bool = True,
+        codec: Optional[Codec] = None,
+        codecs: Optional[Mapping[str, Codec]] = None,
+        durability: Durability = "none",
+    ):
         self.path = Path(path)
+        self.layout = LAYOUTS[layout](self.path, durability=durability) if isinstance(layout, str) else layout
+        self.index = None
+        self.codec = codec or PickleCodec()
+        self._indexed_fields = defaultdict(lambda: ("id",))
+        self._codecs = dict(codecs or {})
+
+        if index:
+            os.makedirs(self.path, exist_ok=True)
+            self.index = SqliteIndex(self.path / ".index.sqlite")
+
+    @property
+    def supports_queries(self) -> bool:
+        # without an index, the tree layout cannot tell the rows of a table apart
+        return self.index is not None or self.layout.per_table
+
+    def add_table(self, mapper: Mapper):
+        self._indexed_fields[mapper.__tablename__] = ("id", *(field for field in mapper.indexes if field != "id"))
+        self._codecs[mapper.__tablename__] = self._get_codec(mapper.__tablename__).bind(mapper)
+
+    def close(self):
+        self.layout.close()
+        if self.index is not None:
+            self.index.close()
 
     def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]:
-        filename = self.path / _get_relative_path_from_criteria(criteria)
-        if not os.path.exists(filename):
-            return None
-        with open(filename, "rb") as f:
-            return pickle.load(f)
-
-    def find_all(self):
-        for root, _, files in os.walk(self.path):
-            for file in files:
-                with open(os.path.join(root, file), "rb") as f:
-                    yield pickle.load(f)
+        if self.index is not None and not _is_key_lookup(criteria):
+            return next(iter(self.find_many(tablename, criteria, limit=1)), None)
+        return self._read(tablename, _get_key(criteria))
+
+    def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        """Rows of the given identities, read in parallel by up to ``read_workers`` threads (rows are files with the
+        tree layout, which are read concurrently best)."""
+        keys = [_get_key(identity) for identity in identities]
+        if len(keys) <= 1 or self.read_workers <= 1:
+            return [self._read(tablename, key) for key in keys]
+        with ThreadPoolExecutor(max_workers=min(self.read_workers, len(keys))) as executor:
+            return list(executor.map(partial(self._read, tablename), keys))
+
+    def find_all(self, tablename: Optional[str] = None):
+        """Iterate over all the rows of a table, or of all tables (the tree layout cannot tell tables apart)."""
+        codec = self._get_codec(tablename)
+        for data in self.layout.scan(tablename):
+            yield codec.decode(data)
 
     def find_many(
-        self, tablename: str, criteria: dict, *, limit: Optional[int] = None, offset: Optional[int] = None
+        self,
+        tablename: str,
+        criteria: Criteria,
+        *,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        order_by: Optional[str | Iterable[str]] = None,
+        fields: Optional[Sequence[str]] = None,
     ) -> Iterable[ResultMapping]:
-        raise NotImplementedError(f'{type(self).__name__} does not implement "find_many" method.')
+        limit, offset = max(limit, 0) if limit is not None else None, max(offset or 0, 0)
+        stop = offset + limit if limit is not None else None
+        order, indexed = parse_order_by(order_by), self._indexed_fields[tablename]
+
+        # only the conditions all rows must satisfy, and that the index understands, can be resolved using the index
+        index_criteria = {
+            k: v.as_range() if isinstance(v, Prefix) else v
+            for k, v in split_criteria(criteria)[0].items()
+            if k in indexed and (isinstance(v, (Range, In, Prefix)) or not isinstance(v, Predicate))
+        }
+        index_order = order[0] if len(order) == 1 and order[0][0] in indexed else None
+
+        if self.layout.per_table and (self.index is None or not (index_criteria or index_order)):
+            # no index, or nothing to gain from it: a sequential scan of the table is cheaper
+            rows = self.find_all(tablename)
+        elif self.index is not None:
+            # resolve indexed criteria (and order, if possible) to keys, and only read the rows for those keys
+            keys = self.index.keys(tablename, "id", index_criteria, order=index_order)
+            rows = (row for row in (self._read(tablename, key) for key in keys) if row is not None)
+        else:
+            raise NotImplementedError(f'{type(self).__name__} cannot implement "find_many" without an index.')
+
+        # the index may give false positives (for values sqlite cannot store natively), hence the complete check
+        if criteria:
+            rows = filter(matcher(criteria), rows)
+
+        if order and (index_order is None or self.index is None):
+            rows = nsmallest(stop, rows, key=sort_key(order)) if stop is not None else sorted(rows, key=sort_key(order))
+
+        # rows are decoded whole, projecting them still spares the memory of the fields left out
+        rows = islice(rows, offset, stop)
+        yield from (project(row, fields) for row in rows) if fields is not None else rows
 
     def insert(self, tablename: str, values: dict) -> ResultMapping:
-        identity = {"id": values["id"]}
-        filename = self.path / _get_relative_path_from_criteria(identity)
-        dirname = os.path.dirname(filename)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        with open(filename, "wb+") as f:
-            pickle.dump(values, f)
-        return identity
+        return self.insert_many(tablename, (values,))[0]
+
+    def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        rows = list(rows)
+        self._write_many(tablename, rows)
+        return [{"id": values["id"]} for values in rows]
 
     def update(self, tablename: str, criteria: dict, values: dict) -> None:
-        pass
+        if (row := self.find_one(tablename, criteria)) is None:
+            raise ValueError("Row not found, cannot update.")
+        self._write_many(tablename, [{**row, **values}])
+
+    def update_many(self, tablename: str, rows: Iterable[tuple[dict, dict]]) -> None:
+        """Update many rows, written as one batch (one segment append, one index transaction)."""
+        updated = []
+        for criteria, values in rows:
+            if (row := self.find_one(tablename, criteria)) is None:
+                raise ValueError("Row not found, cannot update.")
+            updated.append({**row, **values})
+        self._write_many(tablename, updated)
 
     def delete(self, tablename: str, identity: dict) -> None:
-        filename = self.path / _get_relative_path_from_criteria(identity)
-        if os.path.exists(filename):
-            os.remove(filename)
-        else:
-            raise FileNotFoundError(f"File {filename} not found.")
+        key = _get_key(identity)
+        self.layout.delete(tablename, key)
+        if self.index is not None:
+            self.index.remove(tablename, key)
+
+    def _read(self, tablename: str, key: str) -> Optional[ResultMapping]:
+        if (data := self.layout.read(tablename, key)) is None:
+            return None
+        return self._get_codec(tablename).decode(data)
+
+    def _write_many(self, tablename: str, rows: list[dict]):
+        rows = [(_get_key({"id": values["id"]}), values) for values in rows]
+        codec = self._get_codec(tablename)
+        self.layout.write_many(tablename, [(key, codec.encode(values)) for key, values in rows])
+        if self.index is not None:
+            self.index.add_many(tablename, rows, self._indexed_fields[tablename])
+
+    def _get_codec(self, tablename: Optional[str]) -> Codec:
+        return self._codecs.get(tablename, self.codec)
+
+
+class AsyncFileSystemStorage(AsyncStorageAdapter):
+    """Async interface over a :class:`FileSystemStorage` (created with the given arguments), for async mappers.
+    Operations run in worker threads."""
+
+    def __init__(self, path: str | PathLike, *, chunk_size: int = 100, **kwargs):
+        super().__init__(FileSystemStorage(path, **kwargs), chunk_size=chunk_size)
+
+    async def close(self):
+        await self._run(self.storage.close)
+
+
+def _is_key_lookup(criteria: Criteria) -> bool:
+    return isinstance(criteria, Mapping) and set(criteria) == {"id"} and not isinstance(criteria["id"], Predicate)
+
+
+def _get_key(criteria: dict) -> str:
+    if len(criteria) != 1 or "id" not in criteria:
+        raise ValueError(f"Only 'id' criteria is supported for this storage type, got {criteria}.")
+
+    if not criteria["id"]:
+        raise ValueError(f"Empty 'id' criteria is not supported for this storage type, got {criteria}.")
+
+    return str(criteria["id"])
@@ -0,0 +1,483 @@
+"""On-disk layouts for the filesystem storage.
+
+This module provides the layouts used by FileSystemStorage to store serialized
+rows, addressed by table and key: a directory tree with one file per row, and
+per-table append-only segment files with background compaction. Both support
+the same durability modes (see :class:`Layout`).
+"""
+
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from collections import defaultdict
+from contextlib import suppress
+from functools import partial
+from os import PathLike
+from pathlib import Path
+from typing import Callable, Hashable, Iterable, Iterator, Literal, Mapping, NamedTuple, Optional
+
+Durability = Literal["none", "fsync", "group"]
+
+
+def _get_relative_path(pk: str) -> Path:
+    if len(pk) <= 4:
+        return Path("__") / pk
+    if len(pk) <= 6:
+        return Path(pk[:2]) / "__" / pk[2:]
+    return Path(pk[:2]) / pk[2:4] / pk[4:]
+
+
+class GroupCommit:
+    """Runs sync actions (fsync calls, mostly) on behalf of many threads, batching the requests that arrive close
+    together.
+
+    A thread requesting a sync when none is running becomes the leader: it waits for ``delay`` seconds (if any) for
+    other requests to join, then runs the actions of the whole batch, deduplicated by key, while requests arriving in
+    the meantime gather into the next batch. Each requester returns once the batch holding its actions completed, and
+    gets the first error raised by any of them.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self._condition = threading.Condition()
+        self._collecting = _Batch()
+        self._syncing = False
+
+    def sync(self, actions: Mapping[Hashable, Callable[[], None]]):
+        with self._condition:
+            batch = self._collecting
+            for key, action in actions.items():
+                batch.actions.setdefault(key, action)
+
+            while not batch.done:
+                if self._syncing:
+                    self._condition.wait()
+                    continue
+
+                self._syncing = True
+                if self.delay:
+                    self._condition.wait(self.delay)
+                self._collecting = _Batch()
+                self._condition.release()
+                try:
+                    batch.error = _run(batch.actions.values())
+                finally:
+                    self._condition.acquire()
+                    batch.done, self._syncing = True, False
+                    self._condition.notify_all()
+
+        if batch.error is not None:
+            raise batch.error
+
+
+class _Batch:
+    __slots__ = ("actions", "done", "error")
+
+    def __init__(self):
+        self.actions = {}
+        self.done = False
+        self.error = None
+
+
+def _run(actions: Iterable[Callable[[], None]]) -> Optional[BaseException]:
+    """Run all actions, even if some of them fail, returning the first error."""
+    error = None
+    for action in actions:
+        try:
+            action()
+        except Exception as exc:
+            error = error or exc
+    return error
+
+
+class Layout:
+    """Base class for on-disk layouts, storing opaque serialized rows addressed by table and key.
+
+    Layouts storing tables apart from each other set ``per_table`` so that the storage can scan a table without
+    listing its keys first.
+
+    Writes are atomic (a crash never leaves a partially written row behind), and ``durability`` tells when they are
+    flushed to stable storage before returning:
+
+    * ``"none"`` (default) leaves it to the operating system, a crash may lose the last writes.
+    * ``"fsync"`` syncs each write.
+    * ``"group"`` syncs each write too, but writes from concurrent threads share the syncs (see :class:`GroupCommit`,
+      ``commit_delay`` being how long a sync waits for other writes to join it).
+    """
+
+    per_table: bool = False
+
+    def __init__(self, path: str | PathLike, *, durability: Durability = "none", commit_delay: float = 0.0):
+        if durability not in ("none", "fsync", "group"):
+            raise ValueError(f"Unknown durability mode {durability!r}.")
+        self.path = Path(path)
+        self.durability = durability
+        self._group_commit = GroupCommit(commit_delay) if durability == "group" else None
+
+    def read(self, tablename: str, key: str) -> Optional[bytes]: ...
+    def write_many(self, tablename: str, items: Iterable[tuple[str, bytes]]) -> None: ...
+    def delete(self, tablename: str, key: str) -> None: ...
+    def scan(self, tablename: Optional[str] = None) -> Iterator[bytes]: ...
+    def close(self): ...
+
+    def _sync(self, actions: Mapping[Hashable, Callable[[], None]]):
+        """Run sync actions, keyed by what they sync, as the durability mode says."""
+        if self.durability == "none" or not actions:
+            return
+        if self._group_commit is not None:
+            self._group_commit.sync(actions)
+        elif (error := _run(actions.values())) is not None:
+            raise error
+
+
+class TreeLayout(Layout):
+    """One file per row, in a hierarchical directory structure derived from the row key.
+
+    All tables share the same tree, so keys of different tables collide and ``scan`` yields the rows of all tables.
+    Rows are written to a hidden temporary file first, then renamed over the row file.
+    """
+
+    def read(self, tablename: str, key: str) -> Optional[bytes]:
+        filename = self.path / _get_relative_path(key)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def write_many(self, tablename: str, items: Iterable[tuple[str, bytes]]) -> None:
+        items = [(self.path / _get_relative_path(key), data) for key, data in items]
+
+        # create each directory once for the whole batch, instead of checking it for each file. the entries of created
+        # directories are in their parents, which must be synced as well.
+        dirnames = {filename.parent for filename, _ in items}
+        for dirname in list(dirnames):
+            if not dirname.exists():
+                os.makedirs(dirname, exist_ok=True)
+                dirnames.update(parent for parent in dirname.parents if self.path in parent.parents)
+                dirnames.add(self.path)
+
+        temporary = []
+        try:
+            for filename, data in items:
+                fd, tmp = tempfile.mkstemp(prefix=f".{filename.name}.", suffix=".tmp", dir=filename.parent)
+                temporary.append(tmp)
+                with open(fd, "wb") as f:
+                    f.write(data)
+
+            # content first, so that no rename can ever expose a file that is not completely written
+            self._sync({tmp: partial(_fsync_path, tmp) for tmp in temporary})
+            for tmp, (filename, _) in zip(temporary, items):
+                os.replace(tmp, filename)
+            temporary.clear()
+        finally:
+            # only left if something failed, some of them may have been renamed already
+            for tmp in temporary:
+                with suppress(FileNotFoundError):
+                    os.remove(tmp)
+
+        self._sync({dirname: partial(_fsync_directory, dirname) for dirname in dirnames})
+
+    def delete(self, tablename: str, key: str) -> None:
+        filename = self.path / _get_relative_path(key)
+        if os.path.exists(filename):
+            os.remove(filename)
+            self._sync({filename.parent: partial(_fsync_directory, filename.parent)})
+        else:
+            raise FileNotFoundError(f"File {filename} not found.")
+
+    def scan(self, tablename: Optional[str] = None) -> Iterator[bytes]:
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                # hidden files are not rows (the index side-file, for example)
+                if file.startswith("."):
+                    continue
+                with open(os.path.join(root, file), "rb") as f:
+                    yield f.read()
+
+
+# crc32 (of everything after it), flags, key length, value length
+_HEADER = struct.Struct("<IBHI")
+_PUT, _DELETE = 0, 1
+
+
+class _Location(NamedTuple):
+    segment: int
+    offset: int  # offset of the record header
+    size: int  # size of the whole record
+    value_size: int
+
+
+class SegmentLayout(Layout):
+    """Per-table append-only segment files.
+
+    Each write (insert, update or delete) appends a record to the active segment of the table, which is sealed and
+    replaced by a new one once it grows over ``max_segment_size``. An in-memory directory maps each live key to the
+    location of its last record; it is rebuilt by replaying the segments when the layout is opened (a torn record at
+    the end of a segment, from an interrupted write, is truncated).
+
+    Records made obsolete by later writes are garbage. When the garbage ratio of sealed segments goes over
+    ``compaction_threshold``, a background thread compacts them by copying their live records to the active segment
+    and removing them. Reading a row is one ``pread`` on an already opened file, and scanning a table reads its
+    segments sequentially. Syncing writes is one ``fsync`` of the active segment of each table written to.
+    """
+
+    per_table = True
+
+    def __init__(
+        self,
+        path: str | PathLike,
+        *,
+        max_segment_size: int = 16 * 1024 * 1024,
+        compaction_threshold: Optional[float] = 0.5,
+        durability: Durability = "none",
+        commit_delay: float = 0.0,
+    ):
+        super().__init__(path, durability=durability, commit_delay=commit_delay)
+        self.max_segment_size = max_segment_size
+        self.compaction_threshold = compaction_threshold
+
+        self._lock = threading.RLock()
+        self._compaction = None
+
+        self._directory: dict[str, dict[str, _Location]] = defaultdict(dict)
+        self._segments: dict[str, list[int]] = defaultdict(list)
+        self._sizes: dict[tuple[str, int], int] = defaultdict(int)
+        self._garbage: dict[tuple[str, int], int] = defaultdict(int)
+        self._files: dict[tuple[str, int], int] = {}
+
+        if self.path.exists():
+            for entry in sorted(os.scandir(self.path), key=lambda entry: entry.name):
+                if entry.is_dir() and not entry.name.startswith("."):
+                    self._load(entry.name)
+
+    def read(self, tablename: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            if (location := self._directory[tablename].get(key)) is None:
+                return None
+            return self._read_value(tablename, location)
+
+    def write_many(self, tablename: str, items: Iterable[tuple[str, bytes]]) -> None:
+        self._sync(self._append(tablename, [(_PUT, key, data) for key, data in items]))
+        self._maybe_compact_in_background()
+
+    def delete(self, tablename: str, key: str) -> None:
+        with self._lock:
+            if key not in self._directory[tablename]:
+                raise FileNotFoundError(f"Row {key!r} not found in {tablename!r} segments.")
+            actions = self._append(tablename, [(_DELETE, key, b"")])
+        # outside of the lock, which the sync actions of a group commit leader (maybe another thread) need
+        self._sync(actions)
+        self._maybe_compact_in_background()
+
+    def scan(self, tablename: Optional[str] = None) -> Iterator[bytes]:
+        """Live rows of the table (or of all tables), read segment by segment with one read per segment, in write order
+        within a segment. Rows written while scanning may or may not be part of the result."""
+        with self._lock:
+            tablenames = [tablename] if tablename is not None else list(self._directory)
+
+        for _tablename in tablenames:
+            live = defaultdict(list)
+            with self._lock:
+                for key, location in self._directory[_tablename].items():
+                    live[location.segment].append((key, location))
+
+            for segment in sorted(live):
+                entries = sorted(live[segment], key=lambda entry: entry[1].offset)
+                with self._lock:
+                    if segment in self._segments[_tablename]:
+                        start, end = entries[0][1].offset, entries[-1][1].offset + entries[-1][1].size
+                        buffer = _pread(self._get_file(_tablename, segment), end - start, start)
+                        values = [buffer[_value_slice(location, start)] for _, location in entries]
+                    else:
+                        # compacted since listed, its live records moved to another segment
+                        values = [self.read(_tablename, key) for key, _ in entries]
+                yield from (value for value in values if value is not None)
+
+    def compact(self, tablename: Optional[str] = None):
+        """Compact the sealed segments of the table (or of all tables) holding garbage, oldest first."""
+        with self._lock:
+            for _tablename in [tablename] if tablename is not None else list(self._segments):
+                for segment in self._segments[_tablename][:-1]:
+                    if self._garbage[_tablename, segment]:
+                        self._compact_segment(_tablename, segment)
+
+    def close(self):
+        if self._compaction is not None:
+            self._compaction.join()
+        with self._lock:
+            for fd in self._files.values():
+                os.close(fd)
+            self._files.clear()
+
+    def _append(self, tablename: str, records: list[tuple[int, str, bytes]]) -> dict[Hashable, Callable[[], None]]:
+        """Append records to the active segment of a table, returning the actions syncing them."""
+        with self._lock:
+            segment = self._get_active_segment(tablename)
+            offset, buffer, locations = self._sizes[tablename, segment], bytearray(), []
+            actions = {(tablename, segment): partial(self._sync_segment, tablename, segment)}
+            if not offset:
+                # new segment file, its directory entry must be synced too (and the table directory's, if new as well)
+                actions.update({path: partial(_fsync_directory, path) for path in (self.path, self.path / tablename)})
+            for flags, key, data in records:
+                record = _encode_record(flags, key, data)
+                locations.append((flags, key, _Location(segment, offset + len(buffer), len(record), len(data))))
+                buffer += record
+
+            os.write(self._get_file(tablename, segment), buffer)
+            self._sizes[tablename, segment] += len(buffer)
+
+            for flags, key, location in locations:
+                self._set_location(tablename, key, location if flags == _PUT else None)
+                if flags == _DELETE:
+                    self._garbage[tablename, segment] += location.size
+
+        return actions
+
+    def _sync_segment(self, tablename: str, segment: int):
+        with self._lock:
+            if (fd := self._files.get((tablename, segment))) is None:
+                # compacted (after syncing its live records elsewhere) or closed
+                return
+            # the segment may be closed by a compaction while syncing, keep our own descriptor
+            fd = os.dup(fd)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _set_location(self, tablename: str, key: str, location: Optional[_Location]):
+        """Point the directory to a key's new record (or remove it), accounting the previous record as garbage."""
+        directory = self._directory[tablename]
+        if (previous := directory.pop(key, None)) is not None:
+            self._garbage[tablename, previous.segment] += previous.size
+        if location is not None:
+            directory[key] = location
+
+    def _get_active_segment(self, tablename: str) -> int:
+        segments = self._segments[tablename]
+        if not segments or self._sizes[tablename, segments[-1]] >= self.max_segment_size:
+            os.makedirs(self.path / tablename, exist_ok=True)
+            segments.append(segments[-1] + 1 if segments else 1)
+        return segments[-1]
+
+    def _get_file(self, tablename: str, segment: int) -> int:
+        if (fd := self._files.get((tablename, segment))) is None:
+            filename = self.path / tablename / f"{segment:08d}.log"
+            flags = os.O_RDWR | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+            fd = self._files[tablename, segment] = os.open(filename, flags, 0o644)
+        return fd
+
+    def _read_value(self, tablename: str, location: _Location) -> bytes:
+        value_offset = location.offset + location.size - location.value_size
+        return _pread(self._get_file(tablename, location.segment), location.value_size, value_offset)
+
+    def _load(self, tablename: str):
+        """Rebuild the directory of a table by replaying its segments in order."""
+        for filename in sorted((self.path / tablename).glob("*.log")):
+            segment = int(filename.stem)
+            self._segments[tablename].append(segment)
+            with open(filename, "rb") as f:
+                data = f.read()
+
+            offset = 0
+            for flags, key, value_size, size in _decode_records(data):
+                self._set_location(tablename, key, _Location(segment, offset, size, value_size))
+                if flags == _DELETE:
+                    self._set_location(tablename, key, None)
+                offset += size
+
+            if offset < len(data):
+                # torn record from an interrupted write, drop it so that the next appends are readable
+                os.truncate(filename, offset)
+            self._sizes[tablename, segment] = offset
+
+    def _compact_segment(self, tablename: str, segment: int):
+        """Copy the live records of a sealed segment to the active one, then remove it. Deletion records are copied as
+        well unless the segment is the oldest one, as they may shadow records of older segments."""
+        fd, oldest = self._get_file(tablename, segment), segment == self._segments[tablename][0]
+        directory, records = self._directory[tablename], []
+
+        data = _pread(fd, self._sizes[tablename, segment], 0)
+        offset = 0
+        for flags, key, value_size, size in _decode_records(data):
+            location = directory.get(key)
+            if flags == _PUT and location is not None and location.segment == segment and location.offset == offset:
+                records.append((_PUT, key, data[_value_slice(location)]))
+            elif flags == _DELETE and location is None and not oldest:
+                records.append((_DELETE, key, b""))
+            offset += size
+
+        if records:
+            actions = self._append(tablename, records)
+            # live records must be safe in the active segment before the compacted one goes away
+            if self.durability != "none" and (error := _run(actions.values())) is not None:
+                raise error
+
+        os.close(self._files.pop((tablename, segment)))
+        os.remove(self.path / tablename / f"{segment:08d}.log")
+        self._segments[tablename].remove(segment)
+        self._sizes.pop((tablename, segment), None)
+        self._garbage.pop((tablename, segment), None)
+
+    def _maybe_compact_in_background(self):
+        if self.compaction_threshold is None or (self._compaction is not None and self._compaction.is_alive()):
+            return
+
+        with self._lock:
+            sealed = [
+                (tablename, segment) for tablename, segments in self._segments.items() for segment in segments[:-1]
+            ]
+            size = sum(self._sizes[item] for item in sealed)
+            garbage = sum(self._garbage[item] for item in sealed)
+
+        if size and garbage / size >= self.compaction_threshold:
+            self._compaction = threading.Thread(target=self.compact, name="anymodel-compaction", daemon=True)
+            self._compaction.start()
+
+
+def _fsync_path(path: str | PathLike):
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_directory(path: str | PathLike):
+    # directories cannot be opened (nor synced) on windows, where renames are durable once they return
+    if os.name != "nt":
+        _fsync_path(path)
+
+
+def _value_slice(location: _Location, start: int = 0) -> slice:
+    """Slice of a record value, in a buffer starting at the given offset of its segment."""
+    end = location.offset - start + location.size
+    return slice(end - location.value_size, end)
+
+
+def _pread(fd: int, size: int, offset: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    # no pread on windows, callers hold the layout lock so moving the file position is safe.
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _encode_record(flags: int, key: str, data: bytes) -> bytes:
+    key = key.encode()
+    body = _HEADER.pack(0, flags, len(key), len(data))[4:] + key + data
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def _decode_records(data: bytes) -> Iterator[tuple[int, str, int, int]]:
+    """Decode records (flags, key, value size, record size) until the end of data or the first invalid record."""
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        crc, flags, key_size, value_size = _HEADER.unpack_from(data, offset)
+        size = _HEADER.size + key_size + value_size
+        if offset + size > len(data) or zlib.crc32(data[offset + 4 : offset + size]) != crc:
+            return
+        yield flags, data[offset + _HEADER.size : offset + _HEADER.size + key_size].decode(), value_size, size
+        offset += size
@@ -2,11 +2,29 @@
 
 from collections import defaultdict
 from functools import reduce
-from typing import Iterable, Optional
-
-from anymodel.storages import Storage
-from anymodel.types.entity import Entity
-from anymodel.types.mappings import ResultMapping
+from heapq import nsmallest
+from itertools import islice
+from typing import Any, Hashable, Iterable, Mapping, Optional, Sequence
+
+from anymodel.mapper import Mapper
+from anymodel.storages import AsyncStorageAdapter, Storage
+from anymodel.types.mappings import ResultMapping, project
+from anymodel.types.queries import (
+    Aggregates,
+    Criteria,
+    Expression,
+    In,
+    OrderBy,
+    Predicate,
+    Prefix,
+    Range,
+    aggregate_rows,
+    matcher,
+    parse_order_by,
+    sort_key,
+    split_criteria,
+)
+from anymodel.utilities.indexes import HashIndex, SortedIndex
 
 
 class MemoryStorage(Storage):
@@ -19,63 +37,216 @@ class MemoryStorage(Storage):
     def __init__(self):
         self._tables = defaultdict(dict)
         self._autoincrements = defaultdict(int)
+        self._indexes: dict[str, dict[str, HashIndex]] = defaultdict(dict)
+        self._sorted_indexes: dict[str, dict[str, SortedIndex]] = defaultdict(dict)
 
     def __len__(self):
         return reduce(lambda x, y: x + len(y), self._tables.values(), 0)
 
+    def add_table(self, mapper: Mapper):
+        self._indexes[mapper.__tablename__] = {
+            field: HashIndex(field, unique=unique) for field, unique in mapper.indexes.items()
+        }
+        self._sorted_indexes[mapper.__tablename__] = {field: SortedIndex(field) for field in mapper.indexes}
+
     def migrate(self, **kwargs):
         pass
 
-    def delete(self, entity: Entity) -> Entity:
-        pass
+    def delete(self, tablename: str, identity: dict) -> None:
+        if (row := self.find_one(tablename, identity)) is None:
+            raise ValueError("Row not found, cannot delete.")
+        _key = row["id"]
+        for index in self._get_indexes(tablename):
+            index.remove(_key, row)
+        del self._tables[tablename][_key]
 
     def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]:
         for row in self.find_many(tablename, criteria, limit=1):
             return row
 
+    def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        """Rows of the given identities, looked up directly in the table (no index, no matching)."""
+        table = self._tables[tablename]
+        return [table.get(identity["id"]) for identity in identities]
+
     def find_many(
-        self, tablename: str, criteria: dict, *, limit: Optional[int] = None, offset: Optional[int] = None
+        self,
+        tablename: str,
+        criteria: Criteria,
+        *,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        order_by: Optional[str | Iterable[str]] = None,
+        fields: Optional[Sequence[str]] = None,
     ) -> Iterable[ResultMapping]:
         limit, offset = max(limit, 0) if limit is not None else None, max(offset or 0, 0)
-        current = 0
+        stop = offset + limit if limit is not None else None
+
+        # slicing is implemented here to support limit=0, and stops the underlying scan as soon as possible
+        criteria, rest = split_criteria(criteria)
+        rows = islice(self._select(tablename, criteria, parse_order_by(order_by), stop, rest), offset, stop)
+        yield from (project(row, fields) for row in rows) if fields is not None else rows
+
+    def count(self, tablename: str, criteria: Criteria) -> int:
+        criteria, rest = split_criteria(criteria)
+        if not criteria and rest is None:
+            return len(self._tables[tablename])
+        hash_indexes = self._indexes[tablename]
+        if rest is None and all(
+            k in hash_indexes and (isinstance(v, In) or not isinstance(v, Predicate)) for k, v in criteria.items()
+        ):
+            # fully served by hash indexes, only the postings intersection size matters
+            postings = sorted((self._get_posting(hash_indexes[k], v) for k, v in criteria.items()), key=len)
+            smallest, others = postings[0], postings[1:]
+            return len(smallest) if not others else sum(all(k in p for p in others) for k in smallest)
+        return sum(1 for _ in self._select(tablename, criteria, (), None, rest))
+
+    def exists(self, tablename: str, criteria: Criteria) -> bool:
+        criteria, rest = split_criteria(criteria)
+        return any(True for _ in self._select(tablename, criteria, (), 1, rest))
+
+    def aggregate(
+        self, tablename: str, criteria: Criteria, *, group_by: Sequence[str] = (), aggregates: Aggregates
+    ) -> list[dict[str, Any]]:
+        criteria, rest = split_criteria(criteria)
+        if (
+            not criteria
+            and rest is None
+            and len(group_by) == 1
+            and group_by[0] in self._indexes[tablename]
+            and all(aggregate == ("count", None) for aggregate in aggregates.values())
+        ):
+            # counting the rows of each group of an indexed field only needs the index postings sizes
+            field = group_by[0]
+            counts = self._indexes[tablename][field].counts()
+            results = [{field: value, **dict.fromkeys(aggregates, count)} for value, count in counts.items()]
+            return sorted(results, key=sort_key([(field, False)]))
+        return aggregate_rows(self._select(tablename, criteria, (), None, rest), group_by, aggregates)
 
-        for row in self._tables[tablename].values():
-            # Stop if limit is reached, implemented here to support limit=0
-            if limit is not None and current >= limit:
-                break
+    def insert(self, tablename: str, values: dict) -> ResultMapping:
+        return self.insert_many(tablename, (values,))[0]
 
-            # Check if row matches criteria
-            for k, v in criteria.items():
-                if row.get(k) != v:
-                    break
+    def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        identities = []
 
-            # Yield row if all criteria are met
+        for values in rows:
+            if "id" not in values:
+                self._autoincrements[tablename] += 1
+                identity = {"id": self._autoincrements[tablename]}
             else:
-                # ... but not until offset is reached
-                if offset > 0:
-                    offset -= 1
-                    continue
+                identity = {"id": values["id"]}
 
-                yield row
-                current += 1
+            # rows are keyed by their native id, so that lookups by identity (typed, see Identity) need no conversion
+            _key = identity["id"]
+            self._write(tablename, _key, {**values, **identity})
+            identities.append(identity)
 
-    def insert(self, tablename: str, values: dict) -> ResultMapping:
-        if "id" not in values:
-            self._autoincrements[tablename] += 1
-            identity = {"id": self._autoincrements[tablename]}
-        else:
-            identity = {"id": values["id"]}
-
-        # XXX we cast as string here for performances reasons (dicts with string keyx are way faster than anything else)
-        # This may not be the best idea.
-        _key = str(identity["id"])
-        self._tables[tablename][_key] = {**values, **identity}
-
-        return identity
+        return identities
 
     def update(self, tablename: str, criteria: dict, values: dict) -> None:
         if (row := self.find_one(tablename, criteria)) is not None:
-            _key = str(row["id"])
-            self._tables[tablename][_key] = {**row, **values}
+            _key = row["id"]
+            self._write(tablename, _key, {**row, **values})
             return self._tables[tablename][_key]
         raise ValueError("Row not found, cannot update.")
+
+    def _select(
+        self, tablename: str, criteria: dict, order: OrderBy, top: Optional[int], rest: Optional[Expression] = None
+    ) -> Iterable[ResultMapping]:
+        """Rows matching the given criteria (and the ``rest`` expression, if any), in the given order. If ``top`` is
+        given, only the first ``top`` rows are guaranteed to be correctly ordered (and the result may be truncated
+        after them).
+
+        Rows of an ``id`` equality criteria are found directly in the table. Equality (and ``In``) criteria on hash
+        indexed fields are resolved by intersecting the matching index postings (smallest first, the postings of an
+        ``In`` being the union of its values postings). Otherwise, a sorted index is used to scan the rows in order
+        (stopping as soon as enough rows are found) or to resolve a range (or prefix) criteria. Ordering rows that were
+        not read from a sorted index uses a bounded heap when ``top`` is known, instead of sorting all the candidates.
+        Whatever cannot be resolved using indexes is checked using compiled (and cached) matchers."""
+        table = self._tables[tablename]
+        hash_indexes = self._indexes[tablename]
+        sorted_indexes = {k: index for k, index in self._sorted_indexes[tablename].items() if index.usable}
+
+        hashed = [
+            k for k, v in criteria.items() if k in hash_indexes and (isinstance(v, In) or not isinstance(v, Predicate))
+        ]
+        ranged = [
+            k
+            for k, v in criteria.items()
+            if k in sorted_indexes
+            and (isinstance(v, Range) or isinstance(v, Prefix) and sorted_indexes[k].accepts(v.prefix))
+        ]
+
+        if (_id := criteria.get("id")) is not None and isinstance(_id, Hashable) and not isinstance(_id, Predicate):
+            # rows are keyed by id, so primary key lookups need neither an index nor a scan
+            rows, served = [row] if (row := table.get(_id)) is not None else [], ["id"]
+        elif hashed:
+            postings = sorted((self._get_posting(hash_indexes[k], criteria[k]) for k in hashed), key=len)
+            smallest, others = postings[0], postings[1:]
+            rows, served = [table[_key] for _key in smallest if all(_key in posting for posting in others)], hashed
+        elif len(order) == 1 and (field := order[0][0]) in sorted_indexes:
+            predicate = _as_range(criteria[field]) if field in ranged else None
+            rows = (table[_key] for _key in sorted_indexes[field].keys(predicate, reverse=order[0][1]))
+            served = [field] if predicate is not None and not isinstance(criteria[field], Prefix) else []
+            return self._filter(rows, criteria, served, rest)
+        elif ranged:
+            field = ranged[0]
+            rows = [table[_key] for _key in sorted_indexes[field].keys(_as_range(criteria[field]))]
+            served = [] if isinstance(criteria[field], Prefix) else ranged[:1]
+        else:
+            rows, served = table.values(), []
+
+        rows = self._filter(rows, criteria, served, rest)
+        if not order:
+            return rows
+        if top is not None:
+            return nsmallest(top, rows, key=sort_key(order))
+        return sorted(rows, key=sort_key(order))
+
+    @staticmethod
+    def _filter(
+        rows: Iterable[ResultMapping], criteria: dict, served: list[str], rest: Optional[Expression]
+    ) -> Iterable[ResultMapping]:
+        if remaining := {k: v for k, v in criteria.items() if k not in served}:
+            rows = filter(matcher(remaining), rows)
+        if rest is not None:
+            rows = filter(matcher(rest), rows)
+        return rows
+
+    @staticmethod
+    def _get_posting(index: HashIndex, value) -> Mapping[Hashable, None]:
+        if isinstance(value, In):
+            posting = {}
+            for _value in value.values:
+                if _value is not None:
+                    posting.update(index.get(_value))
+            return posting
+        return index.get(value)
+
+    def _write(self, tablename: str, _key: Hashable, row: dict):
+        """Write a row, keeping the table indexes up to date. Constraints are checked before anything is changed."""
+        table, indexes = self._tables[tablename], self._get_indexes(tablename)
+        for index in indexes:
+            index.check(_key, row)
+        if (previous := table.get(_key)) is not None:
+            for index in indexes:
+                index.remove(_key, previous)
+        for index in indexes:
+            index.add(_key, row)
+        table[_key] = row
+
+    def _get_indexes(self, tablename: str) -> list[HashIndex | SortedIndex]:
+        return [*self._indexes[tablename].values(), *self._sorted_indexes[tablename].values()]
+
+
+def _as_range(predicate: Range | Prefix) -> Range:
+    return predicate.as_range() if isinstance(predicate, Prefix) else predicate
+
+
+class AsyncMemoryStorage(AsyncStorageAdapter):
+    """Async interface over a :class:`MemoryStorage`, for async mappers. Operations run inline, as they never block."""
+
+    def __init__(self, storage: Optional[MemoryStorage] = None):
+        super().__init__(storage if storage is not None else MemoryStorage(), threaded=False)
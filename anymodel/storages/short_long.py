@@ -4,10 +4,15 @@ This module provides a storage backend that combines two storage backends,
 typically for implementing hot/cold storage strategies.
 """
 
+from contextlib import contextmanager
+from functools import partial
+from heapq import merge
+from itertools import chain, islice
 from typing import Iterable, Optional
 
 from .. import Mapper
-from ..types.mappings import ResultMapping, ResultMappingView
+from ..types.mappings import ResultMapping, ResultMappingView, project
+from ..types.queries import parse_order_by, sort_key
 from .base import Storage
 
 
@@ -29,19 +34,75 @@ class ShortLongStorage(Storage):
         if (result := self.long_storage.find_one(tablename, criteria)) is not None:
             return ResultMappingView(result, store="long")
 
-    def find_many(self, tablename: str, criteria: dict, *, limit=None, offset=None) -> Iterable[ResultMapping]:
-        return self.short_storage.find_many(tablename, criteria, limit=limit, offset=offset)
+    def find_by_identities(self, tablename: str, identities: Iterable[dict]) -> list[Optional[ResultMapping]]:
+        """Rows of the given identities, looked up in the short storage, then (the missing ones) in the long one."""
+        identities = list(identities)
+        rows = [
+            ResultMappingView(row, store="short") if row is not None else None
+            for row in self.short_storage.find_by_identities(tablename, identities)
+        ]
+        if missing := [index for index, row in enumerate(rows) if row is None]:
+            found = self.long_storage.find_by_identities(tablename, [identities[index] for index in missing])
+            for index, row in zip(missing, found):
+                rows[index] = ResultMappingView(row, store="long") if row is not None else None
+        return rows
+
+    def find_many(
+        self, tablename: str, criteria: dict, *, limit=None, offset=None, order_by=None, fields=None
+    ) -> Iterable[ResultMapping]:
+        """Find rows in both storages, short storage rows first (or merged, if an order is given). Both storages are
+        asked for at most offset + limit rows, offset and limit being applied on the combined result. Long storages
+        unable to run queries (see ``supports_queries``) are left out, their rows still being found by ``find_one``
+        and ``find_by_identities``."""
+        limit, offset = max(limit, 0) if limit is not None else None, max(offset or 0, 0)
+        stop = offset + limit if limit is not None else None
+        order = parse_order_by(order_by)
+
+        # merging needs the order fields, projected out once merged
+        merged_fields = (*fields, *(k for k, _ in order if k not in fields)) if fields is not None else None
+        short_rows, long_rows = (
+            map(
+                partial(ResultMappingView, store=store),
+                storage.find_many(tablename, criteria, limit=stop, order_by=order_by, fields=merged_fields),
+            )
+            if getattr(storage, "supports_queries", True)
+            else ()
+            for storage, store in ((self.short_storage, "short"), (self.long_storage, "long"))
+        )
+
+        if order:
+            rows = merge(short_rows, long_rows, key=sort_key(order))
+        else:
+            rows = chain(short_rows, long_rows)
+
+        rows = islice(rows, offset, stop)
+        if merged_fields != fields:
+            rows = (ResultMappingView(project(row, fields), **row.__metadata__) for row in rows)
+        return rows
 
     def insert(self, tablename: str, values: dict) -> ResultMapping:
         return ResultMappingView(self.short_storage.insert(tablename, values), store="short")
 
+    def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        return [
+            ResultMappingView(identity, store="short") for identity in self.short_storage.insert_many(tablename, rows)
+        ]
+
     def update(self, tablename: str, identity: dict, values: dict) -> None:
         return self.short_storage.update(tablename, identity, values)
 
+    def update_many(self, tablename: str, rows: Iterable[tuple[dict, dict]]) -> None:
+        return self.short_storage.update_many(tablename, rows)
+
     def delete(self, tablename, identity: dict):
         # XXX should we delete from both ? how to chose which one to use ?
         return self.short_storage.delete(tablename, identity)
 
+    @contextmanager
+    def transaction(self):
+        with self.short_storage.transaction(), self.long_storage.transaction():
+            yield self
+
     def archive(self, tablename: str):
         for entity in self.short_storage.find_all():
             self.long_storage.insert(tablename, entity)
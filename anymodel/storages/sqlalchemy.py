@@ -1,51 +1,332 @@
 """SQLAlchemy-based storage implementation.
 
 This module provides a storage backend that persists entities to
-SQL databases using SQLAlchemy, with support for automatic migrations.
+SQL databases using SQLAlchemy, with support for automatic migrations, and its
+async counterpart built on SQLAlchemy's asyncio extension.
 """
 
-from typing import Any, Iterable, Optional, Union, override
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import partial
+from itertools import batched, groupby, islice
+from operator import itemgetter
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator, Mapping, Optional, Sequence, Union, override
 
-from sqlalchemy import URL, Column, MetaData, Table, create_engine
+from sqlalchemy import (
+    URL,
+    Column,
+    ColumnElement,
+    Connection,
+    MetaData,
+    Row,
+    Select,
+    Table,
+    Update,
+    and_,
+    bindparam,
+    create_engine,
+    false,
+    func,
+    literal,
+    not_,
+    or_,
+    select,
+    true,
+    tuple_,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
 from sqlmodel.main import get_sqlalchemy_type
 
 from anymodel import Mapper
-from anymodel.storages import Storage
-from anymodel.types.entity import Entity
-from anymodel.types.mappings import ResultMapping
-from anymodel.utilities.migrations import automigrate
+from anymodel.storages import AsyncStorage, Storage
+from anymodel.types.mappings import ResultMapping, project
+from anymodel.types.queries import (
+    AGGREGATE_FUNCTIONS,
+    Aggregates,
+    And,
+    Condition,
+    Criteria,
+    Expression,
+    In,
+    Like,
+    Not,
+    Or,
+    Predicate,
+    Prefix,
+    Range,
+    and_ as and_expression,
+    matcher,
+    parse_order_by,
+)
+from anymodel.utilities.migrations import automigrate, automigrate_connection
 
 
-class SqlAlchemyStorage(Storage):
+class _SqlAlchemyTables:
+    """Table definitions, query building and result fetching options, shared by the sync and async storages."""
+
+    metadata: MetaData
+    tables: dict[str, Table]
+
+    # rows fetched at a time when streaming results (default size, and current one or None if results are buffered)
+    chunk_size: int
+    _stream: ContextVar[Optional[int]]
+
+    # identities looked up by each ``IN`` query of ``find_by_identities`` (bound parameters are limited)
+    identities_batch_size: int = 500
+
+    @contextmanager
+    def streaming(self, chunk_size: Optional[int] = None) -> Iterator[None]:
+        """Stream the results of the queries run within the block (in the current thread or task) from a server-side
+        cursor, ``chunk_size`` rows at a time, so that iterating over a large result runs in constant memory. The
+        connection is held until the iteration ends.
+
+        Otherwise (unless the storage was created with ``stream_results=True``), results are buffered: all the rows
+        are fetched and the connection released before the first one is yielded."""
+        token = self._stream.set(chunk_size or self.chunk_size)
+        try:
+            yield
+        finally:
+            self._stream.reset(token)
+
+    def add_table(self, mapper: Mapper):
+        if mapper.__tablename__ in self.tables:
+            raise ValueError(f'Table for "{mapper.__tablename__}" already registered.')
+
+        columns = []
+
+        for field in mapper.primary_key:
+            field_info = mapper.__type__.model_fields[field]
+            columns.append(Column(field, get_sqlalchemy_type(field_info), primary_key=True))
+
+        for field in mapper.fields:
+            if field in mapper.primary_key:
+                continue
+            field_info = mapper.__type__.model_fields[field]
+            if field in mapper.indexes:
+                columns.append(Column(field, get_sqlalchemy_type(field_info), index=True, unique=mapper.indexes[field]))
+            else:
+                columns.append(Column(field, get_sqlalchemy_type(field_info)))
+
+        self.tables[mapper.__tablename__] = Table(mapper.__tablename__, self.metadata, *columns)
+
+    def _select(
+        self, tablename: str, criteria: Criteria, *, limit=None, offset=None, order_by=None, fields=None
+    ) -> Select:
+        """Query selecting the matching rows (only the given fields, if any), criteria must be compilable to SQL (see
+        ``_split_criteria``)."""
+        table = self.tables[tablename]
+        if fields is not None:
+            # a select needs columns, queries for no fields (to count rows ...) get the primary key
+            query = select(*([table.c[k] for k in fields] or list(table.primary_key.columns) or list(table.c)))
+        else:
+            query = table.select()
+        query = _order_by(query.where(*_as_criteria(table, criteria)), table.c, order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        if offset is not None:
+            query = query.offset(offset)
+        return query
+
+    def _select_identities(self, tablename: str, identities: Sequence[Mapping[str, Any]]) -> Iterator[Select]:
+        """Queries selecting the rows of the given identities, one ``IN`` query per batch of identities."""
+        table = self.tables[tablename]
+        keys = list(identities[0])
+        for batch in batched(identities, self.identities_batch_size):
+            if len(keys) == 1:
+                condition = table.c[keys[0]].in_([identity[keys[0]] for identity in batch])
+            else:
+                condition = tuple_(*(table.c[k] for k in keys)).in_(
+                    [tuple(identity[k] for k in keys) for identity in batch]
+                )
+            yield table.select().where(condition)
+
+    def _update_many(
+        self, tablename: str, rows: Iterable[tuple[Mapping[str, Any], Mapping[str, Any]]]
+    ) -> list[tuple[Update, list[dict]]]:
+        """Update statements for (identity, values) pairs, with one set of parameters per row: rows updating the same
+        columns share a statement, executed once for all of them (``executemany``)."""
+        table, groups = self.tables[tablename], {}
+        for identity, values in rows:
+            if values:
+                # bound parameters must not be named after the updated columns, nor clash with each other
+                parameters = {
+                    **{f"_pk_{k}": v for k, v in identity.items()},
+                    **{f"_v_{k}": v for k, v in values.items()},
+                }
+                groups.setdefault((tuple(identity), tuple(values)), []).append(parameters)
+        return [
+            (
+                table.update()
+                .where(*(table.c[k] == bindparam(f"_pk_{k}") for k in identity_fields))
+                .values({k: bindparam(f"_v_{k}") for k in value_fields}),
+                parameters,
+            )
+            for (identity_fields, value_fields), parameters in groups.items()
+        ]
+
+    def _select_count(self, tablename: str, criteria: Criteria) -> Select:
+        table = self.tables[tablename]
+        return select(func.count()).select_from(table).where(*_as_criteria(table, criteria))
+
+    def _select_exists(self, tablename: str, criteria: Criteria) -> Select:
+        table = self.tables[tablename]
+        return select(select(literal(1)).select_from(table).where(*_as_criteria(table, criteria)).exists())
+
+    def _select_aggregate(
+        self, tablename: str, criteria: Criteria, group_by: Sequence[str], aggregates: Aggregates
+    ) -> Select:
+        """Query computing the aggregates for each group of rows (``GROUP BY``), ordered by group, NULLs last."""
+        table = self.tables[tablename]
+        columns = [table.c[k] for k in group_by]
+        query = select(
+            *columns,
+            *(_as_aggregate(table, function, field).label(name) for name, (function, field) in aggregates.items()),
+        )
+        query = query.select_from(table).where(*_as_criteria(table, criteria))
+        if columns:
+            query = query.group_by(*columns).order_by(*(column.asc().nulls_last() for column in columns))
+        return query
+
+    def _select_joined(
+        self, tablename: str, criteria: Criteria, joins: Mapping[str, tuple[str, str]], *, fields=None, **kwargs
+    ) -> tuple[Select, Callable[[Iterable[Row]], Iterator[tuple[dict, dict[str, list[dict]]]]]]:
+        """Query selecting the matching rows (limited, offset and ordered in a subquery, so that limits apply to the
+        rows, not to the joined ones) left joined with each of the related tables, along with the function grouping
+        its result rows into (row, related rows) pairs."""
+        table = self.tables[tablename]
+        columns = None
+        if fields is not None:
+            # the subquery also needs the columns used to join and order the rows, left out of the result rows
+            columns, order = list(fields), [k for k, _ in parse_order_by(kwargs.get("order_by"))]
+            joined = [column.name for column in table.primary_key.columns] + (["id"] if "id" in table.c else [])
+            fields = list(dict.fromkeys([*columns, *joined, *order]))
+        parent = self._select(tablename, criteria, fields=fields, **kwargs).subquery("parent")
+        primary_key = [parent.c[column.name] for column in table.primary_key.columns]
+        if not primary_key:
+            raise ValueError(f'Cannot join the rows of "{tablename}", it has no primary key.')
+
+        query, related_order, related_columns = select(*parent.c), [], {}
+        for position, (name, (related_tablename, foreign_key)) in enumerate(joins.items()):
+            related_table = self.tables[related_tablename].alias(f"related_{position}")
+            labels = {column.name: f"related_{position}_{column.name}" for column in related_table.c}
+            related_primary_key = [labels[column.name] for column in self.tables[related_tablename].primary_key.columns]
+            related_columns[name] = (labels, related_primary_key or list(labels.values()))
+
+            query = query.outerjoin(related_table, related_table.c[foreign_key] == parent.c.id)
+            query = query.add_columns(*(related_table.c[column].label(label) for column, label in labels.items()))
+            related_order += [related_table.c[column.name] for column in self.tables[related_tablename].primary_key]
+
+        query = _order_by(query, parent.c, kwargs.get("order_by")).order_by(*primary_key, *related_order)
+        return query, partial(
+            _group_joined,
+            columns=columns if columns is not None else [column.name for column in parent.c],
+            primary_key=[column.name for column in primary_key],
+            related_columns=related_columns,
+        )
+
+
+class SqlAlchemyStorage(_SqlAlchemyTables, Storage):
     """Storage backend for SQL databases via SQLAlchemy.
 
     Provides persistence to any SQLAlchemy-supported database with
     automatic schema migration capabilities.
     """
 
-    def __init__(self, url: Union[str, URL], **kwargs: Any):
+    supports_joins = True
+
+    def __init__(self, url: Union[str, URL], *, stream_results: bool = False, chunk_size: int = 1000, **kwargs: Any):
         self.engine = create_engine(url, **kwargs)
         self.metadata = MetaData()
         self.tables = {}
+        self.chunk_size = chunk_size
+
+        # connection pinned by the current transaction block, if any (per thread / per asyncio task).
+        self._connection = ContextVar(f"{type(self).__name__}.connection.{id(self)}", default=None)
+        self._stream = ContextVar(
+            f"{type(self).__name__}.stream.{id(self)}", default=chunk_size if stream_results else None
+        )
+
+    @contextmanager
+    def transaction(self) -> Iterator[Connection]:
+        """Pin one connection for every operation run within the block, and commit once when leaving it (or rollback
+        if an exception is raised). Nested blocks use savepoints on the same connection."""
+        if (conn := self._connection.get()) is not None:
+            with conn.begin_nested():
+                yield conn
+            return
+
+        with self.engine.connect() as conn:
+            token = self._connection.set(conn)
+            try:
+                with conn.begin():
+                    yield conn
+            finally:
+                self._connection.reset(token)
 
     def insert(self, tablename: str, values: dict) -> ResultMapping:
         """Insert a new row into the table, returns the newly generated primary key."""
         table = self.tables[tablename]
 
-        with self.engine.connect() as conn:
+        with self._connect(commit=True) as conn:
             result = conn.execute(table.insert().values(values))
-            conn.commit()
 
         return result.inserted_primary_key._mapping
 
+    def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        """Insert many rows into the table in as few statements as possible, returns the newly generated primary keys
+        in the same order as the given rows."""
+        table = self.tables[tablename]
+        rows = list(rows)
+        identities = [None] * len(rows)
+
+        primary_key = tuple(table.primary_key.columns)
+        returning = primary_key and self.engine.dialect.insert_executemany_returning_sort_by_parameter_order
+
+        with self._connect(commit=True) as conn:
+            for indexes in _get_batches(rows):
+                if returning:
+                    query = table.insert().returning(*primary_key, sort_by_parameter_order=True)
+                    result = conn.execute(query, [rows[index] for index in indexes])
+                    for index, row in zip(indexes, result):
+                        identities[index] = row._mapping
+                else:
+                    # no reliable way to match the generated keys with their rows, one statement per row it is.
+                    for index in indexes:
+                        result = conn.execute(table.insert().values(rows[index]))
+                        identities[index] = result.inserted_primary_key._mapping
+
+        return identities
+
     def update(self, tablename: str, identity: dict, values: dict) -> None:
         """Updates an existing row in the table."""
         table = self.tables[tablename]
         criteria = _as_criteria(table, identity)
 
-        with self.engine.connect() as conn:
+        with self._connect(commit=True) as conn:
             conn.execute(table.update().where(*criteria).values(values))
-            conn.commit()
+
+    @override
+    def update_many(self, tablename: str, rows: Iterable[tuple[Mapping[str, Any], Mapping[str, Any]]]) -> None:
+        with self._connect(commit=True) as conn:
+            for statement, parameters in self._update_many(tablename, rows):
+                conn.execute(statement, parameters)
+
+    @override
+    def find_many_joined(
+        self,
+        tablename: str,
+        criteria: Criteria,
+        joins: Mapping[str, tuple[str, str]],
+        *,
+        limit=None,
+        offset=None,
+        **kwargs,
+    ) -> Iterable[tuple[ResultMapping, dict[str, list[ResultMapping]]]]:
+        criteria, rest = _split_criteria(criteria)
+        window = {"limit": limit, "offset": offset} if rest is None else {"fields": None}
+        query, group = self._select_joined(tablename, criteria, joins, **{**kwargs, **window})
+        rows = _filter(group(self._execute(query)), rest, limit=limit, offset=offset, key=itemgetter(0))
+        yield from _project_joined(rows, kwargs.get("fields")) if rest is not None else rows
 
     @override
     def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]:
@@ -53,7 +334,7 @@ class SqlAlchemyStorage(Storage):
         criteria = _as_criteria(table, criteria)
 
         query = table.select().where(*criteria)
-        with self.engine.connect() as conn:
+        with self._connect() as conn:
             result = conn.execute(query)
             row = result.fetchone()
             if row is None:
@@ -61,46 +342,83 @@ class SqlAlchemyStorage(Storage):
             return row._mapping
 
     @override
-    def find_many(self, tablename: str, criteria: dict, *, limit=None, offset=None) -> Iterable[ResultMapping]:
-        table = self.tables[tablename]
-        criteria = _as_criteria(table, criteria)
+    def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        if not (identities := list(identities)):
+            return []
+        with self._connect() as conn:
+            rows = [
+                row._mapping for query in self._select_identities(tablename, identities) for row in conn.execute(query)
+            ]
+        return _match_identities(identities, rows)
 
-        query = table.select().where(*criteria)
-        if limit is not None:
-            query = query.limit(limit)
-        if offset is not None:
-            query = query.offset(offset)
+    @override
+    def find_many(
+        self, tablename: str, criteria: Criteria, *, limit=None, offset=None, order_by=None, fields=None
+    ) -> Iterable[ResultMapping]:
+        criteria, rest = _split_criteria(criteria)
+        window = {"limit": limit, "offset": offset, "fields": fields} if rest is None else {}
+        query = self._select(tablename, criteria, order_by=order_by, **window)
 
-        with self.engine.connect() as conn:
-            result = conn.execute(query)
-            for row in result:
-                yield row._mapping
+        rows = _filter((row._mapping for row in self._execute(query)), rest, limit=limit, offset=offset)
+        yield from (project(row, fields) for row in rows) if rest is not None else rows
 
-    ### rework (or work) needed
+    @override
+    def count(self, tablename: str, criteria: Criteria) -> int:
+        if _split_criteria(criteria)[1] is not None:
+            return super().count(tablename, criteria)
+        with self._connect() as conn:
+            return conn.execute(self._select_count(tablename, criteria)).scalar_one()
 
     @override
-    def delete(self, entity: Entity) -> Entity:
-        ...
-        return entity
+    def exists(self, tablename: str, criteria: Criteria) -> bool:
+        if _split_criteria(criteria)[1] is not None:
+            return super().exists(tablename, criteria)
+        with self._connect() as conn:
+            return conn.execute(self._select_exists(tablename, criteria)).scalar_one()
 
     @override
-    def add_table(self, mapper: Mapper):
-        if mapper.__tablename__ in self.tables:
-            raise ValueError(f'Table for "{mapper.__tablename__}" already registered.')
+    def aggregate(
+        self, tablename: str, criteria: Criteria, *, group_by: Sequence[str] = (), aggregates: Aggregates
+    ) -> list[dict[str, Any]]:
+        if _split_criteria(criteria)[1] is not None:
+            return super().aggregate(tablename, criteria, group_by=group_by, aggregates=aggregates)
+        with self._connect() as conn:
+            rows = conn.execute(self._select_aggregate(tablename, criteria, group_by, aggregates)).fetchall()
+        return [dict(row._mapping) for row in rows]
 
-        columns = []
+    def _execute(self, query: Select) -> Iterator[Row]:
+        """Result rows of a query, streamed or buffered (see ``streaming``)."""
+        if (chunk_size := self._stream.get()) is not None:
+            with self._connect() as conn:
+                yield from conn.execute(query.execution_options(yield_per=chunk_size))
+            return
 
-        for field in mapper.primary_key:
-            field_info = mapper.__type__.model_fields[field]
-            columns.append(Column(field, get_sqlalchemy_type(field_info), primary_key=True))
+        with self._connect() as conn:
+            rows = conn.execute(query).fetchall()
+        yield from rows
 
-        for field in mapper.fields:
-            if field in mapper.primary_key:
-                continue
-            field_info = mapper.__type__.model_fields[field]
-            columns.append(Column(field, get_sqlalchemy_type(field_info)))
+    @contextmanager
+    def _connect(self, *, commit: bool = False) -> Iterator[Connection]:
+        """Use the connection pinned by the current transaction if there is one (the transaction will commit), or a
+        fresh connection from the pool otherwise."""
+        if (conn := self._connection.get()) is not None:
+            yield conn
+            return
 
-        self.tables[mapper.__tablename__] = Table(mapper.__tablename__, self.metadata, *columns)
+        with self.engine.connect() as conn:
+            yield conn
+            if commit:
+                conn.commit()
+
+    @override
+    def delete(self, tablename: str, identity: dict) -> None:
+        table = self.tables[tablename]
+        criteria = _as_criteria(table, identity)
+
+        with self._connect(commit=True) as conn:
+            conn.execute(table.delete().where(*criteria))
 
     @override
     def migrate(self, **kwargs):
@@ -112,5 +430,362 @@ class SqlAlchemyStorage(Storage):
             self.engine.echo = old_echo
 
 
-def _as_criteria(table: Table, criteria: dict[str, Any]) -> list:
-    return [getattr(table.c, col) == val for col, val in criteria.items()]
+class AsyncSqlAlchemyStorage(_SqlAlchemyTables, AsyncStorage):
+    """Async storage backend for SQL databases, via SQLAlchemy's asyncio extension (``create_async_engine``), for
+    async mappers. Needs an async driver (``postgresql+asyncpg://``, ``sqlite+aiosqlite://`` ...).
+
+    Same features as :class:`SqlAlchemyStorage`. ``find_many`` fetches all the rows of the query and releases the
+    connection before yielding the first one, so that breaking out of the iteration early never holds a connection.
+    """
+
+    supports_joins = True
+
+    def __init__(self, url: Union[str, URL], *, stream_results: bool = False, chunk_size: int = 1000, **kwargs: Any):
+        self.engine = create_async_engine(url, **kwargs)
+        self.metadata = MetaData()
+        self.tables = {}
+        self.chunk_size = chunk_size
+
+        # connection pinned by the current transaction block, if any (per asyncio task).
+        self._connection = ContextVar(f"{type(self).__name__}.connection.{id(self)}", default=None)
+        self._stream = ContextVar(
+            f"{type(self).__name__}.stream.{id(self)}", default=chunk_size if stream_results else None
+        )
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[AsyncConnection]:
+        """Pin one connection for every operation run within the block (in the current task), and commit once when
+        leaving it (or rollback if an exception is raised). Nested blocks use savepoints on the same connection."""
+        if (conn := self._connection.get()) is not None:
+            async with conn.begin_nested():
+                yield conn
+            return
+
+        async with self.engine.connect() as conn:
+            token = self._connection.set(conn)
+            try:
+                async with conn.begin():
+                    yield conn
+            finally:
+                self._connection.reset(token)
+
+    async def insert(self, tablename: str, values: dict) -> ResultMapping:
+        table = self.tables[tablename]
+
+        async with self._connect(commit=True) as conn:
+            result = await conn.execute(table.insert().values(values))
+
+        return result.inserted_primary_key._mapping
+
+    async def insert_many(self, tablename: str, rows: Iterable[dict]) -> list[ResultMapping]:
+        table = self.tables[tablename]
+        rows = list(rows)
+        identities = [None] * len(rows)
+
+        primary_key = tuple(table.primary_key.columns)
+        returning = primary_key and self.engine.dialect.insert_executemany_returning_sort_by_parameter_order
+
+        async with self._connect(commit=True) as conn:
+            for indexes in _get_batches(rows):
+                if returning:
+                    query = table.insert().returning(*primary_key, sort_by_parameter_order=True)
+                    result = await conn.execute(query, [rows[index] for index in indexes])
+                    for index, row in zip(indexes, result):
+                        identities[index] = row._mapping
+                else:
+                    for index in indexes:
+                        result = await conn.execute(table.insert().values(rows[index]))
+                        identities[index] = result.inserted_primary_key._mapping
+
+        return identities
+
+    async def update(self, tablename: str, identity: dict, values: dict) -> None:
+        table = self.tables[tablename]
+
+        async with self._connect(commit=True) as conn:
+            await conn.execute(table.update().where(*_as_criteria(table, identity)).values(values))
+
+    @override
+    async def update_many(self, tablename: str, rows: Iterable[tuple[Mapping[str, Any], Mapping[str, Any]]]) -> None:
+        async with self._connect(commit=True) as conn:
+            for statement, parameters in self._update_many(tablename, rows):
+                await conn.execute(statement, parameters)
+
+    @override
+    async def find_one(self, tablename: str, criteria: dict) -> Optional[ResultMapping]:
+        table = self.tables[tablename]
+
+        async with self._connect() as conn:
+            result = await conn.execute(table.select().where(*_as_criteria(table, criteria)))
+            row = result.fetchone()
+        return row._mapping if row is not None else None
+
+    @override
+    async def find_by_identities(
+        self, tablename: str, identities: Iterable[Mapping[str, Any]]
+    ) -> list[Optional[ResultMapping]]:
+        if not (identities := list(identities)):
+            return []
+        rows = []
+        async with self._connect() as conn:
+            for query in self._select_identities(tablename, identities):
+                rows += [row._mapping for row in await conn.execute(query)]
+        return _match_identities(identities, rows)
+
+    @override
+    async def find_many(
+        self, tablename: str, criteria: Criteria, *, limit=None, offset=None, order_by=None, fields=None
+    ) -> AsyncIterator[ResultMapping]:
+        criteria, rest = _split_criteria(criteria)
+        window = {"limit": limit, "offset": offset, "fields": fields} if rest is None else {}
+        query = self._select(tablename, criteria, order_by=order_by, **window)
+
+        async with aclosing(self._execute(query)) as rows:
+            async for row in _afilter(rows, rest, limit=limit, offset=offset):
+                yield project(row, fields) if rest is not None else row
+
+    @override
+    async def find_many_joined(
+        self,
+        tablename: str,
+        criteria: Criteria,
+        joins: Mapping[str, tuple[str, str]],
+        *,
+        limit=None,
+        offset=None,
+        **kwargs,
+    ) -> AsyncIterator[tuple[ResultMapping, dict[str, list[ResultMapping]]]]:
+        criteria, rest = _split_criteria(criteria)
+        window = {"limit": limit, "offset": offset} if rest is None else {"fields": None}
+        query, group = self._select_joined(tablename, criteria, joins, **{**kwargs, **window})
+
+        # joined results are always buffered, as rows are grouped synchronously
+        async with self._connect() as conn:
+            rows = (await conn.execute(query)).fetchall()
+
+        rows = _filter(group(rows), rest, limit=limit, offset=offset, key=itemgetter(0))
+        for item in _project_joined(rows, kwargs.get("fields")) if rest is not None else rows:
+            yield item
+
+    @override
+    async def count(self, tablename: str, criteria: Criteria) -> int:
+        if _split_criteria(criteria)[1] is not None:
+            return await super().count(tablename, criteria)
+        async with self._connect() as conn:
+            return (await conn.execute(self._select_count(tablename, criteria))).scalar_one()
+
+    @override
+    async def exists(self, tablename: str, criteria: Criteria) -> bool:
+        if _split_criteria(criteria)[1] is not None:
+            return await super().exists(tablename, criteria)
+        async with self._connect() as conn:
+            return (await conn.execute(self._select_exists(tablename, criteria))).scalar_one()
+
+    @override
+    async def aggregate(
+        self, tablename: str, criteria: Criteria, *, group_by: Sequence[str] = (), aggregates: Aggregates
+    ) -> list[dict[str, Any]]:
+        if _split_criteria(criteria)[1] is not None:
+            return await super().aggregate(tablename, criteria, group_by=group_by, aggregates=aggregates)
+        async with self._connect() as conn:
+            rows = (await conn.execute(self._select_aggregate(tablename, criteria, group_by, aggregates))).fetchall()
+        return [dict(row._mapping) for row in rows]
+
+    async def _execute(self, query: Select) -> AsyncIterator[ResultMapping]:
+        """Result rows of a query, streamed or buffered (see ``streaming``)."""
+        if (chunk_size := self._stream.get()) is not None:
+            async with self._connect() as conn:
+                result = await conn.stream(query.execution_options(yield_per=chunk_size))
+                async for row in result:
+                    yield row._mapping
+            return
+
+        async with self._connect() as conn:
+            rows = (await conn.execute(query)).fetchall()
+        for row in rows:
+            yield row._mapping
+
+    @override
+    async def delete(self, tablename: str, identity: dict) -> None:
+        table = self.tables[tablename]
+
+        async with self._connect(commit=True) as conn:
+            await conn.execute(table.delete().where(*_as_criteria(table, identity)))
+
+    @override
+    async def migrate(self, **kwargs):
+        sync_engine = self.engine.sync_engine
+        old_echo = sync_engine.echo
+        sync_engine.echo = kwargs.get("echo", old_echo)
+        try:
+            async with self.engine.connect() as conn:
+                await conn.run_sync(automigrate_connection, self.metadata)
+                await conn.commit()
+        finally:
+            sync_engine.echo = old_echo
+
+    @asynccontextmanager
+    async def _connect(self, *, commit: bool = False) -> AsyncIterator[AsyncConnection]:
+        if (conn := self._connection.get()) is not None:
+            yield conn
+            return
+
+        async with self.engine.connect() as conn:
+            yield conn
+            if commit:
+                await conn.commit()
+
+
+def _order_by(query: Select, columns, order_by) -> Select:
+    for field, descending in parse_order_by(order_by):
+        column = columns[field]
+        query = query.order_by((column.desc() if descending else column.asc()).nulls_last())
+    return query
+
+
+def _group_joined(
+    rows: Iterable[Row], *, columns: list[str], primary_key: list[str], related_columns: dict
+) -> Iterator[tuple[dict, dict[str, list[dict]]]]:
+    """Group the result rows of a joined query (ordered by primary key) into (row, {join name: related rows}) pairs.
+    Related rows are deduplicated by primary key, as joining more than one table multiplies them."""
+    current, current_key = None, None
+    for row in rows:
+        row, key = row._mapping, tuple(row._mapping[column] for column in primary_key)
+        if current is None or key != current_key:
+            if current is not None:
+                yield current[0], {name: list(related.values()) for name, related in current[1].items()}
+            current_key, current = (
+                key,
+                ({column: row[column] for column in columns}, {name: {} for name in related_columns}),
+            )
+
+        for name, (labels, related_primary_key) in related_columns.items():
+            related_key = tuple(row[label] for label in related_primary_key)
+            if all(value is None for value in related_key):
+                # no related row (left join)
+                continue
+            current[1][name].setdefault(related_key, {column: row[label] for column, label in labels.items()})
+
+    if current is not None:
+        yield current[0], {name: list(related.values()) for name, related in current[1].items()}
+
+
+def _match_identities(
+    identities: Sequence[Mapping[str, Any]], rows: Iterable[ResultMapping]
+) -> list[Optional[ResultMapping]]:
+    """Rows of the given identities, in the same order (None for the missing ones)."""
+    keys = list(identities[0])
+    rows = {tuple(row[k] for k in keys): row for row in rows}
+    return [rows.get(tuple(identity[k] for k in keys)) for identity in identities]
+
+
+def _get_batches(rows: list[dict]) -> list[list[int]]:
+    """Indexes of the given rows, grouped for executemany. It requires the same set of columns for each parameter set,
+    so consecutive rows providing the same columns are batched together (this keeps the insertion order as given)."""
+    return [[index for index, _ in group] for _, group in groupby(enumerate(rows), key=lambda item: item[1].keys())]
+
+
+def _split_criteria(criteria: Criteria) -> tuple[Criteria, Optional[Expression]]:
+    """Split criteria into the part that compiles to SQL, and the rest (conditions using predicates SQL knows nothing
+    about), to be checked in python on the selected rows."""
+    if not isinstance(criteria, Expression):
+        if all(_is_compilable(Condition(k, v)) for k, v in criteria.items()):
+            return criteria, None
+        criteria = and_expression(*(Condition(k, v) for k, v in criteria.items()))
+
+    compiled, rest = [], []
+    for item in criteria.items if isinstance(criteria, And) else (criteria,):
+        (compiled if _is_compilable(item) else rest).append(item)
+    return And(compiled), and_expression(*rest) if rest else None
+
+
+def _is_compilable(expression: Expression) -> bool:
+    if isinstance(expression, Condition):
+        return not isinstance(expression.value, Predicate) or isinstance(expression.value, (Range, In, Like, Prefix))
+    if isinstance(expression, (And, Or)):
+        return all(_is_compilable(item) for item in expression.items)
+    return isinstance(expression, Not) and _is_compilable(expression.item)
+
+
+def _filter(
+    rows: Iterable, rest: Optional[Expression], *, limit=None, offset=None, key: Optional[Callable] = None
+) -> Iterable:
+    """Check the criteria that could not be compiled to SQL on the selected rows, then apply the limit and offset
+    (which could not be applied by the database)."""
+    if rest is None:
+        return rows
+    matches, offset = matcher(rest), max(offset or 0, 0)
+    rows = (row for row in rows if matches(key(row) if key is not None else row))
+    return islice(rows, offset, offset + max(limit, 0) if limit is not None else None)
+
+
+async def _afilter(
+    rows: AsyncIterator[ResultMapping], rest: Optional[Expression], *, limit=None, offset=None
+) -> AsyncIterator[ResultMapping]:
+    """Async counterpart of ``_filter``."""
+    if rest is None:
+        async for row in rows:
+            yield row
+        return
+
+    matches, skip, remaining = matcher(rest), max(offset or 0, 0), max(limit, 0) if limit is not None else None
+    if remaining == 0:
+        return
+    async for row in rows:
+        if not matches(row):
+            continue
+        if skip:
+            skip -= 1
+            continue
+        yield row
+        if remaining is not None and (remaining := remaining - 1) == 0:
+            return
+
+
+def _project_joined(items: Iterable[tuple[dict, dict]], fields: Optional[Iterable[str]]) -> Iterator[tuple[dict, dict]]:
+    return ((project(row, fields), related) for row, related in items)
+
+
+def _as_aggregate(table: Table, function: str, field: Optional[str]) -> ColumnElement:
+    if function not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f'Unknown aggregate function "{function}".')
+    if field is None:
+        return func.count()
+    return getattr(func, function)(table.c[field])
+
+
+def _as_criteria(table: Table, criteria: Criteria) -> list[ColumnElement]:
+    if isinstance(criteria, Expression):
+        return [_as_expression(table, criteria)]
+    return [_as_condition(getattr(table.c, col), val) for col, val in criteria.items()]
+
+
+def _as_expression(table: Table, expression: Expression) -> ColumnElement:
+    if isinstance(expression, Condition):
+        return _as_condition(getattr(table.c, expression.field), expression.value)
+    if isinstance(expression, And):
+        return and_(*(_as_expression(table, item) for item in expression.items)) if expression.items else true()
+    if isinstance(expression, Or):
+        return or_(*(_as_expression(table, item) for item in expression.items)) if expression.items else false()
+    if isinstance(expression, Not):
+        return not_(_as_expression(table, expression.item))
+    raise TypeError(f"Unsupported query expression: {expression!r}.")
+
+
+def _as_condition(column: Column, value: Any):
+    if isinstance(value, Range):
+        conditions = []
+        if value.lower is not None:
+            conditions.append(column >= value.lower if value.lower_inclusive else column > value.lower)
+        if value.upper is not None:
+            conditions.append(column <= value.upper if value.upper_inclusive else column < value.upper)
+        return and_(*conditions) if conditions else column.is_not(None)
+    if isinstance(value, In):
+        return column.in_([v for v in value.values if v is not None])
+    if isinstance(value, Like):
+        return column.like(value.pattern)
+    if isinstance(value, Prefix):
+        return column.startswith(value.prefix, autoescape=True)
+    if value is None:
+        return column.is_(None)
+    return column == value
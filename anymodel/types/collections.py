@@ -1,21 +1,32 @@
 """Type-safe collections for entity relationships.
 
 This module provides the Collection class for managing groups of entities
-with support for lazy loading.
+with support for lazy loading (synchronous or asynchronous), and tracking of
+the entities added or removed, so that only the changes are saved. The
+PagedCollection class loads them page by page instead, for collections too
+large to be loaded at once.
 """
 
-from typing import Any, Sequence
+import inspect
+from collections.abc import MutableSequence
+from typing import Any, Callable, Iterable, Optional, Sequence
 
 from pydantic import GetCoreSchemaHandler
 from pydantic_core import core_schema
 
+from anymodel.types.mappings import Identity
 
-class Collection(Sequence):
+
+class Collection(MutableSequence):
     """A lazy-loadable collection of entities.
 
     Collections can be initialized with either a sequence of entities
     or a loader function that returns entities when called. This supports
     lazy loading of related entities.
+
+    Collections track the entities added to and removed from them (by identity, entities are not hashable) until
+    ``reset_changes`` is called, which mappers do once they saved the changes. Appending to a collection that is not
+    loaded yet does not load it.
     """
 
     def __init__(self, seq_or_loader):
@@ -25,11 +36,50 @@ class Collection(Sequence):
         else:
             self._loader = None
             self._wrapped = list(seq_or_loader)
+        self._added: dict[int, Any] = {}
+        self._removed: dict[int, Any] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return self._loader is None
+
+    @property
+    def added(self) -> list:
+        """Items added since the collection was created (or its changes reset), and not removed since."""
+        return list(self._added.values())
+
+    @property
+    def removed(self) -> list:
+        """Items removed since the collection was created (or its changes reset), and not added back since."""
+        return list(self._removed.values())
+
+    @property
+    def changed(self) -> bool:
+        return bool(self._added or self._removed)
+
+    def reset_changes(self):
+        self._added.clear()
+        self._removed.clear()
 
     def load(self):
         if self._loader:
-            self._wrapped = list(self._loader())
-            self._loader = None
+            result = self._loader()
+            if hasattr(result, "__aiter__") or inspect.isawaitable(result):
+                if inspect.iscoroutine(result):
+                    result.close()
+                raise RuntimeError("This collection loads asynchronously, use `await collection.aload()` first.")
+            self._set_loaded(result)
+
+    async def aload(self):
+        """Load the collection using a loader that may be asynchronous (returning an async iterable or an awaitable),
+        as the relations of entities found by an async mapper are. Returns the collection."""
+        if self._loader:
+            result = self._loader()
+            if hasattr(result, "__aiter__"):
+                self._set_loaded([item async for item in result])
+            else:
+                self._set_loaded(await result if inspect.isawaitable(result) else result)
+        return self
 
     def __getitem__(self, item):
         self.load()
@@ -39,6 +89,61 @@ class Collection(Sequence):
         self.load()
         return len(self._wrapped)
 
+    def __iter__(self):
+        self.load()
+        return iter(self._wrapped)
+
+    async def __aiter__(self):
+        await self.aload()
+        for item in self._wrapped:
+            yield item
+
+    def __setitem__(self, index, value):
+        self.load()
+        if isinstance(index, slice):
+            removed, added = self._wrapped[index], list(value)
+            self._wrapped[index] = added
+        else:
+            removed, added = [self._wrapped[index]], [value]
+            self._wrapped[index] = value
+        self._track(added, removed)
+
+    def __delitem__(self, index):
+        self.load()
+        removed = self._wrapped[index]
+        del self._wrapped[index]
+        self._track((), removed if isinstance(index, slice) else [removed])
+
+    def insert(self, index: int, value):
+        self.load()
+        self._wrapped.insert(index, value)
+        self._track([value], ())
+
+    def append(self, value):
+        # items appended to a collection that is not loaded are only tracked, until it is loaded
+        if not self._loader:
+            self._wrapped.append(value)
+        self._track([value], ())
+
+    def extend(self, values: Iterable):
+        for value in list(values):
+            self.append(value)
+
+    def _track(self, added: Iterable, removed: Iterable):
+        for item in removed:
+            if self._added.pop(id(item), None) is None:
+                self._removed[id(item)] = item
+        for item in added:
+            if self._removed.pop(id(item), None) is None:
+                self._added[id(item)] = item
+
+    def _set_loaded(self, items: Iterable):
+        self._wrapped = list(items)
+        self._loader = None
+        # items appended before loading, unless loaded (already stored in the collection)
+        loaded = {id(item) for item in self._wrapped}
+        self._wrapped.extend(item for item in self._added.values() if id(item) not in loaded)
+
     @classmethod
     def __get_pydantic_core_schema__(cls, source: type[Any], handler: GetCoreSchemaHandler) -> core_schema.CoreSchema:
         return core_schema.no_info_after_validator_function(
@@ -63,3 +168,138 @@ class Collection(Sequence):
         if self._loader:
             return "..."
         return repr(self._wrapped)
+
+
+class PagedCollection(Collection):
+    """A collection of entities loaded page by page, for collections too large to be loaded at once.
+
+    ``find(limit, offset=None, last=None)`` returns the entities of a page (``limit`` entities, after ``offset``
+    ones, or after the ``last`` entity of the previous page), and ``count()`` the number of entities (either may be
+    asynchronous). Iterating (or ``async for``) fetches one page of ``page_size`` entities at a time, without keeping
+    them, slices and indexes run one limited query (``collection[100:150]``), and ``len`` runs a count query, cached
+    until the collection is modified (or its changes saved). Slices and indexes only see stored entities, while
+    iterations and ``len`` take unsaved additions and removals into account. ``load`` (or ``aload``) still loads
+    every entity, the collection behaving as a plain one then.
+    """
+
+    def __init__(self, find: Callable[..., Any], count: Callable[[], Any], *, page_size: int = 100):
+        super().__init__(find)
+        self._count = count
+        self.page_size = page_size
+        self._counted: Optional[int] = None
+
+    def __getitem__(self, item):
+        if self.loaded:
+            return super().__getitem__(item)
+        if isinstance(item, slice):
+            if (item.start or 0) >= 0 and item.stop is not None and item.stop >= 0 and (item.step or 1) > 0:
+                # no need to count the entities
+                indexes = range(item.start or 0, item.stop, item.step or 1)
+            else:
+                # slices (and indexes) only see stored entities, so they are resolved against the stored count
+                indexes = range(*item.indices(self._get_stored_count()))
+            if not indexes:
+                return []
+            start = min(indexes)
+            page = self._fetch(max(indexes) - start + 1, start)
+            return [page[index - start] for index in indexes if index - start < len(page)]
+        index = item + self._get_stored_count() if item < 0 else item
+        if index < 0 or not (page := self._fetch(1, index)):
+            raise IndexError("Collection index out of range.")
+        return page[0]
+
+    def __len__(self):
+        if self.loaded:
+            return super().__len__()
+        return self._get_stored_count() + len(self._added) - len(self._removed)
+
+    def __iter__(self):
+        if self.loaded:
+            return super().__iter__()
+        return self._iter_pages()
+
+    async def __aiter__(self):
+        if self.loaded:
+            for item in self._wrapped:
+                yield item
+            return
+        last = None
+        while True:
+            result = self._loader(self.page_size, last=last)
+            if hasattr(result, "__aiter__"):
+                page = [item async for item in result]
+            else:
+                page = list(await result if inspect.isawaitable(result) else result)
+            for item in filter(self._get_filter(), page):
+                yield item
+            if len(page) < self.page_size:
+                break
+            last = page[-1]
+        for item in list(self._added.values()):
+            yield item
+
+    async def acount(self) -> int:
+        """Number of entities, using a count function that may be asynchronous (``len`` cannot)."""
+        if self.loaded:
+            return len(self._wrapped)
+        if self._counted is None:
+            result = self._count()
+            self._counted = await result if inspect.isawaitable(result) else result
+        return self._counted + len(self._added) - len(self._removed)
+
+    def __delitem__(self, index):
+        if self.loaded:
+            return super().__delitem__(index)
+        removed = self[index]
+        self._track((), removed if isinstance(index, slice) else [removed])
+
+    def remove(self, value):
+        if self.loaded:
+            return super().remove(value)
+        # membership is not checked, that would need to load the collection
+        self._track((), [value])
+
+    def reset_changes(self):
+        super().reset_changes()
+        self._counted = None
+
+    def _track(self, added: Iterable, removed: Iterable):
+        super()._track(added, removed)
+        self._counted = None
+
+    def _get_stored_count(self) -> int:
+        if self._counted is None:
+            self._counted = self._resolve(self._count())
+        return self._counted
+
+    def _iter_pages(self):
+        last = None
+        while True:
+            page = self._fetch(self.page_size, last=last)
+            yield from filter(self._get_filter(), page)
+            if len(page) < self.page_size:
+                break
+            last = page[-1]
+        yield from list(self._added.values())
+
+    def _get_filter(self) -> Callable[[Any], bool]:
+        """Predicate filtering out the fetched entities that were removed, or added (those are iterated last), by
+        identity as well, as the fetched instances may be other ones (if the mapper has no identity map)."""
+        tracked = [*self._added.values(), *self._removed.values()]
+        ids, identities = set(map(id, tracked)), set(map(_get_identity, tracked)) - {None}
+        return lambda item: id(item) not in ids and _get_identity(item) not in identities
+
+    def _fetch(self, limit: int, offset: Optional[int] = None, *, last=None) -> list:
+        return list(self._resolve(self._loader(limit, offset=offset, last=last)))
+
+    @staticmethod
+    def _resolve(result):
+        if hasattr(result, "__aiter__") or inspect.isawaitable(result):
+            if inspect.iscoroutine(result):
+                result.close()
+            raise RuntimeError("This collection loads asynchronously, use `async for` or `await collection.acount()`.")
+        return result
+
+
+def _get_identity(item) -> Optional[Identity]:
+    return state.identity if (state := getattr(item, "__state__", None)) is not None else None
@@ -1,13 +1,18 @@
 """Entity base class and state management.
 
-This module provides the Entity base class for domain objects and
-the MappingState class for tracking entity persistence state.
+This module provides the Entity base class for domain objects, the
+MappingState class for tracking entity persistence state, and the Hydrator
+class, building clean entities from storage rows.
 """
 
+from copy import copy
 from functools import cached_property
-from typing import Optional
+from typing import Any, Callable, Iterable, Mapping, Optional
 
 from pydantic import BaseModel
+from pydantic.fields import FieldInfo
+
+from anymodel.types.mappings import Identity
 
 _IDENTITY_ATTRIBUTE = "__identity__"
 
@@ -23,6 +28,10 @@ class MappingState:
         self._entity = entity
         self._identity = None
         self._store = None
+        self._deferred = frozenset()
+        self._loader = None
+        # stored values of the fields, as of the last load or save, to find which fields really changed
+        self._snapshot: Optional[dict[str, Any]] = None
 
     @property
     def transient(self):
@@ -32,7 +41,7 @@ class MappingState:
     @property
     def dirty(self):
         """is the entity modified since the last clean state (from storage or defaults)?"""
-        return bool(len(self._entity.__pydantic_fields_set__))
+        return bool(self.changes())
 
     @property
     def clean(self):
@@ -40,12 +49,13 @@ class MappingState:
         return not self.dirty
 
     @property
-    def identity(self):
+    def identity(self) -> Optional[Identity]:
         return self._identity
 
     @identity.setter
-    def identity(self, value: dict):
-        self._identity = value
+    def identity(self, value: Optional[Mapping]):
+        # identities are built once (with a precomputed hash) and kept, mappings given by storages are converted
+        self._identity = value if value is None or isinstance(value, Identity) else Identity(value)
 
         # XXX maybe not the right place, should the state really update the entity ???? And if so, should it mark it
         # as clean ?
@@ -59,11 +69,55 @@ class MappingState:
     def store(self, value: Optional[str]):
         self._store = value
 
+    @property
+    def deferred(self) -> set[str]:
+        """fields not loaded from the storage yet (see ``only`` and ``defer`` in :meth:`anymodel.mapper.Mapper.find`)"""
+        return {k for k in self._deferred if k not in self._entity.__dict__}
+
+    def defer(self, fields: Iterable[str], loader: Callable[[set[str]], Mapping]):
+        """Mark fields as not loaded, ``loader`` being called with the fields still missing to fetch their values."""
+        for k in fields:
+            self._entity.__dict__.pop(k, None)
+        self._deferred, self._loader = frozenset(fields), loader
+
+    def load_deferred(self, values: Optional[Mapping] = None):
+        """Load all the deferred fields still missing at once, using the loader unless their ``values`` are given.
+        Loaded values are not modifications, so the entity stays clean for them."""
+        if fields := self.deferred:
+            values = values if values is not None else self._loader(fields)
+            values = {k: values.get(k) for k in fields}
+            self._entity.__dict__.update(values)
+            self._snapshot = {**(self._snapshot or {}), **_snapshot(values)}
+        self._deferred, self._loader = frozenset(), None
+
+    def changes(self, fields: Optional[Iterable[str]] = None) -> dict[str, Any]:
+        """Values of the (given) fields changed since the entity was loaded or saved. Fields with a stored value are
+        compared to it (so that fields set back to their stored value are not changes, while containers modified in
+        place are), other fields are changed if they were set."""
+        values, fields_set, snapshot = self._entity.__dict__, self._entity.__pydantic_fields_set__, self._snapshot or {}
+        changes = {}
+        for k in fields if fields is not None else {*fields_set, *snapshot}:
+            if k not in values:  # deferred
+                continue
+            if k in snapshot:
+                if values[k] != snapshot[k]:
+                    changes[k] = values[k]
+            elif k in fields_set:
+                changes[k] = values[k]
+        return changes
+
     def detach(self):
         self._identity = None
 
-    def set_clean(self):
+    def set_clean(self, values: Optional[Mapping] = None):
+        """Mark the entity as not modified, ``values`` being the stored values of its fields, if known."""
         self._entity.__pydantic_fields_set__ = set()
+        self._snapshot = _snapshot(values) if values is not None else None
+
+    def set_stored(self, values: Mapping):
+        """Mark the given fields as not modified anymore, with the given (stored) values."""
+        self._entity.__pydantic_fields_set__ = self._entity.__pydantic_fields_set__.difference(values)
+        self._snapshot = {**(self._snapshot or {}), **_snapshot(values)}
 
     def __eq__(self, other):
         return set(other) == set(
@@ -77,6 +131,70 @@ class MappingState:
         )
 
 
+def _snapshot(values: Mapping) -> dict[str, Any]:
+    # containers are copied (one level deep), to notice their changes
+    return {k: copy(v) if isinstance(v, (list, dict, set)) else v for k, v in values.items()}
+
+
+class Hydrator:
+    """Builds clean entities of a type from storage rows, in one pass.
+
+    This is what ``model_construct(**row)`` followed by setting the mapping state does (no validation, stored values
+    being trusted), compiled once per mapper: the field order is computed beforehand, and the instance dict, the
+    (empty) fields set and the mapping state are built directly, the identity being kept as given instead of being
+    merged into the instance dict (rows always hold the primary key). Fields missing from a row get their default,
+    if any, and other keys of the row are ignored (unless the entity type allows extra fields).
+    """
+
+    def __init__(self, entity_type: type["Entity"], relations: Iterable[str] = ()):
+        self.entity_type = entity_type
+        relations = set(relations)
+        # (name, is a relation, field info) for each field, in declaration order (the order of the instance dict)
+        self._fields = tuple((k, k in relations, v) for k, v in entity_type.model_fields.items())
+        self._extra = entity_type.model_config.get("extra") == "allow"
+        self._post_init = bool(entity_type.__pydantic_post_init__)
+
+    def __call__(
+        self,
+        row: Mapping[str, Any],
+        identity: Identity,
+        relations: Optional[Mapping[str, Any]] = None,
+        *,
+        store: Optional[str] = None,
+    ) -> "Entity":
+        """Clean entity of a row, with the given identity, related collections (by relation name) and store."""
+        values, snapshot = {}, {}
+        for k, is_relation, field in self._fields:
+            if is_relation and relations and k in relations:
+                values[k] = relations[k]
+            elif not is_relation and k in row:
+                value = values[k] = row[k]
+                # containers are copied, as by _snapshot (their own copy method being the fastest way)
+                snapshot[k] = value.copy() if isinstance(value, (list, dict, set)) else value
+            elif not field.is_required():
+                values[k] = _get_default(field, values)
+
+        entity = self.entity_type.__new__(self.entity_type)
+        state = values["__state__"] = MappingState(entity)
+        state._identity, state._store, state._snapshot = identity, store, snapshot
+        object.__setattr__(entity, "__dict__", values)
+        object.__setattr__(entity, "__pydantic_fields_set__", set())
+        object.__setattr__(
+            entity, "__pydantic_extra__", {k: v for k, v in row.items() if k not in values} if self._extra else None
+        )
+        object.__setattr__(entity, "__pydantic_private__", None)
+        if self._post_init:
+            entity.model_post_init(None)
+        return entity
+
+
+def _get_default(field: FieldInfo, values: dict[str, Any]) -> Any:
+    # default factories may take the values of the previous fields (pydantic 2.10+, older versions do not know them)
+    if getattr(field, "default_factory_takes_data", False):
+        return field.get_default(call_default_factory=True, validated_data=values)
+    return field.get_default(call_default_factory=True)
+
+
 class Entity(BaseModel):
     """Base class for domain entities.
 
@@ -90,6 +208,14 @@ class Entity(BaseModel):
         """lazy initialized object to store the mapping state of the entity."""
         return MappingState(self)
 
+    def __getattr__(self, name: str):
+        # deferred fields are missing from the instance dict until loaded, which loads all of them at once
+        state = self.__dict__.get("__state__")
+        if state is not None and name in state._deferred and name not in self.__dict__:
+            state.load_deferred()
+            return self.__dict__[name]
+        return super().__getattr__(name)
+
     def __repr__(self):
         transient = "~" if self.__state__.transient else ""
         dirty = "*" if self.__state__.dirty else ""
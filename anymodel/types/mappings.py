@@ -1,14 +1,22 @@
 """Result mapping types for storage operations.
 
 This module provides types for handling results from storage operations,
-including metadata about the storage source.
+including metadata about the storage source, and the identities of stored
+rows.
 """
 
-from typing import Any, Iterable, Mapping
+from typing import Any, Iterable, Iterator, Mapping, Optional, Sequence
 
 ResultMapping = Mapping[str, Any]
 
 
+def project(row: ResultMapping, fields: Optional[Sequence[str]]) -> ResultMapping:
+    """The given fields of a row (those it has), or the row itself if ``fields`` is None."""
+    if fields is None:
+        return row
+    return {k: row[k] for k in fields if k in row}
+
+
 class ResultMappingView(ResultMapping):
     """A view over a result mapping with metadata support.
 
@@ -32,3 +40,60 @@ class ResultMappingView(ResultMapping):
 
     def __len__(self) -> int:
         return len(self.mapping)
+
+
+class Identity(Mapping[str, Any]):
+    """Identity of a stored row: the values of its primary key fields, with their native types (as stored).
+
+    Identities are immutable mappings (so that storages use them as criteria, like the dicts of primary key values
+    they replace), hashed once when built, so that they are cheap keys for identity maps and caches. Identities of
+    the same values are equal (and equal to the dicts of these values), whatever the instances.
+    """
+
+    __slots__ = ("_fields", "_hash", "_values")
+
+    def __init__(self, values: Mapping[str, Any]):
+        self._fields = tuple(values)
+        self._values = tuple(values.values())
+        self._hash = hash(self._values)
+
+    @classmethod
+    def of(cls, row: Mapping[str, Any], fields: tuple[str, ...]) -> "Identity":
+        """Identity of a row, made of the values of the given (primary key) fields."""
+        identity = cls.__new__(cls)
+        identity._fields = fields
+        identity._values = tuple(row[k] for k in fields)
+        identity._hash = hash(identity._values)
+        return identity
+
+    @property
+    def key(self) -> tuple:
+        """Values of the identity, in the order of the primary key fields."""
+        return self._values
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._values[self._fields.index(key)]
+        except ValueError:
+            raise KeyError(key) from None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Identity):
+            return self._hash == other._hash and self._values == other._values and self._fields == other._fields
+        return super().__eq__(other)
+
+    def __reduce__(self):
+        # hashes of strings differ between processes, so unpickled identities are hashed again
+        return Identity, (dict(self),)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self)!r})"
@@ -0,0 +1,564 @@
+"""Query types for storage lookups.
+
+This module provides predicates that can be used as criteria values (in place of
+plain values, which are compared for equality), query expressions combining
+conditions on fields with and/or/not, ordering and aggregation helpers, and the
+shared python implementation of all of them, used by storages that cannot do
+better natively.
+"""
+
+import re
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Literal, Mapping, Optional, Sequence, get_args
+
+from pydantic_core import from_json, to_json
+
+OrderBy = Sequence[tuple[str, bool]]
+
+AggregateFunction = Literal["count", "sum", "min", "max", "avg"]
+
+# aggregates, by output name: (function, field), the field being None to count rows
+Aggregates = Mapping[str, tuple[AggregateFunction, Optional[str]]]
+
+AGGREGATE_FUNCTIONS: tuple[AggregateFunction, ...] = get_args(AggregateFunction)
+
+
+class Predicate:
+    """Base class for criteria values that are not compared for equality, but tested by calling them with the row
+    value (never None, which never matches a predicate)."""
+
+    __slots__ = ()
+
+    def __call__(self, value) -> bool: ...
+
+
+class Range(Predicate):
+    """Matches values within a range, each bound being optional (open-ended range) and inclusive by default.
+
+    None values never match a range, like NULL values never match a comparison in SQL.
+    """
+
+    __slots__ = ("lower", "lower_inclusive", "upper", "upper_inclusive")
+
+    def __init__(self, lower=None, upper=None, *, lower_inclusive: bool = True, upper_inclusive: bool = True):
+        self.lower = lower
+        self.upper = upper
+        self.lower_inclusive = lower_inclusive
+        self.upper_inclusive = upper_inclusive
+
+    def __call__(self, value) -> bool:
+        if value is None:
+            return False
+        if self.lower is not None and (value < self.lower or (not self.lower_inclusive and value == self.lower)):
+            return False
+        return self.upper is None or not (value > self.upper or (not self.upper_inclusive and value == self.upper))
+
+    def __eq__(self, other):
+        if not isinstance(other, Range):
+            return NotImplemented
+        return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, attr) for attr in self.__slots__))
+
+    def __repr__(self):
+        lower = "(-inf" if self.lower is None else ("[" if self.lower_inclusive else "(") + repr(self.lower)
+        upper = "+inf)" if self.upper is None else repr(self.upper) + ("]" if self.upper_inclusive else ")")
+        return f"<{type(self).__name__} {lower}, {upper}>"
+
+
+class In(Predicate):
+    """Matches values equal to one of the given (hashable) values, like SQL's IN. None values never match."""
+
+    __slots__ = ("_set", "values")
+
+    def __init__(self, values: Iterable):
+        self.values = tuple(dict.fromkeys(values))
+        self._set = frozenset(self.values)
+
+    def __call__(self, value) -> bool:
+        return value is not None and value in self._set
+
+    def __eq__(self, other):
+        if not isinstance(other, In):
+            return NotImplemented
+        return self._set == other._set
+
+    def __hash__(self):
+        return hash(self._set)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {list(self.values)!r}>"
+
+
+def in_(values: Iterable) -> In:
+    """Matches values equal to one of the given ones."""
+    return In(values)
+
+
+def gt(value) -> Range:
+    """Matches values strictly greater than the given one."""
+    return Range(lower=value, lower_inclusive=False)
+
+
+def ge(value) -> Range:
+    """Matches values greater than or equal to the given one."""
+    return Range(lower=value)
+
+
+def lt(value) -> Range:
+    """Matches values strictly lower than the given one."""
+    return Range(upper=value, upper_inclusive=False)
+
+
+def le(value) -> Range:
+    """Matches values lower than or equal to the given one."""
+    return Range(upper=value)
+
+
+def between(lower, upper) -> Range:
+    """Matches values between the given bounds, both included (like SQL's BETWEEN)."""
+    return Range(lower, upper)
+
+
+class Like(Predicate):
+    """Matches strings against a SQL LIKE pattern, ``%`` standing for any sequence of characters and ``_`` for any
+    single character (there is no escape character). The python implementation is case-sensitive, SQL storages follow
+    their database (SQLite's LIKE ignores the case of ASCII characters). None values never match."""
+
+    __slots__ = ("_regex", "pattern")
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self._regex = re.compile(
+            "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern), re.DOTALL
+        )
+
+    def __call__(self, value) -> bool:
+        return isinstance(value, str) and self._regex.fullmatch(value) is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, Like):
+            return NotImplemented
+        return self.pattern == other.pattern
+
+    def __hash__(self):
+        return hash((Like, self.pattern))
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.pattern!r}>"
+
+
+class Prefix(Predicate):
+    """Matches strings starting with the given prefix (which has no wildcards). None values never match."""
+
+    __slots__ = ("prefix",)
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def __call__(self, value) -> bool:
+        return isinstance(value, str) and value.startswith(self.prefix)
+
+    def as_range(self) -> Range:
+        """Range of strings containing all the strings starting with the prefix, usable with sorted indexes."""
+        return Range(self.prefix, self.prefix + "\U0010ffff", upper_inclusive=False)
+
+    def __eq__(self, other):
+        if not isinstance(other, Prefix):
+            return NotImplemented
+        return self.prefix == other.prefix
+
+    def __hash__(self):
+        return hash((Prefix, self.prefix))
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.prefix!r}>"
+
+
+def like(pattern: str) -> Like:
+    """Matches strings following a SQL LIKE pattern."""
+    return Like(pattern)
+
+
+def startswith(prefix: str) -> Prefix:
+    """Matches strings starting with the given prefix."""
+    return Prefix(prefix)
+
+
+class Expression:
+    """Base class for query expressions, built from field references (see :func:`field`) and combined with ``&``
+    (and), ``|`` (or) and ``~`` (not).
+
+    Expressions follow SQL semantics for None values: a condition on a None value is unknown rather than false
+    (except for ``is_null``), ``not`` keeps it unknown, and only rows for which the whole expression is true match.
+    """
+
+    __slots__ = ()
+
+    def __and__(self, other: "Expression") -> "Expression":
+        return and_(self, other)
+
+    def __or__(self, other: "Expression") -> "Expression":
+        return or_(self, other)
+
+    def __invert__(self) -> "Expression":
+        return not_(self)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash((type(self), self._key()))
+
+    def _key(self) -> tuple: ...
+
+
+class Condition(Expression):
+    """Condition on the value of a field, either a plain value compared for equality (None meaning the value must be
+    None, like SQL's IS NULL) or a predicate. This is what each item of a criteria mapping stands for."""
+
+    __slots__ = ("field", "value")
+
+    def __init__(self, field: str, value: Any):
+        self.field = field
+        self.value = value
+
+    def _key(self) -> tuple:
+        return self.field, self.value
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.field}={self.value!r}>"
+
+
+class And(Expression):
+    """Matches rows matching all the given expressions (all rows, if there are none)."""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items: Iterable[Expression]):
+        self.items = tuple(items)
+
+    def _key(self) -> tuple:
+        return self.items
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {list(self.items)!r}>"
+
+
+class Or(Expression):
+    """Matches rows matching any of the given expressions (no rows, if there are none)."""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items: Iterable[Expression]):
+        self.items = tuple(items)
+
+    def _key(self) -> tuple:
+        return self.items
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {list(self.items)!r}>"
+
+
+class Not(Expression):
+    """Matches rows for which the given expression is false (but not unknown)."""
+
+    __slots__ = ("item",)
+
+    def __init__(self, item: Expression):
+        self.item = item
+
+    def _key(self) -> tuple:
+        return (self.item,)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.item!r}>"
+
+
+class FieldRef:
+    """Reference to a field, building conditions on its value with comparison operators and methods.
+
+    >>> (field("age") >= 18) & field("name").startswith("A") & (field("email") != None)
+
+    """
+
+    __slots__ = ("name",)
+    __hash__ = None  # type: ignore[assignment]
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __eq__(self, value) -> Condition:  # type: ignore[override]
+        return Condition(self.name, value)
+
+    def __ne__(self, value) -> Expression:  # type: ignore[override]
+        return not_(Condition(self.name, value))
+
+    def __lt__(self, value) -> Condition:
+        return Condition(self.name, lt(value))
+
+    def __le__(self, value) -> Condition:
+        return Condition(self.name, le(value))
+
+    def __gt__(self, value) -> Condition:
+        return Condition(self.name, gt(value))
+
+    def __ge__(self, value) -> Condition:
+        return Condition(self.name, ge(value))
+
+    def in_(self, values: Iterable) -> Condition:
+        return Condition(self.name, In(values))
+
+    def between(self, lower, upper) -> Condition:
+        return Condition(self.name, between(lower, upper))
+
+    def like(self, pattern: str) -> Condition:
+        return Condition(self.name, Like(pattern))
+
+    def startswith(self, prefix: str) -> Condition:
+        return Condition(self.name, Prefix(prefix))
+
+    def is_null(self) -> Condition:
+        return Condition(self.name, None)
+
+    def is_not_null(self) -> Expression:
+        return not_(Condition(self.name, None))
+
+    def asc(self) -> str:
+        """Ascending order on this field, for ``order_by`` arguments."""
+        return self.name
+
+    def desc(self) -> str:
+        """Descending order on this field, for ``order_by`` arguments."""
+        return "-" + self.name
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+
+def field(name: str) -> FieldRef:
+    """Reference to a field, to build query expressions."""
+    return FieldRef(name)
+
+
+def and_(*items: Expression) -> Expression:
+    """Matches rows matching all the given expressions."""
+    items = tuple(x for item in items for x in (item.items if isinstance(item, And) else (item,)))
+    return items[0] if len(items) == 1 else And(items)
+
+
+def or_(*items: Expression) -> Expression:
+    """Matches rows matching any of the given expressions."""
+    items = tuple(x for item in items for x in (item.items if isinstance(item, Or) else (item,)))
+    return items[0] if len(items) == 1 else Or(items)
+
+
+def not_(item: Expression) -> Expression:
+    """Matches rows for which the given expression is false."""
+    return item.item if isinstance(item, Not) else Not(item)
+
+
+Criteria = Mapping[str, Any] | Expression
+
+
+def as_expression(criteria: Criteria) -> Expression:
+    """Criteria as an expression (a mapping being the conjunction of its conditions)."""
+    if isinstance(criteria, Expression):
+        return criteria
+    return and_(*(Condition(k, v) for k, v in criteria.items()))
+
+
+def split_criteria(criteria: Criteria) -> tuple[dict[str, Any], Optional[Expression]]:
+    """Split criteria into a mapping of conditions all matching rows must satisfy (at most one per field, usable for
+    index lookups), and the rest of the expression, if any."""
+    if not isinstance(criteria, Expression):
+        return dict(criteria), None
+    conditions, rest = {}, []
+    for item in criteria.items if isinstance(criteria, And) else (criteria,):
+        if isinstance(item, Condition) and item.field not in conditions:
+            conditions[item.field] = item.value
+        else:
+            rest.append(item)
+    return conditions, and_(*rest) if rest else None
+
+
+def matcher(criteria: Criteria) -> Callable[[Mapping], bool]:
+    """Compiles criteria into a function telling whether a row matches all of them. Compiled expressions are cached,
+    as long as their values are hashable."""
+    if isinstance(criteria, Expression):
+        try:
+            return _compile_cached(criteria)
+        except TypeError:
+            return _compile_expression(criteria)
+
+    # (field, predicate or None for equality, value)
+    tests = tuple((k, v if isinstance(v, Predicate) else None, v) for k, v in criteria.items())
+
+    def matches(row: Mapping) -> bool:
+        for k, predicate, value in tests:
+            if predicate is None:
+                if row.get(k) != value:
+                    return False
+            elif (v := row.get(k)) is None or not predicate(v):
+                return False
+        return True
+
+    return matches
+
+
+def _compile_expression(expression: Expression) -> Callable[[Mapping], bool]:
+    test = _compile(expression)
+    return lambda row: test(row) is True
+
+
+_compile_cached = lru_cache(maxsize=1024)(_compile_expression)
+
+
+def _compile(expression: Expression) -> Callable[[Mapping], Optional[bool]]:
+    """Compiles an expression into a function returning True, False or None (unknown) for a row."""
+    if isinstance(expression, Condition):
+        k, value = expression.field, expression.value
+        if value is None:
+            return lambda row: row.get(k) is None
+        if isinstance(value, Predicate):
+            return lambda row: None if (v := row.get(k)) is None else value(v)
+        return lambda row: None if (v := row.get(k)) is None else v == value
+
+    if isinstance(expression, Not):
+        test = _compile(expression.item)
+        return lambda row: None if (result := test(row)) is None else not result
+
+    if isinstance(expression, (And, Or)):
+        tests, decisive = tuple(_compile(item) for item in expression.items), isinstance(expression, Or)
+
+        def combined(row: Mapping) -> Optional[bool]:
+            combined_result = not decisive
+            for test in tests:
+                if (result := test(row)) is decisive:
+                    return decisive
+                if result is None:
+                    combined_result = None
+            return combined_result
+
+        return combined
+
+    raise TypeError(f"Unsupported query expression: {expression!r}.")
+
+
+def parse_order_by(order_by: Optional[str | FieldRef | Iterable[str | FieldRef]]) -> OrderBy:
+    """Normalize an ``order_by`` argument (a field name or a sequence of field names, prefixed with a dash for a
+    descending order, or field references) into a tuple of (field, descending) pairs."""
+    if order_by is None:
+        return ()
+    if isinstance(order_by, (str, FieldRef)):
+        order_by = (order_by,)
+    order_by = tuple(field.name if isinstance(field, FieldRef) else field for field in order_by)
+    return tuple((field[1:], True) if field.startswith("-") else (field, False) for field in order_by)
+
+
+def keyset(order: OrderBy, values: Sequence) -> Expression:
+    """Expression matching the rows coming after a row, given its values for the (field, descending) pairs of an
+    order, for keyset pagination. The order must be total (ending with the primary key), and None values come last
+    whatever the direction, as with ``sort_key``."""
+    clauses, equal = [], []
+    for (k, descending), value in zip(order, values, strict=True):
+        if value is not None:
+            after = Condition(k, lt(value) if descending else gt(value))
+            clauses.append(and_(*equal, or_(after, Condition(k, None))))
+        equal.append(Condition(k, value))
+    return or_(*clauses)
+
+
+def encode_cursor(order: OrderBy, values: Sequence) -> str:
+    """Opaque cursor, holding the values of a row for the (field, descending) pairs of an order (see ``keyset``)."""
+    return urlsafe_b64encode(to_json([[[k, descending] for k, descending in order], list(values)])).decode()
+
+
+def decode_cursor(cursor: str, order: OrderBy) -> list:
+    """Values held by a cursor, which must have been built for the same order. Values are decoded from JSON, so that
+    their python type may need to be restored."""
+    try:
+        cursor_order, values = from_json(urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError) as error:
+        raise ValueError("Invalid cursor.") from error
+    if [tuple(x) for x in cursor_order] != list(order) or len(values) != len(order):
+        raise ValueError("Cursor does not match the order of this query.")
+    return values
+
+
+class _Descending:
+    """Reverses the ordering of the wrapped value."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def sort_key(order: OrderBy) -> Callable[[Mapping], tuple]:
+    """Sort key function for rows, following the given (field, descending) pairs. None values always come last,
+    whatever the direction."""
+
+    def key(row: Mapping) -> tuple:
+        items = []
+        for field, descending in order:
+            value = row.get(field)
+            items += (value is None, _Descending(value) if descending else value)
+        return tuple(items)
+
+    return key
+
+
+def aggregate_rows(rows: Iterable[Mapping], group_by: Sequence[str], aggregates: Aggregates) -> list[dict[str, Any]]:
+    """Compute aggregates over rows in one pass, for each group of rows sharing the same values for the ``group_by``
+    fields (ordered by those values, None last). Like in SQL, None values are ignored (``count`` of a field counts the
+    rows where it is not None), aggregates over no values are None, and there is always one (possibly empty) group if
+    no ``group_by`` fields are given."""
+    for function, _ in aggregates.values():
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError(f'Unknown aggregate function "{function}".')
+
+    specs = tuple(aggregates.values())
+    groups: dict[tuple, list] = {}
+    for row in rows:
+        key = tuple(row.get(k) for k in group_by)
+        if (states := groups.get(key)) is None:
+            states = groups[key] = [[0, None] for _ in specs]
+        for state, (function, field) in zip(states, specs):
+            if field is None:
+                state[0] += 1
+            elif (value := row.get(field)) is not None:
+                state[0] += 1
+                if function in ("sum", "avg"):
+                    state[1] = value if state[1] is None else state[1] + value
+                elif function == "min":
+                    state[1] = value if state[1] is None or value < state[1] else state[1]
+                elif function == "max":
+                    state[1] = value if state[1] is None or value > state[1] else state[1]
+
+    if not group_by and not groups:
+        groups[()] = [[0, None] for _ in specs]
+
+    def result(function: AggregateFunction, count: int, value):
+        if function == "count":
+            return count
+        if function == "avg":
+            return value / count if count else None
+        return value
+
+    results = [
+        {
+            **dict(zip(group_by, key)),
+            **{name: result(function, *state) for (name, (function, _)), state in zip(aggregates.items(), states)},
+        }
+        for key, states in groups.items()
+    ]
+    return sorted(results, key=sort_key([(k, False) for k in group_by])) if group_by else results
@@ -1,28 +1,88 @@
 """Entity relationship definitions.
 
 This module provides classes for defining relationships between entities,
-supporting lazy loading and automatic persistence of related entities.
+supporting lazy or eager loading and automatic persistence of related entities.
 """
 
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING
+from collections import defaultdict
+from typing import TYPE_CHECKING, Callable, Iterable, Literal, Mapping, Optional, Sequence
 
+from anymodel.types.collections import Collection, PagedCollection
+from anymodel.types.queries import In
 
 if TYPE_CHECKING:
     from anymodel.mapper import Mapper  # noqa: F401
 
+LoadStrategy = Literal["lazy", "selectin", "joined"]
+LOAD_STRATEGIES = ("lazy", "selectin", "joined")
+OrphanPolicy = Literal["detach", "delete"]
+ORPHAN_POLICIES = ("detach", "delete")
+
 
 class Relation(ABC):
-    """Abstract base class for entity relationships."""
+    """Abstract base class for entity relationships.
+
+    The load strategy tells how the related entities are loaded by default (it can be overriden for each mapper call,
+    see :meth:`anymodel.mapper.Mapper.find`):
+
+    * ``"lazy"``: each entity gets a collection loading its related entities on first use (one query per entity).
+    * ``"selectin"``: the related entities of a whole page of entities are loaded at once, with one ``In`` query.
+    * ``"joined"``: entities and their related entities are loaded with one query, joining the tables, if the storage
+      supports it (both mappers must use the same storage), falling back to ``"selectin"`` otherwise.
+
+    Eager strategies need relations to implement ``get_related_criteria`` and ``group_related``. Lazy relations with a
+    ``page_size`` get paged collections instead (see :class:`anymodel.types.collections.PagedCollection`), loading
+    their entities page by page and counting them without loading them, which needs relations to implement
+    ``get_page_callbacks_for``.
+
+    When saving an entity, only the changes of its related collections are saved: new or added entities are linked
+    and saved, modified ones saved, and the entities removed from the collection are either detached (their foreign
+    key is cleared) or deleted, depending on the ``orphans`` policy. Clean related entities are not written.
+    """
+
+    strategy: LoadStrategy = "lazy"
+    orphans: OrphanPolicy = "detach"
+    page_size: Optional[int] = None
 
     @abstractmethod
     def get_find_callback_for(self, mapper, entity):
         raise NotImplementedError
 
+    def get_page_callbacks_for(self, mapper, row) -> tuple[Callable, Callable]:
+        """Functions finding a page of the related entities of a row, and counting them, for paged collections."""
+        raise NotImplementedError
+
+    def get_collection_for(self, mapper, row) -> Collection:
+        """Lazy collection of the related entities of a row."""
+        if self.page_size:
+            return PagedCollection(*self.get_page_callbacks_for(mapper, row), page_size=self.page_size)
+        return Collection(self.get_find_callback_for(mapper, row))
+
     @abstractmethod
     def save(self, mapper, entity, related_entity):
         raise NotImplementedError
 
+    def link(self, mapper, entity, related_entity):
+        """Set the foreign key of a related entity (without saving it), for units of work saving related entities by
+        batches."""
+        raise NotImplementedError
+
+    def unlink(self, mapper, entity, related_entity):
+        """Clear the foreign key of an entity removed from the related entities (without saving it)."""
+        raise NotImplementedError
+
+    def get_foreign_key(self, mapper) -> str:
+        raise NotImplementedError
+
+    def get_related_criteria(self, mapper, rows: Sequence[Mapping]) -> dict:
+        """Criteria matching the related rows of all the given rows, for eager loading."""
+        raise NotImplementedError
+
+    def group_related(self, mapper, rows: Sequence[Mapping], related_rows: Iterable[Mapping]) -> list[list[Mapping]]:
+        """Split related rows (as found using ``get_related_criteria``) into the related rows of each given row."""
+        raise NotImplementedError
+
 
 class OneToManyRelation(Relation):
     """Represents a one-to-many relationship between entities.
@@ -31,15 +91,68 @@ class OneToManyRelation(Relation):
     a one-to-many relationship.
     """
 
-    def __init__(self, mapper: "Mapper"):
+    def __init__(
+        self,
+        mapper: "Mapper",
+        *,
+        strategy: LoadStrategy = "lazy",
+        orphans: OrphanPolicy = "detach",
+        page_size: Optional[int] = None,
+    ):
         self.mapper = mapper
+        self.strategy = check_load_strategy(strategy)
+        self.orphans = check_orphan_policy(orphans)
+        self.page_size = page_size
 
     def get_find_callback_for(self, mapper, row):
         def load():
-            return self.mapper.find(**{f"{mapper.__tablename__}_id": str(row["id"])})
+            return self.mapper.find(**{self.get_foreign_key(mapper): row["id"]})
 
         return load
 
+    def get_page_callbacks_for(self, mapper, row) -> tuple[Callable, Callable]:
+        criteria = {self.get_foreign_key(mapper): row["id"]}
+
+        def find(limit=None, offset=None, last=None):
+            # pages are ordered by primary key, following pages are found after the last entity of the previous one
+            after = self.mapper.cursor(last) if last is not None else None
+            return self.mapper.find(limit=limit, offset=offset, after=after, **criteria)
+
+        def count():
+            return self.mapper.count(**criteria)
+
+        return find, count
+
+    def get_foreign_key(self, mapper) -> str:
+        return f"{mapper.__tablename__}_id"
+
+    def get_related_criteria(self, mapper, rows: Sequence[Mapping]) -> dict:
+        return {self.get_foreign_key(mapper): In(row["id"] for row in rows)}
+
+    def group_related(self, mapper, rows: Sequence[Mapping], related_rows: Iterable[Mapping]) -> list[list[Mapping]]:
+        foreign_key, groups = self.get_foreign_key(mapper), defaultdict(list)
+        for related_row in related_rows:
+            groups[related_row[foreign_key]].append(related_row)
+        return [groups.get(row["id"], []) for row in rows]
+
+    def link(self, mapper, entity, related_entity):
+        setattr(related_entity, self.get_foreign_key(mapper), entity.id)
+
+    def unlink(self, mapper, entity, related_entity):
+        setattr(related_entity, self.get_foreign_key(mapper), None)
+
     def save(self, mapper, entity, related_entity):
-        setattr(related_entity, f"{mapper.__tablename__}_id", entity.id)
+        self.link(mapper, entity, related_entity)
         return self.mapper.save(related_entity)
+
+
+def check_load_strategy(strategy: str) -> LoadStrategy:
+    if strategy not in LOAD_STRATEGIES:
+        raise ValueError(f"Unknown load strategy {strategy!r}, expected one of {', '.join(LOAD_STRATEGIES)}.")
+    return strategy
+
+
+def check_orphan_policy(orphans: str) -> OrphanPolicy:
+    if orphans not in ORPHAN_POLICIES:
+        raise ValueError(f"Unknown orphan policy {orphans!r}, expected one of {', '.join(ORPHAN_POLICIES)}.")
+    return orphans
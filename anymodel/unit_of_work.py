@@ -0,0 +1,216 @@
+"""Unit of work implementation, deferring and batching the writes of many entities.
+
+This module provides the UnitOfWork class, which registers new, modified and
+deleted entities of several mappers, and writes all of them at once when
+flushed: ordered by relation dependencies, batched by table, and within one
+transaction per storage.
+"""
+
+from contextlib import ExitStack
+from functools import partial
+from graphlib import TopologicalSorter
+from itertools import batched
+from typing import Callable, Iterable, Optional, Self
+
+from anymodel.mapper import AsyncMapper, Mapper
+from anymodel.types.entity import Entity
+
+
+class UnitOfWork:
+    """Registers entities to save or delete, and writes them when flushed (or committed).
+
+    Entities are registered with ``add`` (new or modified entities, and the changes of their related collections) or
+    ``delete``, the mapper of each entity being found by type among the given mappers (and their related mappers).
+    ``flush`` writes everything within one transaction per storage: new entities are inserted and modified ones
+    updated by batches of ``batch_size`` entities of the same table (one storage call per batch), parents first so
+    that the foreign keys of their related entities can be set (level by level, for relations of a mapper to itself),
+    then deleted entities (and orphans of relations deleting them) are deleted, children first. Entities without
+    changes are not written. If a write fails, the transactions are rolled back, and so are the states of the
+    entities (their identities, stored values and presence in the identity maps).
+
+    Used as a context manager, the unit of work is committed at the end of the block, unless it raises.
+
+    >>> with UnitOfWork(teams, members) as uow:
+    ...     uow.add(Team(name="JLA", members=[Member(name="Superman"), Member(name="Batman")]))
+
+    """
+
+    batch_size: int = 500
+
+    def __init__(self, *mappers: Mapper, batch_size: Optional[int] = None):
+        self.batch_size = batch_size or self.batch_size
+        self._mappers: dict[type, Mapper] = {}
+        for mapper in mappers:
+            self._add_mapper(mapper)
+        # registered entities, by id (entities are not hashable), in registration order
+        self._saved: dict[int, Entity] = {}
+        self._deleted: dict[int, Entity] = {}
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def add(self, *entities: Entity):
+        """Register new or modified entities (and the changes of their related collections) to save."""
+        for entity in entities:
+            self._get_mapper(entity)
+            self._deleted.pop(id(entity), None)
+            self._saved[id(entity)] = entity
+
+    def delete(self, *entities: Entity):
+        """Register stored entities to delete."""
+        for entity in entities:
+            self._get_mapper(entity)
+            if entity.__state__.transient:
+                raise ValueError("Cannot delete a transient entity.")
+            self._saved.pop(id(entity), None)
+            self._deleted[id(entity)] = entity
+
+    def flush(self):
+        """Write all the registered entities, within one transaction per storage (all of them are rolled back if any
+        write fails), and forget them."""
+        saved, deleted, links = self._get_changes()
+        order = self._get_order([*saved, *deleted])
+        states = [_EntityState(entity) for entity in [*saved, *deleted]]
+
+        try:
+            with ExitStack() as stack:
+                storages = {id(mapper.storage): mapper.storage for mapper in order}
+                for storage in storages.values():
+                    stack.enter_context(storage.transaction())
+
+                pending = {id(entity) for entity in saved}
+                for mapper in order:
+                    entities = [entity for entity in saved if self._get_mapper(entity) is mapper]
+                    while entities:
+                        # entities whose parents are written already (all of them, but for relations of the mapper to
+                        # itself, which are written level by level)
+                        level = [entity for entity in entities if not pending.intersection(links.get(id(entity), ()))]
+                        if not level:
+                            raise ValueError(f"Cannot save {mapper.__type__.__name__} entities related to each other.")
+                        self._write(mapper, level, links)
+                        pending.difference_update(map(id, level))
+                        entities = [entity for entity in entities if id(entity) in pending]
+
+                for mapper in reversed(order):
+                    for entity in deleted:
+                        if self._get_mapper(entity) is mapper:
+                            mapper.delete(entity)
+        except BaseException:
+            for state in states:
+                state.restore(self._get_mapper(state.entity))
+            raise
+
+        # the changes of related collections are saved too
+        for entity in saved:
+            related_values = self._get_mapper(entity)._get_known_modified_related_values(entity)
+            for related in related_values.values():
+                related.reset_changes()
+            entity.__pydantic_fields_set__ = entity.__pydantic_fields_set__.difference(related_values)
+        self.rollback()
+
+    def commit(self):
+        """Flush the registered entities."""
+        self.flush()
+
+    def rollback(self):
+        """Forget the registered entities, without writing them."""
+        self._saved.clear()
+        self._deleted.clear()
+
+    def _write(self, mapper: Mapper, entities: list[Entity], links: dict[int, dict[Optional[int], Callable]]):
+        """Link entities of a mapper to their (written) parents, and insert or update them by batches."""
+        for entity in entities:
+            for link in links.get(id(entity), {}).values():
+                link()
+        stored = [entity for entity in entities if not entity.__state__.transient]
+        for batch in batched((entity for entity in entities if entity.__state__.transient), self.batch_size):
+            mapper._insert_many(batch)
+        # only the entities with changes are written
+        for batch in batched(stored, self.batch_size):
+            mapper._update_many(batch)
+        for entity in entities:
+            mapper._mapped(entity)
+
+    def _get_changes(self) -> tuple[list[Entity], list[Entity], dict[int, dict[Optional[int], Callable]]]:
+        """Entities to save (registered ones, and the ones to save with them, see
+        :meth:`anymodel.mapper.Mapper._get_related_changes`), entities to delete (registered ones, and deleted orphans),
+        and the functions linking (or unlinking) related entities to their parents, by related entity id and parent
+        entity id (None for unlinking, which does not need the parent to be written)."""
+        saved, deleted, links = dict(self._saved), dict(self._deleted), {}
+        queue = list(saved.values())
+        for entity in queue:
+            mapper = self._get_mapper(entity)
+            for k, related in mapper._get_known_modified_related_values(entity).items():
+                relation = mapper.relations[k]
+                linked, children, removed = mapper._get_related_changes(
+                    relation, related, replaced=k in entity.__pydantic_fields_set__
+                )
+                for child in linked:
+                    links.setdefault(id(child), {})[id(entity)] = partial(relation.link, mapper, entity, child)
+                if relation.orphans == "delete":
+                    deleted.update((id(child), child) for child in removed)
+                else:
+                    # unlinking does not depend on the parent being written
+                    for child in removed:
+                        links.setdefault(id(child), {})[None] = partial(relation.unlink, mapper, entity, child)
+                    children += removed
+                for child in children:
+                    if id(child) not in saved:
+                        saved[id(child)] = child
+                        queue.append(child)
+        return list(saved.values()), list(deleted.values()), links
+
+    def _get_order(self, entities: Iterable[Entity]) -> list[Mapper]:
+        """Mappers of the given entities, and their related mappers, parents first (relations of a mapper to itself are
+        left out, their entities being ordered within the mapper, see :meth:`flush`)."""
+        graph, stack = {}, list({id(mapper): mapper for mapper in map(self._get_mapper, entities)}.values())
+        while stack:
+            if (mapper := stack.pop()) not in graph:
+                graph[mapper] = set()
+                stack += [relation.mapper for relation in mapper.relations.values()]
+        for mapper in graph:
+            for relation in mapper.relations.values():
+                if relation.mapper is not mapper:
+                    graph[relation.mapper].add(mapper)
+        return list(TopologicalSorter(graph).static_order())
+
+    def _get_mapper(self, entity: Entity) -> Mapper:
+        if (mapper := self._mappers.get(type(entity))) is None:
+            raise ValueError(f"No mapper for {type(entity).__name__} in this unit of work.")
+        return mapper
+
+    def _add_mapper(self, mapper: Mapper):
+        if isinstance(mapper, AsyncMapper):
+            raise TypeError("Units of work only support synchronous mappers.")
+        if self._mappers.setdefault(mapper.__type__, mapper) is mapper:
+            for relation in mapper.relations.values():
+                if relation.mapper.__type__ not in self._mappers:
+                    self._add_mapper(relation.mapper)
+
+
+class _EntityState:
+    """State of an entity before a flush (its values, fields set, identity, stored values and presence in the identity
+    map), to restore if the flush fails."""
+
+    def __init__(self, entity: Entity):
+        self.entity = entity
+        self.values = dict(entity.__dict__)
+        self.fields_set = set(entity.__pydantic_fields_set__)
+        self.identity, self.snapshot = entity.__state__._identity, entity.__state__._snapshot
+
+    def restore(self, mapper: Mapper):
+        entity, state = self.entity, self.entity.__state__
+        if mapper._cache is not None and state.identity is not None and mapper._cache.get(state.identity) is entity:
+            mapper._cache.delete(state.identity)
+        entity.__dict__.clear()
+        entity.__dict__.update(self.values)
+        entity.__pydantic_fields_set__ = self.fields_set
+        state._identity, state._snapshot = self.identity, self.snapshot
+        if self.identity is not None:
+            mapper._mapped(entity)
@@ -0,0 +1,286 @@
+"""Bounded in-process caches.
+
+This module provides BoundedCache, a strong-reference cache with a size bound
+(number of entries and/or approximate bytes), LRU or LFU eviction, optional
+expiration of entries, and hit/miss/eviction counters. Mappers use it as a
+second-level cache of entity rows, next to their identity map. SqliteCache is
+a persistent counterpart, shared by the processes using the same file.
+"""
+
+import pickle
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from os import PathLike
+from threading import Lock
+from typing import Any, Callable, Hashable, Literal, Mapping, Optional
+
+EvictionPolicy = Literal["lru", "lfu"]
+
+
+class CacheStats:
+    """Counters of a cache, since its creation (or the last ``reset``)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of the lookups that were hits (0 if there were no lookups)."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __repr__(self):
+        return (
+            f"<{type(self).__name__} hits={self.hits} misses={self.misses} evictions={self.evictions} "
+            f"expirations={self.expirations} hit_rate={self.hit_rate:.1%}>"
+        )
+
+
+class Cache:
+    """Base class for caches. ``get`` returns ``default`` for missing (or expired) keys, and ``set`` caches a value for
+    ``ttl`` seconds (if None, the default ttl of the cache, if any).
+
+    Versions are small values kept next to the entries, for instance to invalidate groups of entries by making their
+    version a part of their keys. Caches keep them apart from the entries where they can: their lookups are not
+    counted in ``stats``, and they are neither evicted nor expired (only cleared)."""
+
+    stats: CacheStats
+
+    def get(self, key: Hashable, default=None): ...
+    def set(self, key: Hashable, value, *, ttl: Optional[float] = None): ...
+    def delete(self, key: Hashable): ...
+    def clear(self): ...
+
+    def get_version(self, key: Hashable):
+        return self.get(key)
+
+    def set_version(self, key: Hashable, value):
+        self.set(key, value)
+
+
+class BoundedCache(Cache):
+    """Strong-reference cache, bounded by a number of entries and/or an approximate size in bytes.
+
+    When a bound is exceeded, entries are evicted using the given policy: least recently used (``"lru"``), or least
+    frequently used (``"lfu"``, the least recently used of them on ties). Entries expire ``ttl`` seconds after being
+    set (never, if None), the default being overridden by the ``ttl`` given to ``set``. Sizes are estimated by
+    ``sizeof`` (shallow sizes of a mapping and of its keys and values by default), and are only computed if
+    ``max_bytes`` is set.
+
+    Lookups, evictions and expirations are counted in ``stats``. Operations are thread safe.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        *,
+        policy: EvictionPolicy = "lru",
+        ttl: Optional[float] = None,
+        sizeof: Optional[Callable[[Any], int]] = None,
+    ):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f'Unknown eviction policy "{policy}".')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.ttl = ttl
+        self.sizeof = sizeof or _sizeof
+        self.stats = CacheStats()
+        self.size = 0
+
+        # entries as (value, size, expiration time) tuples, in recency order. LFU also keeps the keys of each use
+        # count (in recency order too), to find the entry to evict without scanning (the smallest use count is
+        # found among the few distinct counts).
+        self._entries: OrderedDict[Hashable, tuple[Any, int, Optional[float]]] = OrderedDict()
+        self._uses: dict[Hashable, int] = {}
+        self._frequencies: dict[int, dict[Hashable, None]] = {}
+        self._versions: dict[Hashable, Any] = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def get(self, key: Hashable, default=None):
+        """Returns the value cached for the key (and counts a hit), or ``default`` (and counts a miss)."""
+        with self._lock:
+            if (entry := self._lookup(key)) is None:
+                self.stats.misses += 1
+                return default
+            self.stats.hits += 1
+            self._touch(key)
+            return entry[0]
+
+    def set(self, key: Hashable, value, *, ttl: Optional[float] = None):
+        """Cache a value, evicting other entries if needed. Values larger than ``max_bytes`` are not cached."""
+        ttl = ttl if ttl is not None else self.ttl
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._remove(key)
+            if self.max_entries == 0 or (self.max_bytes is not None and size > self.max_bytes):
+                return
+            self._evict(size)
+            self._entries[key] = (value, size, time.monotonic() + ttl if ttl is not None else None)
+            self.size += size
+            if self.policy == "lfu":
+                self._uses[key] = 1
+                self._frequencies.setdefault(1, {})[key] = None
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._uses.clear()
+            self._frequencies.clear()
+            self._versions.clear()
+            self.size = 0
+
+    def get_version(self, key: Hashable):
+        with self._lock:
+            return self._versions.get(key)
+
+    def set_version(self, key: Hashable, value):
+        with self._lock:
+            self._versions[key] = value
+
+    def _lookup(self, key: Hashable) -> Optional[tuple]:
+        if (entry := self._entries.get(key)) is not None and entry[2] is not None and entry[2] <= time.monotonic():
+            self._remove(key)
+            self.stats.expirations += 1
+            return None
+        return entry
+
+    def _touch(self, key: Hashable):
+        self._entries.move_to_end(key)
+        if self.policy == "lfu":
+            uses = self._uses[key]
+            self._unlink(key, uses)
+            self._uses[key] = uses + 1
+            self._frequencies.setdefault(uses + 1, {})[key] = None
+
+    def _evict(self, size: int):
+        """Evict entries until there is room for a new entry of the given size."""
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) >= self.max_entries)
+            or (self.max_bytes is not None and self.size + size > self.max_bytes)
+        ):
+            if self.policy == "lfu":
+                key = next(iter(self._frequencies[min(self._frequencies)]))
+            else:
+                key = next(iter(self._entries))
+            self._remove(key)
+            self.stats.evictions += 1
+
+    def _remove(self, key: Hashable):
+        if (entry := self._entries.pop(key, None)) is not None:
+            self.size -= entry[1]
+            if (uses := self._uses.pop(key, None)) is not None:
+                self._unlink(key, uses)
+
+    def _unlink(self, key: Hashable, uses: int):
+        keys = self._frequencies[uses]
+        del keys[key]
+        if not keys:
+            del self._frequencies[uses]
+
+
+class SqliteCache(Cache):
+    """Persistent cache, stored in a sqlite file which the processes using it share.
+
+    Keys are strings, values are pickled (so the file must only be shared with trusted processes). Entries expire
+    ``ttl`` seconds after being set (never, if None), and when there are more than ``max_entries`` of them, the least
+    recently set ones are evicted. ``stats`` only counts the operations of this process.
+    """
+
+    def __init__(self, path: str | PathLike, *, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires REAL);
+            CREATE TABLE IF NOT EXISTS versions (key TEXT PRIMARY KEY, value BLOB);
+            """
+        )
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._connection.execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.stats.expirations += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            self.stats.hits += 1
+        return pickle.loads(entry[0])
+
+    def set(self, key: str, value, *, ttl: Optional[float] = None):
+        ttl = ttl if ttl is not None else self.ttl
+        value = pickle.dumps(value)
+        with self._lock:
+            # replacing a row gives it a new rowid, so rowids follow the order entries were last set in
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl if ttl is not None else None),
+            )
+            if self.max_entries is not None:
+                cursor = self._connection.execute(
+                    "DELETE FROM entries WHERE rowid IN "
+                    "(SELECT rowid FROM entries ORDER BY rowid LIMIT MAX((SELECT COUNT(*) FROM entries) - ?, 0))",
+                    (self.max_entries,),
+                )
+                self.stats.evictions += cursor.rowcount
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM entries")
+            self._connection.execute("DELETE FROM versions")
+
+    def get_version(self, key: str):
+        with self._lock:
+            entry = self._connection.execute("SELECT value FROM versions WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(entry[0]) if entry is not None else None
+
+    def set_version(self, key: str, value):
+        value = pickle.dumps(value)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO versions (key, value) VALUES (?, ?)", (key, value))
+
+
+def _sizeof(value) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, Mapping):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    return size
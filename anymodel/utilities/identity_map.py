@@ -4,12 +4,16 @@ This module provides the IdentityMap class which ensures that only one
 instance of an entity with a given identity exists in memory at a time.
 """
 
-from typing import Any, MutableMapping
+from typing import Any, Literal, MutableMapping
 from weakref import WeakValueDictionary
 
 from anymodel.types.entity import Entity
+from anymodel.types.mappings import Identity
 
-Identity = tuple[str, ...]
+# what to do with identity mapped entities found again in the storage: keep them as they are, refresh them with the
+# stored values unless they have unsaved changes, or always overwrite them (discarding unsaved changes)
+RefreshPolicy = Literal["keep", "refresh_clean", "overwrite"]
+REFRESH_POLICIES = ("keep", "refresh_clean", "overwrite")
 
 
 class IdentityMap:
@@ -17,6 +21,8 @@ class IdentityMap:
 
     Uses weak references to allow garbage collection of entities
     that are no longer referenced elsewhere in the application.
+    Entities are keyed by their identity (see Identity), whose hash is
+    computed once.
     """
 
     _map: MutableMapping[Identity, Any]
@@ -31,4 +37,13 @@ class IdentityMap:
         return entity
 
     def get(self, key: Identity) -> Entity | None:
-        return self._map.get(tuple(key))
+        return self._map.get(key)
+
+    def delete(self, key: Identity):
+        self._map.pop(key, None)
+
+
+def check_refresh_policy(policy: str) -> RefreshPolicy:
+    if policy not in REFRESH_POLICIES:
+        raise ValueError(f"Unknown refresh policy {policy!r}, expected one of {', '.join(REFRESH_POLICIES)}.")
+    return policy
@@ -0,0 +1,248 @@
+"""Secondary indexes for row storages.
+
+This module provides index structures mapping field values to row keys, so that
+storages can resolve criteria without scanning (or deserializing) every row of a
+table. In-memory indexes are maintained by the storage, and a sqlite-backed index
+is available for storages needing a persistent one.
+"""
+
+import sqlite3
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from datetime import date, time
+from itertools import count
+from operator import itemgetter
+from os import PathLike
+from threading import Lock
+from typing import Any, Hashable, Iterable, Iterator, Mapping, Optional
+
+from anymodel.types.queries import In, Range
+
+
+class HashIndex:
+    """Maps each value of a field to the keys of the rows holding this value.
+
+    Postings are dicts used as insertion-ordered sets, so that rows found through the index keep a stable order. A
+    unique index rejects rows holding a value already indexed for another key (None values are never considered
+    duplicates, like in SQL).
+    """
+
+    def __init__(self, field: str, *, unique: bool = False):
+        self.field = field
+        self.unique = unique
+        self._postings: dict[Any, dict[Hashable, None]] = {}
+
+    def __len__(self):
+        return len(self._postings)
+
+    def get(self, value) -> Mapping[Hashable, None]:
+        """Returns the keys of the rows holding the given value."""
+        return self._postings.get(value, {})
+
+    def counts(self) -> dict[Any, int]:
+        """Returns the number of rows holding each indexed value."""
+        return {value: len(posting) for value, posting in self._postings.items()}
+
+    def check(self, key: Hashable, row: Mapping):
+        """Raise a ValueError if adding the given row would break the index unicity constraint."""
+        if not self.unique or (value := row.get(self.field)) is None:
+            return
+        if any(other != key for other in self._postings.get(value, ())):
+            raise ValueError(f"Duplicate value {value!r} for unique index on {self.field!r}.")
+
+    def add(self, key: Hashable, row: Mapping):
+        self.check(key, row)
+        self._postings.setdefault(row.get(self.field), {})[key] = None
+
+    def remove(self, key: Hashable, row: Mapping):
+        value = row.get(self.field)
+        if (posting := self._postings.get(value)) is not None:
+            posting.pop(key, None)
+            if not posting:
+                del self._postings[value]
+
+
+class SortedIndex:
+    """Keeps the keys of the rows ordered by the value of a field, for range lookups and ordered scans.
+
+    Entries are (value, sequence) pairs, the sequence number being unique for each key, so that an entry can be found
+    (and removed) by bisection even for values shared by a lot of rows. Rows with a None value are kept apart and
+    always come last. If the field values cannot be compared with each other, the index disables itself (see
+    ``usable``) and lookups must fall back to scanning the rows.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.usable = True
+        self._entries: list[tuple[Any, int]] = []
+        self._keys: list[Hashable] = []
+        self._sequences: dict[Hashable, int] = {}
+        self._nulls: dict[Hashable, None] = {}
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._keys) + len(self._nulls)
+
+    def check(self, key: Hashable, row: Mapping):
+        pass
+
+    def add(self, key: Hashable, row: Mapping):
+        if (value := row.get(self.field)) is None:
+            self._nulls[key] = None
+        elif self.usable:
+            entry = (value, sequence := next(self._counter))
+            try:
+                position = bisect_right(self._entries, entry)
+            except TypeError:
+                return self._disable()
+            self._entries.insert(position, entry)
+            self._keys.insert(position, key)
+            self._sequences[key] = sequence
+
+    def remove(self, key: Hashable, row: Mapping):
+        if (value := row.get(self.field)) is None:
+            self._nulls.pop(key, None)
+        elif self.usable and (sequence := self._sequences.pop(key, None)) is not None:
+            position = bisect_left(self._entries, (value, sequence))
+            del self._entries[position]
+            del self._keys[position]
+
+    def accepts(self, value) -> bool:
+        """Whether the given value can be compared with the indexed values, to be used as a range bound."""
+        try:
+            bisect_left(self._entries, value, key=itemgetter(0))
+        except TypeError:
+            return False
+        return True
+
+    def keys(self, predicate: Optional[Range] = None, *, reverse: bool = False) -> Iterator[Hashable]:
+        """Iterate over the keys of the rows matching the given range (or all the rows, if no range is given), ordered
+        by value. None values are only part of unbounded scans, and come last in both directions."""
+        if not self.usable:
+            raise RuntimeError(f"Sorted index on {self.field!r} is not usable, values are not comparable.")
+
+        lower, upper = 0, len(self._keys)
+        if predicate is not None:
+            value = itemgetter(0)
+            if predicate.lower is not None:
+                bisect = bisect_left if predicate.lower_inclusive else bisect_right
+                lower = bisect(self._entries, predicate.lower, key=value)
+            if predicate.upper is not None:
+                bisect = bisect_right if predicate.upper_inclusive else bisect_left
+                upper = bisect(self._entries, predicate.upper, lower, key=value)
+
+        if reverse:
+            yield from (self._keys[position] for position in range(upper - 1, lower - 1, -1))
+        else:
+            yield from (self._keys[position] for position in range(lower, upper))
+
+        if predicate is None:
+            yield from self._nulls
+
+    def _disable(self):
+        self.usable = False
+        self._entries, self._keys, self._sequences = [], [], {}
+
+
+class SqliteIndex:
+    """Persistent index of field values to row keys, stored in a sqlite side-file.
+
+    Entries are (table, field, value, key) tuples, with a composite sql index on (table, field, value) so that equality,
+    range and ordered lookups never need to read the rows. The primary key field is always indexed, and gives the list
+    of keys of a table. Values sqlite cannot store natively are indexed by their string representation, so lookups may
+    return false positives for them: callers must check the criteria against the rows they load.
+    """
+
+    def __init__(self, path: str | PathLike):
+        self.path = path
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (tablename TEXT, field TEXT, value, key TEXT);
+            CREATE INDEX IF NOT EXISTS entries_by_value ON entries (tablename, field, value);
+            CREATE INDEX IF NOT EXISTS entries_by_key ON entries (tablename, key);
+            """
+        )
+
+    def close(self):
+        self._connection.close()
+
+    def add_many(self, tablename: str, rows: Iterable[tuple[str, Mapping]], fields: Iterable[str]):
+        """Index the given (key, row) pairs, replacing previous entries for the same keys."""
+        rows, fields = list(rows), tuple(fields)
+        with self._transaction() as cursor:
+            cursor.executemany(
+                "DELETE FROM entries WHERE tablename = ? AND key = ?", [(tablename, key) for key, _ in rows]
+            )
+            cursor.executemany(
+                "INSERT INTO entries (tablename, field, value, key) VALUES (?, ?, ?, ?)",
+                [(tablename, field, _as_sql_value(row.get(field)), key) for key, row in rows for field in fields],
+            )
+
+    def remove(self, tablename: str, key: str):
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM entries WHERE tablename = ? AND key = ?", (tablename, key))
+
+    def keys(
+        self, tablename: str, field: str, criteria: Mapping[str, Any], *, order: Optional[tuple[str, bool]] = None
+    ) -> list[str]:
+        """Keys of the rows of a table matching all the given criteria (on indexed fields only: values, ranges or
+        ``In`` predicates). ``field`` is the always indexed field used to list the table keys when there is no
+        criteria. If ``order`` is given as an indexed (field, descending) pair, keys are sorted by this field value,
+        None values last."""
+        queries, parameters = [], []
+        for k, v in criteria.items():
+            query, query_parameters = "SELECT key FROM entries WHERE tablename = ? AND field = ?", [tablename, k]
+            if isinstance(v, In):
+                values = [_as_sql_value(value) for value in v.values if value is not None]
+                query += " AND value IN (" + ", ".join("?" * len(values)) + ")"
+                query_parameters += values
+            elif not isinstance(v, Range):
+                query += " AND value IS ?"
+                query_parameters.append(_as_sql_value(v))
+            else:
+                query += " AND value IS NOT NULL"
+                if v.lower is not None:
+                    query += " AND value >= ?" if v.lower_inclusive else " AND value > ?"
+                    query_parameters.append(_as_sql_value(v.lower))
+                if v.upper is not None:
+                    query += " AND value <= ?" if v.upper_inclusive else " AND value < ?"
+                    query_parameters.append(_as_sql_value(v.upper))
+            queries.append(query)
+            parameters += query_parameters
+
+        if not queries:
+            queries.append("SELECT key FROM entries WHERE tablename = ? AND field = ?")
+            parameters += [tablename, field]
+
+        query = " INTERSECT ".join(queries)
+        if order is not None:
+            query = (
+                "SELECT key FROM entries WHERE tablename = ? AND field = ? AND key IN (" + query + ") "
+                "ORDER BY value IS NULL, value " + ("DESC" if order[1] else "ASC")
+            )
+            parameters = [tablename, order[0], *parameters]
+
+        with self._lock:
+            return [key for (key,) in self._connection.execute(query, parameters)]
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+
+def _as_sql_value(value):
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value)
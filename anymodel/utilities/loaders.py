@@ -0,0 +1,72 @@
+"""Batching loader, coalescing concurrent lookups into bulk ones.
+
+This module provides BatchLoader, which collects the keys looked up by
+concurrent coroutines (within one event loop tick, or a short delay) and
+resolves them with one call of a bulk load function, each key being looked up
+once however many coroutines wait for it. Async mappers use it to find the
+entities looked up by primary key with one query.
+"""
+
+import asyncio
+from itertools import batched
+from typing import Any, Awaitable, Callable, Hashable, Optional, Sequence
+
+
+class BatchLoader:
+    """Coalesces the lookups of concurrent coroutines into calls of a bulk load function.
+
+    ``load_many(keys)`` returns the values of the given keys, in the same order. Keys looked up within one event loop
+    tick (or within ``delay`` seconds of the first one, if set) are loaded together, by batches of up to
+    ``max_batch_size`` keys (all at once, if None), and the lookups of a key already being loaded wait for the same
+    result (if the load fails, they all get the exception). Values are not cached once loaded.
+    """
+
+    def __init__(
+        self,
+        load_many: Callable[[list], Awaitable[Sequence]],
+        *,
+        delay: Optional[float] = None,
+        max_batch_size: Optional[int] = None,
+    ):
+        self.load_many = load_many
+        self.delay = delay
+        self.max_batch_size = max_batch_size
+
+        # futures of the keys being loaded (or waiting to be), and of the keys of the next batch
+        self._futures: dict[Hashable, asyncio.Future] = {}
+        self._batch: Optional[dict[Hashable, asyncio.Future]] = None
+
+    async def load(self, key: Hashable) -> Any:
+        """Value of the given key, loaded with the keys of the other lookups of the same tick (or delay)."""
+        if (future := self._futures.get(key)) is None:
+            loop = asyncio.get_running_loop()
+            if self._batch is None:
+                self._batch = {}
+                if self.delay:
+                    loop.call_later(self.delay, self._dispatch)
+                else:
+                    loop.call_soon(self._dispatch)
+            future = self._futures[key] = self._batch[key] = loop.create_future()
+        # shielded, so that cancelling one lookup does not cancel the others
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        batch, self._batch = self._batch, None
+        for keys in batched(batch, self.max_batch_size or len(batch)):
+            asyncio.get_running_loop().create_task(self._resolve({key: batch[key] for key in keys}))
+
+    async def _resolve(self, batch: dict[Hashable, asyncio.Future]):
+        try:
+            values = await self.load_many(list(batch))
+        except Exception as exception:
+            for future in batch.values():
+                future.set_exception(exception)
+        else:
+            for future, value in zip(batch.values(), values):
+                future.set_result(value)
+        finally:
+            # the load may also have been cancelled (or returned too few values), lookups must not wait forever
+            for key, future in batch.items():
+                if not future.done():
+                    future.cancel()
+                self._futures.pop(key, None)
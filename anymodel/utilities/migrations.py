@@ -17,32 +17,38 @@ def automigrate(engine, metadata):
 
     See: https://alembic.sqlalchemy.org/en/latest/cookbook.html#run-alembic-operation-objects-directly-as-in-from-autogenerate
     """
+    with engine.connect() as connection:
+        automigrate_connection(connection, metadata)
+        connection.commit()
+
+
+def automigrate_connection(connection, metadata):
+    """Same as :func:`automigrate`, using the given connection and leaving the transaction commit to the caller (for
+    async engines, it can be run using ``AsyncConnection.run_sync``)."""
     from alembic.autogenerate import produce_migrations
     from alembic.migration import MigrationContext
     from alembic.operations import Operations
     from alembic.operations.ops import ModifyTableOps
 
-    with engine.connect() as connection:
-        context = MigrationContext.configure(connection)
-        migrations = produce_migrations(context, metadata)
-        operations = Operations(context)
-
-        if not len(migrations.upgrade_ops.ops):
-            # No database schema changes detected
-            return
-
-        stack = [migrations.upgrade_ops]
-        use_batch = engine.name == "sqlite"
-        while stack:
-            elem = stack.pop(0)
-
-            if use_batch and isinstance(elem, ModifyTableOps):
-                with operations.batch_alter_table(elem.table_name, schema=elem.schema) as batch_ops:
-                    for table_elem in elem.ops:
-                        batch_ops.invoke(table_elem)
-
-            elif hasattr(elem, "ops"):
-                stack.extend(elem.ops)
-            else:
-                operations.invoke(elem)
-        connection.commit()
+    context = MigrationContext.configure(connection)
+    migrations = produce_migrations(context, metadata)
+    operations = Operations(context)
+
+    if not len(migrations.upgrade_ops.ops):
+        # No database schema changes detected
+        return
+
+    stack = [migrations.upgrade_ops]
+    use_batch = connection.dialect.name == "sqlite"
+    while stack:
+        elem = stack.pop(0)
+
+        if use_batch and isinstance(elem, ModifyTableOps):
+            with operations.batch_alter_table(elem.table_name, schema=elem.schema) as batch_ops:
+                for table_elem in elem.ops:
+                    batch_ops.invoke(table_elem)
+
+        elif hasattr(elem, "ops"):
+            stack.extend(elem.ops)
+        else:
+            operations.invoke(elem)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Compare the codecs available to FileSystemStorage: write time, size on disk and read throughput.
+
+Usage: python bin/benchmark_codecs.py [rows] [layout]
+"""
+
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from anymodel import Entity, Field, Mapper
+from anymodel.storages.codecs import CompressedCodec, JsonCodec, PickleCodec, SchemaCodec
+from anymodel.storages.filesystem import FileSystemStorage
+
+
+class Note(Entity):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    contact_id: int = Field(index=True)
+    text: str = ""
+    created_at: Optional[datetime] = None
+    tags: list[str] = []
+
+
+CODECS = {
+    "pickle": PickleCodec(),
+    "json": JsonCodec(),
+    "schema": SchemaCodec(),
+    "pickle+zlib": CompressedCodec(PickleCodec()),
+    "json+zlib": CompressedCodec(JsonCodec()),
+    "schema+zlib": CompressedCodec(SchemaCodec()),
+    "schema+lzma": CompressedCodec(SchemaCodec(), "lzma"),
+}
+
+
+def get_notes(count: int) -> list[Note]:
+    start = datetime(2024, 1, 1)
+    return [
+        Note(
+            id=i + 1,
+            contact_id=i % 100,
+            text=f"Call #{i} with the customer, discussed the renewal of contract {i % 37} and next steps. "
+            * (1 + i % 4),
+            created_at=start + timedelta(minutes=i),
+            tags=["call", "renewal"] if i % 2 else ["email"],
+        )
+        for i in range(count)
+    ]
+
+
+def get_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file() and not p.name.startswith(".index"))
+
+
+def run(name: str, codec, count: int, layout: str):
+    with tempfile.TemporaryDirectory() as path:
+        storage = FileSystemStorage(path, layout=layout, index=False, codec=codec)
+        mapper = Mapper(Note, storage=storage)
+
+        notes = get_notes(count)
+        started = time.perf_counter()
+        mapper.save_many(notes)
+        write = time.perf_counter() - started
+
+        started = time.perf_counter()
+        rows = sum(1 for _ in storage.find_all(mapper.__tablename__))
+        read = time.perf_counter() - started
+        assert rows == count
+
+        size = get_size(Path(path))
+        storage.close()
+
+    print(f"{name:<14} {write:>8.3f}s {size / 1024:>10.1f}KiB {size / count:>8.1f}B/row {count / read:>12,.0f}rows/s")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    layout = sys.argv[2] if len(sys.argv) > 2 else "segments"
+    print(f"{count} rows, {layout} layout")
+    print(f"{'codec':<14} {'write':>9} {'size':>13} {'':>13} {'read':>19}")
+    for name, codec in CODECS.items():
+        run(name, codec, count, layout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Compare the throughput of building entities from storage rows: model_construct followed by setting the mapping
+state (as mappers used to), and the hydrator compiled by the mapper. Hydration alone, then a full ``find`` on a
+memory storage (without identity map, so that every row is hydrated).
+
+Usage: PYTHONPATH=. python bin/benchmark_hydration.py [rows]
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from anymodel import Entity, Field, Mapper
+from anymodel.storages.memory import MemoryStorage
+from anymodel.types.mappings import Identity
+
+
+class Note(Entity):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    contact_id: int = Field(index=True)
+    text: str = ""
+    created_at: Optional[datetime] = None
+    tags: list[str] = []
+    pinned: bool = False
+
+
+def get_notes(count: int) -> list[Note]:
+    start = datetime(2024, 1, 1)
+    return [
+        Note(
+            id=i + 1,
+            contact_id=i % 100,
+            text=f"Call #{i} with the customer.",
+            created_at=start + timedelta(minutes=i),
+            tags=["call", "renewal"] if i % 2 else ["email"],
+            pinned=not i % 10,
+        )
+        for i in range(count)
+    ]
+
+
+def construct(row, identity, relations=None, *, store=None):
+    """Hydration as mappers did it before compiling a hydrator."""
+    entity = Note.model_construct(**row, **(relations or {}))
+    entity.__state__.store = store
+    entity.__state__.identity = identity
+    entity.__state__.set_clean({k: entity.__dict__[k] for k in Note.model_fields if k in row})
+    return entity
+
+
+def measure(function, count: int, repeat: int = 3) -> float:
+    """Best rows/s of a few runs."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    storage = MemoryStorage()
+    mapper = Mapper(Note, storage=storage)
+    mapper.save_many(get_notes(count))
+    rows = list(storage.find_many(mapper.__tablename__, {}))
+    identities = [Identity.of(row, mapper.primary_key) for row in rows]
+    hydrator = mapper._hydrator
+
+    # both give the same clean entities
+    for row, identity in zip(rows[:100], identities):
+        before, after = construct(row, identity), hydrator(row, identity)
+        assert before.model_dump() == after.model_dump() and before.__dict__.keys() == after.__dict__.keys()
+        assert before.__state__.identity == after.__state__.identity and after.__state__.clean
+
+    results = {}
+    for name, hydrate in (("model_construct", construct), ("hydrator", hydrator)):
+        mapper._hydrator = hydrate
+        results[name] = (
+            measure(lambda hydrate=hydrate: sum(1 for row, i in zip(rows, identities) if hydrate(row, i)), count),
+            measure(lambda: sum(1 for _ in mapper.find()), count),
+        )
+
+    print(f"{count} rows")
+    print(f"{'':<16} {'hydration':>16} {'find':>16}")
+    for name, (hydration, find) in results.items():
+        print(f"{name:<16} {hydration:>11,.0f}rows/s {find:>11,.0f}rows/s")
+    (before_hydration, before_find), (after_hydration, after_find) = results.values()
+    print(f"{'speedup':<16} {after_hydration / before_hydration:>15.2f}x {after_find / before_find:>15.2f}x")
+
+
+if __name__ == "__main__":
+    main()
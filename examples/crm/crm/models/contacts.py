@@ -1,7 +1,7 @@
 from typing import Optional, List
 
 from anymodel.types.entity import Entity
-from anymodel.mapper import Mapper
+from anymodel.mapper import AsyncMapper
 
 
 class Contact(Entity):
@@ -15,7 +15,7 @@ class Contact(Entity):
     notes: List[str] = ""
 
 
-class ContactMapper(Mapper[Contact]):
+class ContactMapper(AsyncMapper[Contact]):
     fields = {
         "first_name": ...,
         "last_name": ...,
@@ -20,27 +20,27 @@ class ContactsViewSet:
         ]
 
     async def get(self, request):
-        contact = self.mapper.find_one_by_pk(request.path_params["id"])
+        contact = await self.mapper.find_one_by_pk(request.path_params["id"])
         if contact is None:
             return JSONResponse({"error": "Not found."}, status_code=404)
         return JSONResponse(contact.model_dump(exclude_none=True))
 
     async def list(self, request):
         output = []
-        for contact in self.mapper.find():
+        async for contact in self.mapper.find():
             output.append(contact.model_dump(exclude_none=True))
         return JSONResponse(output)
 
     async def create(self, request):
         data = await request.json()
-        contact = self.mapper.save(self.mapper.__type__(**data))
+        contact = await self.mapper.save(self.mapper.__type__(**data))
         return JSONResponse(contact.model_dump(exclude_none=True))
 
     async def update(self, request):
         data = await request.json()
-        contact = self.mapper.get(request.path_params["id"])
+        contact = await self.mapper.find_one_by_pk(request.path_params["id"])
         if contact is None:
             return JSONResponse({"error": "Not found."}, status_code=404)
         contact = contact.model_copy(update=data)
-        contact = self.mapper.save(contact)
+        contact = await self.mapper.save(contact)
         return JSONResponse(contact.model_dump(exclude_none=True))
@@ -1,6 +1,7 @@
+from datetime import datetime
 from typing import Optional
 
-from anymodel import Entity, Field
+from anymodel import Collection, Entity, Field
 
 
 class Hero(Entity):
@@ -11,3 +12,45 @@ class Hero(Entity):
 class SuperPower(Entity):
     id: Optional[int] = Field(None, primary_key=True)
     name: str
+
+
+class Contact(Entity):
+    id: Optional[int] = Field(None, primary_key=True)
+    email: str = Field(unique=True)
+    company: str = Field("", index=True)
+    city: str = ""
+
+
+class Article(Entity):
+    id: Optional[int] = Field(None, primary_key=True)
+    title: str
+    category: str = Field("", index=True)
+    published: Optional[int] = Field(None, index=True)
+    views: int = 0
+
+
+class Note(Entity):
+    id: Optional[int] = Field(None, primary_key=True)
+    contact_id: Optional[int] = Field(None, index=True)
+    text: str = ""
+    created_at: Optional[datetime] = None
+    tags: list[str] = []
+
+
+class Team(Entity):
+    id: Optional[int] = Field(None, primary_key=True)
+    name: str
+    members: Collection = []
+
+
+class Member(Entity):
+    id: Optional[int] = Field(None, primary_key=True)
+    team_id: Optional[int] = Field(None, index=True)
+    name: str
+
+
+class Node(Entity):
+    id: Optional[int] = Field(None, primary_key=True)
+    node_id: Optional[int] = Field(None, index=True)
+    name: str
+    children: Collection = []
@@ -0,0 +1,220 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from anymodel import AsyncMapper, Collection, OneToManyRelation
+from anymodel.storages.filesystem import AsyncFileSystemStorage
+from anymodel.storages.memory import AsyncMemoryStorage
+from anymodel.storages.sqlalchemy import AsyncSqlAlchemyStorage
+from anymodel.utilities.identity_map import IdentityMap
+from anymodel.utilities.loaders import BatchLoader
+from ._models import Contact, Hero, Member, Team
+
+
+@pytest.fixture(params=["memory", "filesystem", "sqlalchemy"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        return AsyncMemoryStorage()
+    if request.param == "filesystem":
+        return AsyncFileSystemStorage(tmp_path)
+    return AsyncSqlAlchemyStorage(f"sqlite+aiosqlite:///{tmp_path}/db.sqlite")
+
+
+def test_mapper(storage, monkeypatch):
+    calls = []
+    update_many = storage.update_many
+    monkeypatch.setattr(storage, "update_many", lambda *args: calls.append(args) or update_many(*args))
+
+    async def main():
+        mapper = AsyncMapper(Hero, storage=storage, cache=IdentityMap())
+        await storage.migrate()
+
+        heroes = await mapper.save_many([Hero(id=1, name="Superman"), Hero(id=2, name="Batman")])
+        assert all(hero.__state__ == {"clean"} for hero in heroes)
+        assert await mapper.find_one_by_pk(2) is heroes[1]
+
+        # changes of stored entities are written with one call, along with the insertion of new ones
+        heroes[0].name, heroes[1].name = "Kal-El", "Bruce"
+        await mapper.save_many([*heroes, Hero(id=4, name="Robin")])
+        assert len(calls) == 1 and len(calls[0][1]) == 2 and all(hero.__state__ == {"clean"} for hero in heroes)
+        await mapper.delete(await mapper.find_one_by_pk(4))
+
+        heroes[0].name = "Uberman"
+        await mapper.save(heroes[0])
+        await mapper.save(Hero(id=3, name="Flash"))
+        assert [hero.name async for hero in mapper.find()] == ["Uberman", "Bruce", "Flash"]
+        assert [hero.id async for hero in mapper.find(name="Flash")] == [3]
+
+        await mapper.delete(heroes[1])
+        assert heroes[1].__state__.transient
+        assert [hero.name async for hero in mapper.find()] == ["Uberman", "Flash"]
+
+    asyncio.run(main())
+
+
+def test_batched_lookups(storage, monkeypatch):
+    mapper = AsyncMapper(Hero, storage=storage, cache=IdentityMap())
+    mapper.lookup_batch_delay = 0
+    queries = []
+    find_by_identities = storage.find_by_identities
+    monkeypatch.setattr(storage, "find_by_identities", lambda *args: queries.append(args) or find_by_identities(*args))
+
+    async def main():
+        await storage.migrate()
+        await mapper.save_many([Hero(id=1, name="Superman"), Hero(id=2, name="Batman")])
+
+        # concurrent lookups are resolved with one query, each primary key once
+        found = await asyncio.gather(*(mapper.find_one_by_pk(pk) for pk in [1, 2, 1, 3]))
+        assert [hero and hero.name for hero in found] == ["Superman", "Batman", "Superman", None]
+        assert found[0] is found[2] is await mapper.find_one_by_pk(1)
+        assert len(queries) == 1
+
+        # sequential ones get a query each
+        found = [await mapper.find_one_by_pk(3), await mapper.find_one_by_pk(4)]
+        assert found == [None, None] and len(queries) == 3
+
+    asyncio.run(main())
+
+
+def test_batch_loader():
+    batches = []
+
+    async def load_many(keys):
+        batches.append(keys)
+        if "error" in keys:
+            raise KeyError("error")
+        return [key.upper() for key in keys]
+
+    async def main():
+        loader = BatchLoader(load_many, delay=0.01, max_batch_size=2)
+        first = asyncio.create_task(loader.load("a"))
+        await asyncio.sleep(0)
+        assert await asyncio.gather(first, loader.load("b"), loader.load("a"), loader.load("c")) == ["A", "B", "A", "C"]
+        assert batches == [["a", "b"], ["c"]]
+
+        # errors are raised to every lookup of the batch
+        results = await asyncio.gather(loader.load("d"), loader.load("error"), return_exceptions=True)
+        assert all(isinstance(result, KeyError) for result in results)
+
+        # lookups of a cancelled load are cancelled too, instead of waiting forever
+        loads = []
+
+        async def load_forever(keys):
+            loads.append(asyncio.current_task())
+            await asyncio.Event().wait()
+
+        loader.load_many = load_forever
+        lookup = asyncio.create_task(loader.load("e"))
+        while not loads:
+            await asyncio.sleep(0.01)
+        loads[0].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(lookup, 1)
+        loader.load_many = load_many
+        assert await loader.load("e") == "E"
+
+    asyncio.run(main())
+
+
+def test_sqlalchemy_storage(tmp_path):
+    storage = AsyncSqlAlchemyStorage(f"sqlite+aiosqlite:///{tmp_path}/db.sqlite")
+    mapper = AsyncMapper(Contact, storage=storage)
+
+    async def main():
+        await storage.migrate()
+        contact = await mapper.save(Contact(email="clark@example.com", company="Daily Planet"))
+        assert contact.id == 1
+
+        found = await mapper.find_one_by_pk(1)
+        assert (found.email, found.company, found.__state__) == ("clark@example.com", "Daily Planet", {"clean"})
+
+        # deferred fields are loaded explicitly
+        found = await mapper.find_one_by_pk(1, only=["email"])
+        with pytest.raises(RuntimeError):
+            found.company
+        assert (await mapper.undefer(found)).company == "Daily Planet"
+        assert found.__state__ == {"clean"}
+
+        # transaction blocks commit once, or rollback everything
+        with pytest.raises(IntegrityError):
+            async with mapper.transaction():
+                await mapper.save(Contact(email="lois@example.com"))
+                await mapper.save(Contact(email="clark@example.com"))
+        assert [contact.email async for contact in mapper.find()] == ["clark@example.com"]
+
+        # concurrent tasks each get their own connection
+        await asyncio.gather(*(mapper.save(Contact(email=f"reader{i}@example.com")) for i in range(5)))
+        assert len([contact async for contact in mapper.find()]) == 6
+
+        # streamed results, paginated with a cursor
+        with storage.streaming(chunk_size=2):
+            page = [contact async for contact in mapper.find(order_by="-email", limit=4)]
+            after = mapper.cursor(page[-1], "-email")
+            assert [contact.email async for contact in mapper.find(order_by="-email", after=after)] == [
+                "reader0@example.com",
+                "clark@example.com",
+            ]
+        await storage.engine.dispose()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("strategy", ["lazy", "selectin", "joined"])
+def test_relations(tmp_path, strategy):
+    storage = AsyncSqlAlchemyStorage(f"sqlite+aiosqlite:///{tmp_path}/db.sqlite")
+    members = AsyncMapper(Member, storage=storage)
+    teams = AsyncMapper(Team, storage=storage, relations={"members": OneToManyRelation(members, strategy=strategy)})
+
+    async def main():
+        await storage.migrate()
+        await teams.save(Team(name="JLA", members=[Member(name="Superman"), Member(name="Batman")]))
+        await teams.save(Team(name="Outsiders"))
+
+        found = [team async for team in teams.find()]
+        for team in found:
+            await team.members.aload()
+        assert [[member.name for member in team.members] for team in found] == [["Superman", "Batman"], []]
+
+        jla = await teams.find_one_by_pk(1)
+        assert [member.name for member in await jla.members.aload()] == ["Superman", "Batman"]
+        await storage.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_paged_relations(storage):
+    members = AsyncMapper(Member, storage=storage)
+    teams = AsyncMapper(Team, storage=storage, relations={"members": OneToManyRelation(members, page_size=2)})
+
+    async def main():
+        await storage.migrate()
+        await teams.save(Team(id=1, name="JLA", members=[Member(id=i, name=f"Member {i}") for i in range(1, 6)]))
+
+        team = await teams.find_one_by_pk(1)
+        with pytest.raises(RuntimeError):
+            len(team.members)
+        assert await team.members.acount() == 5 and len(team.members) == 5
+        assert [member.name async for member in team.members] == [f"Member {i}" for i in range(1, 6)]
+        assert not team.members.loaded
+
+    asyncio.run(main())
+
+
+def test_collection_aload():
+    async def find():
+        yield "Superman"
+        yield "Batman"
+
+    async def fetch():
+        return ["Flash"]
+
+    async def main():
+        assert list(await Collection(find).aload()) == ["Superman", "Batman"]
+        assert list(await Collection(fetch).aload()) == ["Flash"]
+        assert list(await Collection(lambda: ["Robin"]).aload()) == ["Robin"]
+
+    asyncio.run(main())
+
+    with pytest.raises(RuntimeError):
+        len(Collection(find))
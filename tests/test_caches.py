@@ -0,0 +1,85 @@
+import pytest
+
+from anymodel.utilities import caches
+from anymodel.utilities.caches import BoundedCache, SqliteCache
+
+
+def test_lru():
+    cache = BoundedCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts b, the least recently used
+    assert ("a" in cache, "b" in cache, "c" in cache) == (True, False, True)
+    assert cache.get("b", "missing") == "missing"
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.evictions) == (1, 1, 1)
+    assert cache.stats.hit_rate == 0.5
+
+    # versions are not counted, nor evicted
+    cache.set_version("v", 1)
+    cache.set("d", 4)
+    assert (cache.get_version("v"), len(cache), cache.stats.hits, cache.stats.evictions) == (1, 2, 1, 2)
+
+    cache.delete("d")
+    assert len(cache) == 1
+    cache.clear()
+    assert (len(cache), cache.get_version("v")) == (0, None)
+
+
+def test_lfu():
+    cache = BoundedCache(max_entries=3, policy="lfu")
+    for key in "abc":
+        cache.set(key, key)
+    for key in "aab":
+        cache.get(key)
+    cache.set("d", "d")  # evicts c, never used
+    cache.set("e", "e")  # evicts d, the least recently used of the least used entries
+    assert sorted(k for k in "abcde" if k in cache) == ["a", "b", "e"]
+
+    with pytest.raises(ValueError):
+        BoundedCache(policy="fifo")
+
+
+def test_max_bytes():
+    cache = BoundedCache(max_bytes=1000, sizeof=len)
+    cache.set("a", "x" * 600)
+    cache.set("b", "x" * 300)
+    cache.set("c", "x" * 200)  # evicts a
+    assert (cache.size, len(cache)) == (500, 2)
+    cache.set("d", "x" * 2000)  # too large to be cached
+    assert ("d" in cache, cache.size) == (False, 500)
+
+
+def test_ttl(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr(caches.time, "monotonic", lambda: now)
+    cache = BoundedCache(ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=60)
+    now = 130.0
+    assert (cache.get("a"), cache.get("b")) == (None, 2)
+    assert (cache.stats.expirations, len(cache)) == (1, 1)
+
+
+def test_sqlite_cache(tmp_path, monkeypatch):
+    cache, other = SqliteCache(tmp_path / "cache.sqlite", max_entries=2), SqliteCache(tmp_path / "cache.sqlite")
+    cache.set("a", {"id": 1})
+    assert other.get("a") == {"id": 1}  # shared by the processes using the file
+    cache.set("b", [1, 2], ttl=10)
+    cache.set("c", None)
+    assert (len(cache), cache.get("a", "missing"), cache.stats.evictions) == (2, "missing", 1)
+
+    now = caches.time.time()
+    monkeypatch.setattr(caches.time, "time", lambda: now + 60)
+    assert (cache.get("b"), cache.stats.expirations) == (None, 1)
+    cache.delete("c")
+    assert len(cache) == 0
+
+    # versions are shared too, and are not counted, nor evicted
+    other.set_version("v", 1)
+    cache.set("d", 4)
+    cache.set("e", 5)
+    cache.set("f", 6)
+    assert (cache.get_version("v"), cache.stats.hits, cache.stats.misses) == (1, 0, 2)
+    cache.close()
+    other.close()
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import event
+
+from anymodel import Mapper
+from anymodel.storages.caching import CachingStorage
+from anymodel.storages.sqlalchemy import SqlAlchemyStorage
+from anymodel.types.queries import Predicate, field, ge
+from anymodel.utilities.caches import BoundedCache, SqliteCache
+from ._models import Contact
+
+
+class Any(Predicate):
+    def __call__(self, value) -> bool:
+        return True
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        return BoundedCache(max_entries=100)
+    return SqliteCache(tmp_path / "cache.sqlite")
+
+
+def test_caching_storage(cache):
+    backend = SqlAlchemyStorage("sqlite:///:memory:")
+    storage = CachingStorage(backend, cache)
+    mapper = Mapper(Contact, storage=storage)
+    storage.migrate()
+    mapper.save_many(
+        [
+            Contact(email="clark@example.com", company="Daily Planet"),
+            Contact(email="lois@example.com", company="Daily Planet"),
+            Contact(email="bruce@example.com", company="Wayne Enterprises"),
+        ]
+    )
+
+    statements = []
+    event.listen(backend.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    cache.stats.reset()
+
+    def emails(*expressions, **criteria):
+        return [contact.email for contact in mapper.find(*expressions, **criteria)]
+
+    # queries are cached by normalized criteria (equivalent criteria share entries), rows by primary key
+    assert emails(company="Daily Planet", order_by="-email") == ["lois@example.com", "clark@example.com"]
+    assert (cache.stats.hits, cache.stats.misses) == (0, 1)  # the query, but not the generations of the table
+    assert emails(company="Daily Planet", order_by="-email") == ["lois@example.com", "clark@example.com"]
+    assert emails(field("company") == "Daily Planet", order_by="-email") == ["lois@example.com", "clark@example.com"]
+    assert emails(id=ge(2), company="Daily Planet") == ["lois@example.com"]
+    assert emails(company="Daily Planet", id=ge(2)) == ["lois@example.com"]
+    assert mapper.find_one_by_pk(2).email == "lois@example.com"
+    assert [contact.email for contact in mapper.find(only=["email"], company="Daily Planet")] == [
+        "clark@example.com",
+        "lois@example.com",
+    ]
+    assert len(statements) == 3
+    assert (storage.stats.hits, storage.stats.misses) == (4, 3)
+
+    # writes invalidate the queries of the table and the rows they change
+    lois = mapper.find_one_by_pk(2)
+    lois.company = "Wayne Enterprises"
+    mapper.save(lois)
+    statements.clear()
+    assert emails(company="Daily Planet") == ["clark@example.com"]
+    assert mapper.find_one_by_pk(2).company == "Wayne Enterprises"
+    assert len(statements) == 2
+    mapper.delete(mapper.find_one_by_pk(1))
+    assert emails(company="Daily Planet") == []
+
+    # criteria that cannot be normalized, and transactions, bypass the cache
+    statements.clear()
+    assert len(emails(company=Any())) == 2
+    assert len(emails(company=Any())) == 2
+    with storage.transaction():
+        assert mapper.find_one_by_pk(2).email == "lois@example.com"
+    assert len(statements) == 3
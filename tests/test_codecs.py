@@ -0,0 +1,67 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+from anymodel import Mapper, MemoryStorage
+from anymodel.storages.codecs import CompressedCodec, JsonCodec, PickleCodec, SchemaCodec
+from anymodel.storages.filesystem import FileSystemStorage
+
+from ._models import Note
+
+ROW = {
+    "id": 42,
+    "contact_id": -7,
+    "text": "Called about the renewal. " * 20,
+    "created_at": datetime(2024, 12, 7, 14, 30),
+    "tags": ["renewal", "phone"],
+}
+
+CODECS = [
+    PickleCodec(),
+    JsonCodec(),
+    SchemaCodec(),
+    CompressedCodec(SchemaCodec()),
+    CompressedCodec(JsonCodec(), "lzma"),
+]
+
+
+@pytest.fixture
+def mapper():
+    return Mapper(Note, storage=MemoryStorage())
+
+
+@pytest.mark.parametrize("codec", CODECS, ids=lambda codec: type(codec).__name__)
+def test_roundtrip(codec, mapper):
+    codec = codec.bind(mapper)
+    assert codec.decode(codec.encode(ROW)) == ROW
+
+    # rows may be partial, or hold fields the mapper does not know about
+    assert codec.decode(codec.encode({"id": 1, "created_at": None})) == {"id": 1, "created_at": None}
+    assert codec.decode(codec.encode({"id": 1, "extra": [1, "2"]})) == {"id": 1, "extra": [1, "2"]}
+
+
+def test_schema_codec_values():
+    values = [None, True, False, 0, -1, 2**70, -(2**70), 1.5, "", "é", b"\x00", date(2024, 1, 1), Decimal("1.1")]
+    values += [[1, [2, None]], {"a": {"b": 1}}, {1: "non string keys"}]
+    codec = SchemaCodec()
+    for value in values:
+        assert codec.decode(codec.encode({"value": value})) == {"value": value}
+
+
+def test_schema_codec_is_compact(mapper):
+    row = {**ROW, "text": "Call back."}
+    assert len(SchemaCodec().bind(mapper).encode(row)) < len(SchemaCodec().encode(row)) < len(PickleCodec().encode(row))
+    assert len(CompressedCodec(SchemaCodec()).encode(ROW)) < len(SchemaCodec().encode(ROW)) / 4
+
+
+def test_storage_codecs(tmp_path):
+    storage = FileSystemStorage(tmp_path, layout="segments", codec=JsonCodec(), codecs={"note": SchemaCodec()})
+    mapper = Mapper(Note, storage=storage)
+    mapper.save(Note(**ROW))
+    storage.insert("contact", {"id": 1, "name": "Clark"})
+
+    assert isinstance(storage._get_codec("note"), SchemaCodec) and storage._get_codec("note").fields
+    assert storage.find_one("note", {"id": 42}) == ROW
+    assert storage.find_one("contact", {"id": 1}) == {"id": 1, "name": "Clark"}
+    assert [note.text for note in mapper.find(contact_id=-7)] == [ROW["text"]]
@@ -1,7 +1,11 @@
+import pickle
 from unittest.mock import Mock
 
+from anymodel.types.collections import Collection
+from anymodel.types.entity import Hydrator
+from anymodel.types.mappings import Identity
 from anymodel.types.utils import mapper
-from ._models import Hero
+from ._models import Hero, Note, Team
 
 
 def test_modified_fields():
@@ -31,6 +35,13 @@ def test_identity():
     assert hero.__state__.identity == {"id": 42}
     assert hero.id == 42  # identity setter updates the entity
 
+    # identities are typed, hashable values
+    identity = hero.__state__.identity
+    assert isinstance(identity, Identity) and identity.key == (42,)
+    assert identity == Identity.of({"id": 42, "name": "Superman"}, ("id",)) and identity != Identity({"id": "42"})
+    assert {identity: hero}[Identity({"id": 42})] is hero
+    assert pickle.loads(pickle.dumps(identity)) == identity
+
     hero.__state__.detach()
     assert hero.__state__.identity is None
 
@@ -43,3 +54,18 @@ def test_mapper():
     hero.__mapper__ = mock_mapper
 
     assert mapper(hero) is mock_mapper
+
+
+def test_hydrator():
+    row = {"id": 1, "tags": ["call"], "unknown": True}
+    note = Hydrator(Note)(row, Identity.of(row, ("id",)), store="short")
+
+    # same entity as model_construct gives, clean, with its identity kept as given
+    assert note == Note.model_construct(id=1, tags=["call"]) and note.__pydantic_fields_set__ == set()
+    assert note.__state__.identity.key == (1,) and note.__state__.store == "short" and note.__state__.clean
+    note.tags.append("email")
+    assert note.__state__.changes() == {"tags": ["call", "email"]}
+
+    members = Collection([])
+    team = Hydrator(Team, ["members"])({"id": 2, "name": "JLA"}, Identity({"id": 2}), {"members": members})
+    assert team.members is members and list(team.__dict__) == ["id", "name", "members", "__state__"]
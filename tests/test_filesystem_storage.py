@@ -0,0 +1,213 @@
+import os
+import pickle
+import threading
+
+import pytest
+
+from anymodel import Mapper, MemoryStorage
+from anymodel.storages.filesystem import FileSystemStorage
+from anymodel.storages.layouts import GroupCommit, SegmentLayout, TreeLayout
+from anymodel.storages.short_long import ShortLongStorage
+from anymodel.types.queries import ge
+from ._models import Article
+
+
+@pytest.fixture(params=["tree", "segments"])
+def storage(request, tmp_path):
+    storage = FileSystemStorage(tmp_path, layout=request.param)
+    Mapper(Article, storage=storage)
+    storage.insert_many(
+        "article",
+        [
+            {"id": 1, "title": "Intro", "category": "news", "published": 3, "views": 10},
+            {"id": 2, "title": "Draft", "category": "news", "published": None, "views": 0},
+            {"id": 3, "title": "Release", "category": "blog", "published": 1, "views": 30},
+            {"id": 4, "title": "Recap", "category": "blog", "published": 5, "views": 20},
+        ],
+    )
+    return storage
+
+
+def titles(rows):
+    return [row["title"] for row in rows]
+
+
+def test_find_many(storage):
+    assert titles(storage.find_many("article", {})) == ["Intro", "Draft", "Release", "Recap"]
+    assert titles(storage.find_many("article", {"category": "news"})) == ["Intro", "Draft"]
+    assert titles(storage.find_many("article", {"category": "blog", "views": 20})) == ["Recap"]
+    assert titles(storage.find_many("article", {"published": ge(3)}, order_by="-published")) == ["Recap", "Intro"]
+    assert titles(storage.find_many("article", {}, order_by="published", limit=2, offset=1)) == ["Intro", "Recap"]
+    assert titles(storage.find_many("article", {}, order_by="-views", limit=2)) == ["Release", "Recap"]
+    assert storage.find_one("article", {"title": "Release"})["id"] == 3
+    assert storage.find_one("article", {"category": "sports"}) is None
+
+
+def test_find_many_reads_only_matching_rows(storage, monkeypatch):
+    reads = []
+    read = storage._read
+    monkeypatch.setattr(storage, "_read", lambda *args: reads.append(args) or read(*args))
+
+    assert titles(storage.find_many("article", {"category": "blog"})) == ["Release", "Recap"]
+    assert len(reads) == 2
+
+
+def test_index_is_persistent(storage, tmp_path):
+    storage.delete("article", {"id": 1})
+    storage.close()
+
+    reopened = FileSystemStorage(tmp_path, layout=type(storage.layout)(tmp_path))
+    Mapper(Article, storage=reopened)
+    assert titles(reopened.find_many("article", {"category": "news"})) == ["Draft"]
+    assert len(list(reopened.find_all("article"))) == 3
+
+
+def test_update(storage):
+    storage.update("article", {"id": 2}, {"title": "Published", "published": 6})
+    assert storage.find_one("article", {"id": 2}) == {
+        "id": 2,
+        "title": "Published",
+        "category": "news",
+        "published": 6,
+        "views": 0,
+    }
+    assert titles(storage.find_many("article", {"published": ge(5)})) == ["Recap", "Published"]
+    with pytest.raises(ValueError):
+        storage.update("article", {"id": 42}, {"title": "Missing"})
+
+
+def test_without_index(tmp_path):
+    storage = FileSystemStorage(tmp_path, index=False)
+    storage.insert("article", {"id": 1, "title": "Intro"})
+    assert storage.find_one("article", {"id": 1})["title"] == "Intro"
+    with pytest.raises(NotImplementedError):
+        list(storage.find_many("article", {}))
+
+
+def test_segments(tmp_path):
+    storage = FileSystemStorage(
+        tmp_path, layout=SegmentLayout(tmp_path, max_segment_size=100, compaction_threshold=None)
+    )
+    storage.insert_many("hero", [{"id": i, "name": f"Hero #{i}"} for i in range(1, 4)])
+    storage.insert_many("villain", [{"id": i, "name": f"Villain #{i}"} for i in range(1, 3)])
+    for i in range(1, 4):
+        storage.update("hero", {"id": i}, {"name": f"Super hero #{i}"})
+    storage.delete("hero", {"id": 3})
+
+    # tables do not collide, and each table has its own segment files
+    assert [row["name"] for row in storage.find_all("hero")] == ["Super hero #1", "Super hero #2"]
+    assert [row["name"] for row in storage.find_all("villain")] == ["Villain #1", "Villain #2"]
+    assert len(list((tmp_path / "hero").glob("*.log"))) > 1
+    storage.close()
+
+    # the directory is rebuilt from the segments, a torn record at the end of a segment is ignored
+    last_segment = sorted((tmp_path / "hero").glob("*.log"))[-1]
+    with open(last_segment, "ab") as f:
+        f.write(b"torn record")
+    layout = SegmentLayout(tmp_path, max_segment_size=100, compaction_threshold=None)
+    assert [pickle.loads(data)["name"] for data in layout.scan("hero")] == ["Super hero #1", "Super hero #2"]
+    assert os.path.getsize(last_segment) == layout._sizes["hero", int(last_segment.stem)]
+
+    # compaction removes dead records, and keeps the live ones (deleted rows do not come back)
+    size = sum(os.path.getsize(f) for f in (tmp_path / "hero").glob("*.log"))
+    layout.compact()
+    assert sum(os.path.getsize(f) for f in (tmp_path / "hero").glob("*.log")) < size
+    layout.close()
+
+    layout = SegmentLayout(tmp_path)
+    assert [pickle.loads(data)["name"] for data in layout.scan("hero")] == ["Super hero #1", "Super hero #2"]
+    assert layout.read("hero", "3") is None
+    layout.close()
+
+
+def test_segments_background_compaction(tmp_path):
+    layout = SegmentLayout(tmp_path, max_segment_size=1000, compaction_threshold=0.5)
+    for i in range(100):
+        layout.write_many("counter", [("1", pickle.dumps({"id": 1, "value": i}))])
+    layout.close()
+
+    assert sum(os.path.getsize(f) for f in (tmp_path / "counter").glob("*.log")) < 3000
+    assert pickle.loads(SegmentLayout(tmp_path).read("counter", "1")) == {"id": 1, "value": 99}
+
+
+def test_tree_writes_are_atomic(tmp_path, monkeypatch):
+    layout = TreeLayout(tmp_path)
+    layout.write_many("hero", [("1", b"before")])
+
+    def replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", replace)
+    with pytest.raises(OSError):
+        layout.write_many("hero", [("1", b"after")])
+
+    # the row is left untouched, and no temporary file is left behind
+    assert layout.read("hero", "1") == b"before"
+    assert [f.name for f in tmp_path.rglob("*") if f.is_file()] == ["1"]
+
+
+@pytest.mark.parametrize("layout", ["tree", "segments"])
+@pytest.mark.parametrize("durability", ["none", "fsync", "group"])
+def test_durability(tmp_path, monkeypatch, layout, durability):
+    syncs = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: syncs.append(fd) or fsync(fd))
+
+    storage = FileSystemStorage(tmp_path, layout=layout, durability=durability)
+    storage.insert("hero", {"id": 1, "name": "Superman"})
+    storage.update("hero", {"id": 1}, {"name": "Clark Kent"})
+    storage.delete("hero", {"id": 1})
+    assert storage.find_one("hero", {"id": 1}) is None
+    assert bool(syncs) is (durability != "none")
+
+    with pytest.raises(ValueError):
+        FileSystemStorage(tmp_path, layout=layout, durability="sometimes")
+
+
+def test_group_commit():
+    group_commit = GroupCommit(delay=0.05)
+    synced, barrier = [], threading.Barrier(8)
+
+    def write(i):
+        barrier.wait()
+        group_commit.sync({"segment": lambda: synced.append(i)})
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # requests are batched, and deduplicated by key within a batch
+    assert 1 <= len(synced) < 8
+
+    def fail():
+        raise OSError("I/O error")
+
+    with pytest.raises(OSError):
+        group_commit.sync({"segment": fail})
+
+
+def test_as_unindexed_long_storage(tmp_path):
+    long_storage = FileSystemStorage(tmp_path, index=False)
+    storage = ShortLongStorage(MemoryStorage(), long_storage)
+    storage.short_storage.insert("article", {"id": 5, "title": "Launch", "category": "news"})
+    long_storage.insert("article", {"id": 1, "title": "Intro", "category": "news"})
+
+    # the tree layout cannot be queried without an index, only the short storage is
+    assert not long_storage.supports_queries
+    assert titles(storage.find_many("article", {"category": "news"})) == ["Launch"]
+    assert storage.find_one("article", {"id": 1})["title"] == "Intro"
+
+
+def test_as_long_storage(storage):
+    short_storage = MemoryStorage()
+    storage = ShortLongStorage(short_storage, storage)
+    short_storage.insert("article", {"id": 5, "title": "Launch", "category": "news", "published": 4})
+
+    assert titles(storage.find_many("article", {"category": "news"})) == ["Launch", "Intro", "Draft"]
+    assert titles(storage.find_many("article", {}, order_by="-published", limit=3)) == ["Recap", "Launch", "Intro"]
+    assert [row.__metadata__["store"] for row in storage.find_many("article", {"published": ge(4)})] == [
+        "short",
+        "long",
+    ]
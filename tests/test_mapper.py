@@ -1,5 +1,12 @@
-from anymodel import MemoryStorage, Mapper
-from ._models import Hero
+import pytest
+
+from anymodel import MemoryStorage, Mapper, OneToManyRelation
+from anymodel.storages.filesystem import FileSystemStorage
+from anymodel.storages.sqlalchemy import SqlAlchemyStorage
+from anymodel.types.queries import Predicate, field, or_
+from anymodel.utilities.caches import BoundedCache
+from anymodel.utilities.identity_map import IdentityMap
+from ._models import Article, Contact, Hero, Member, Note, Team
 
 
 def test_basics():
@@ -38,3 +45,424 @@ def test_relations():
     hero = Hero(name="Superman")
     assert hero.id is None
     assert hero
+
+
+def test_save_many():
+    storage = MemoryStorage()
+    mapper = Mapper(Hero, cache=IdentityMap(), storage=storage)
+
+    heroes = [Hero(name="Superman"), Hero(name="Batman"), Hero(id=42, name="Wonder Woman")]
+    assert mapper.save_many(heroes) == heroes
+    assert len(storage) == 3
+    assert [hero.id for hero in heroes] == [1, 2, 42]
+    assert all(hero.__state__ == {"clean"} for hero in heroes)
+    assert mapper.find_one_by_pk(2) is heroes[1]
+
+    heroes[0].name = "Uberman"
+    mapper.save_many([heroes[0], Hero(name="Flash")])
+    assert len(storage) == 4
+    assert [hero.name for hero in mapper.find()] == ["Uberman", "Batman", "Wonder Woman", "Flash"]
+
+
+def test_delete():
+    storage = MemoryStorage()
+    mapper = Mapper(Hero, cache=IdentityMap(), storage=storage)
+
+    hero = mapper.save(Hero(name="Superman"))
+    assert mapper.delete(hero) is hero
+    assert hero.__state__.transient
+    assert len(storage) == 0
+    assert mapper.find_one_by_pk(1) is None
+
+    with pytest.raises(ValueError):
+        mapper.delete(hero)
+
+
+def test_find_reuses_identity_mapped_entities():
+    storage = MemoryStorage()
+    mapper = Mapper(Hero, cache=IdentityMap(), storage=storage)
+    superman, batman = mapper.save_many([Hero(name="Superman"), Hero(name="Batman")])
+    storage.update("hero", {"id": 1}, {"name": "Kal-El"})
+    storage.update("hero", {"id": 2}, {"name": "Bruce"})
+    batman.name = "Dark Knight"  # unsaved change
+
+    assert list(mapper.find()) == [superman, batman]
+    assert all(a is b for a, b in zip(mapper.find(), [superman, batman]))
+    assert (superman.name, batman.name) == ("Superman", "Dark Knight")
+
+    list(mapper.find(refresh="refresh_clean"))
+    assert (superman.name, batman.name) == ("Kal-El", "Dark Knight")
+    assert batman.__state__ == {"dirty"}
+
+    list(mapper.find(refresh="overwrite"))
+    assert (superman.name, batman.name) == ("Kal-El", "Bruce")
+    assert batman.__state__ == {"clean"}
+
+    with pytest.raises(ValueError):
+        list(mapper.find(refresh="never"))
+
+
+def test_dirty_checking():
+    storage = MemoryStorage()
+    mapper = Mapper(Note, storage=storage)
+    note = mapper.save(Note(text="Call Clark", tags=["call"]))
+    assert not mapper.is_dirty(note) and mapper.is_dirty(Note())
+
+    # containers modified in place are changes too
+    note.tags.append("urgent")
+    assert note.__state__ == {"dirty"}
+    assert mapper._get_known_modified_values(note) == {"tags": ["call", "urgent"]}
+    mapper.save(note)
+    assert note.__state__ == {"clean"}
+    assert storage.find_one("note", {"id": note.id})["tags"] == ["call", "urgent"]
+
+
+def test_indexes():
+    storage = MemoryStorage()
+    mapper = Mapper(Contact, storage=storage)
+    assert mapper.indexes == {"email": True, "company": False}
+
+    mapper.save_many(
+        [
+            Contact(email="clark@dailyplanet.com", company="Daily Planet", city="Metropolis"),
+            Contact(email="lois@dailyplanet.com", company="Daily Planet", city="Metropolis"),
+            Contact(email="bruce@wayne.com", company="Wayne Enterprises", city="Gotham"),
+        ]
+    )
+
+    def emails(**criteria):
+        return [contact.email for contact in mapper.find(**criteria)]
+
+    assert emails(company="Daily Planet") == ["clark@dailyplanet.com", "lois@dailyplanet.com"]
+    assert emails(company="Daily Planet", email="lois@dailyplanet.com") == ["lois@dailyplanet.com"]
+    assert emails(company="Wayne Enterprises", city="Metropolis") == []
+    assert emails(company="LexCorp") == []
+
+    # indexes follow updates and deletes
+    lois = next(mapper.find(email="lois@dailyplanet.com"))
+    lois.company = "LexCorp"
+    mapper.save(lois)
+    assert emails(company="Daily Planet") == ["clark@dailyplanet.com"]
+    assert emails(company="LexCorp") == ["lois@dailyplanet.com"]
+
+    mapper.delete(lois)
+    assert emails(company="LexCorp") == []
+
+    # unique indexes reject duplicates, but the row can be updated with its own value
+    with pytest.raises(ValueError):
+        mapper.save(Contact(email="bruce@wayne.com"))
+    bruce = next(mapper.find(email="bruce@wayne.com"))
+    bruce.email = "bruce@wayne.com"
+    mapper.save(bruce)
+    assert len(storage) == 2
+
+
+def test_relation_load_strategies(monkeypatch):
+    storage = MemoryStorage()
+    members = Mapper(Member, storage=storage)
+    teams = Mapper(Team, storage=storage, relations={"members": OneToManyRelation(members, strategy="selectin")})
+    teams.eager_batch_size = 2
+    teams.save_many(
+        [
+            Team(name="JLA", members=[Member(name="Superman"), Member(name="Batman")]),
+            Team(name="Titans", members=[Member(name="Robin")]),
+            Team(name="Outsiders"),
+        ]
+    )
+    assert "members" not in storage.find_one("team", {"name": "JLA"})
+
+    queries = []
+    find_many = storage.find_many
+    monkeypatch.setattr(
+        storage, "find_many", lambda *args, **kwargs: queries.append(args) or find_many(*args, **kwargs)
+    )
+
+    # one query for the teams, then one query per page of teams for their members
+    found = list(teams.find())
+    assert [[member.name for member in team.members] for team in found] == [["Superman", "Batman"], ["Robin"], []]
+    assert [tablename for tablename, _ in queries] == ["team", "member", "member"]
+
+    # strategies can be chosen for each call, joined falls back to selectin for storages that cannot join
+    queries.clear()
+    assert [team.name for team in teams.find(load="lazy")] == ["JLA", "Titans", "Outsiders"]
+    assert len(queries) == 1
+    (jla,) = teams.find(name="JLA", load={"members": "joined"})
+    assert [member.name for member in jla.members] == ["Superman", "Batman"]
+
+    with pytest.raises(ValueError):
+        list(teams.find(load="eager"))
+    with pytest.raises(ValueError):
+        list(teams.find(load={"villains": "selectin"}))
+
+
+class Even(Predicate):
+    def __call__(self, value) -> bool:
+        return value % 2 == 0
+
+
+@pytest.mark.parametrize("storage", ["memory", "filesystem", "sqlalchemy"])
+def test_query_expressions(tmp_path, storage):
+    if storage == "memory":
+        storage = MemoryStorage()
+    elif storage == "filesystem":
+        storage = FileSystemStorage(tmp_path)
+    else:
+        storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Article, storage=storage)
+    storage.migrate()
+    mapper.save_many(
+        [
+            Article(id=1, title="Intro", category="news", published=3, views=10),
+            Article(id=2, title="Draft", category="blog"),
+            Article(id=3, title="Release", category="news", published=1, views=250),
+            Article(id=4, title="Launch", category="blog", published=2, views=40),
+            Article(id=5, title="Roadmap", category="blog", published=4, views=7),
+        ]
+    )
+
+    def titles(*expressions, **kwargs):
+        return [article.title for article in mapper.find(*expressions, **kwargs)]
+
+    title, published, views = field("title"), field("published"), field("views")
+    assert titles(views > 20, order_by="title") == ["Launch", "Release"]
+    assert titles((views >= 40) | (field("category") == "news"), order_by=published) == ["Release", "Launch", "Intro"]
+    assert titles(title.startswith("R"), category="blog") == ["Roadmap"]
+    assert titles(title.like("_a%") | title.like("%a_"), order_by=published.desc()) == ["Roadmap", "Launch"]
+    assert titles(published.is_null()) == ["Draft"]
+    assert titles(published.in_([1, 2, None]), order_by="-published") == ["Launch", "Release"]
+
+    # like in SQL, conditions on None values are unknown, and stay unknown when negated
+    assert titles(published != 3, order_by="published") == ["Release", "Launch", "Roadmap"]
+    assert titles(~(published > 2) & (published != None), order_by="published") == ["Release", "Launch"]  # noqa: E711
+    assert titles(or_(~published.between(2, 3), title == "Draft"), order_by="id") == [
+        "Draft",
+        "Release",
+        "Roadmap",
+    ]
+
+    # predicates a storage cannot compile natively are checked in python (before limits are applied)
+    assert titles(published == Even(), order_by="published") == ["Launch", "Roadmap"]
+    rows = storage.find_many("article", (published == Even()) | (views > 100), order_by="published", offset=1, limit=1)
+    assert [row["title"] for row in rows] == ["Launch"]
+
+
+@pytest.mark.parametrize("storage", ["memory", "filesystem", "sqlalchemy"])
+def test_deferred_fields(tmp_path, storage):
+    if storage == "memory":
+        storage = MemoryStorage()
+    elif storage == "filesystem":
+        storage = FileSystemStorage(tmp_path)
+    else:
+        storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Article, storage=storage)
+    storage.migrate()
+    mapper.save_many(
+        [
+            Article(id=1, title="Intro", category="news", published=3, views=10),
+            Article(id=2, title="Release", category="blog", published=1, views=250),
+        ]
+    )
+
+    rows = list(storage.find_many("article", {}, order_by="-views", fields=["title"]))
+    assert [dict(row) for row in rows] == [{"title": "Release"}, {"title": "Intro"}]
+
+    loaded = []
+    find_many = storage.find_many
+    storage.find_many = lambda *args, **kwargs: loaded.append(kwargs.get("fields")) or find_many(*args, **kwargs)
+
+    intro, release = mapper.find(only=["title"], order_by="id")
+    assert intro.__state__.deferred == {"category", "published", "views"}
+    assert intro.__state__ == {"clean"}
+    assert loaded == [["id", "title"]]
+
+    # the first deferred field accessed loads all of them, the entity stays clean
+    assert intro.views == 10
+    assert (intro.category, intro.published, intro.__state__.deferred) == ("news", 3, set())
+    assert intro.__state__ == {"clean"}
+    assert sorted(loaded[1]) == ["category", "id", "published", "views"]
+
+    # deferred fields are not saved unless modified, and modified ones are not overwritten when loading the others
+    release.title = "Release notes"
+    mapper.save(release)
+    release.views = 300
+    assert release.category == "blog"
+    mapper.save(release)
+    assert (mapper.undefer(release).published, release.views) == (1, 300)
+
+    (found,) = mapper.find(defer=["category", "views"], title="Release notes")
+    assert found.__state__.deferred == {"category", "views"}
+    assert (mapper.undefer(found).category, found.views) == ("blog", 300)
+
+    with pytest.raises(ValueError):
+        list(mapper.find(only=["body"]))
+
+
+@pytest.mark.parametrize("storage", ["memory", "filesystem", "sqlalchemy"])
+def test_keyset_pagination(tmp_path, storage):
+    if storage == "memory":
+        storage = MemoryStorage()
+    elif storage == "filesystem":
+        storage = FileSystemStorage(tmp_path)
+    else:
+        storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Article, storage=storage)
+    storage.migrate()
+    published = [3, None, 1, 2, 3, None, 1, 5, 3, 2, None]
+    mapper.save_many(Article(id=i + 1, title=f"#{i + 1}", published=x) for i, x in enumerate(published))
+
+    for order_by in ("published", "-published", ["-published", "-id"], None):
+        expected = [article.id for article in mapper.find(order_by=order_by, limit=len(published))]
+        assert sorted(expected) == list(range(1, len(published) + 1))
+        assert [article.id for article in mapper.find(order_by=order_by, limit=3, offset=3)] == expected[3:6]
+
+        pages, after = [], None
+        while page := list(mapper.find(order_by=order_by, limit=4, after=after)):
+            pages.append([article.id for article in page])
+            after = mapper.cursor(page[-1], order_by)
+        assert pages == [expected[:4], expected[4:8], expected[8:]]
+
+    (three,) = mapper.find(id=1)
+    after = mapper.cursor(three, "published")
+    assert [article.id for article in mapper.find(field("title") != "#6", order_by="published", after=after)] == [
+        5,
+        9,
+        8,
+        2,
+        11,
+    ]
+    with pytest.raises(ValueError):
+        list(mapper.find(order_by="-published", after=after))
+    with pytest.raises(ValueError):
+        list(mapper.find(order_by="published", after="garbage"))
+
+
+@pytest.mark.parametrize("storage", ["memory", "filesystem", "sqlalchemy"])
+def test_aggregates(tmp_path, storage):
+    if storage == "memory":
+        storage = MemoryStorage()
+    elif storage == "filesystem":
+        storage = FileSystemStorage(tmp_path)
+    else:
+        storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Article, storage=storage)
+    storage.migrate()
+    assert (mapper.count(), mapper.exists()) == (0, False)
+    assert mapper.aggregate(sum="views") == {"count": 0, "sum_views": None}
+
+    rows = [("news", 1, 10), ("news", 2, 30), ("sports", None, 5), ("news", 3, 20), ("weather", None, 0)]
+    mapper.save_many(
+        Article(id=i + 1, title=f"#{i}", category=c, published=p, views=v) for i, (c, p, v) in enumerate(rows)
+    )
+
+    assert mapper.count() == 5
+    assert mapper.count(category="news") == 3
+    assert mapper.count(field("views") >= 10, category="news") == 3
+    assert mapper.count(or_(field("category") == "sports", field("published") == 2)) == 2
+    assert mapper.count(views=Even()) == 4  # not compiled by sql storages
+    assert mapper.exists(category="weather") and not mapper.exists(category="politics")
+
+    assert mapper.aggregate(sum="views", max=["views", "published"], avg="published") == {
+        "count": 5,
+        "sum_views": 65,
+        "max_views": 30,
+        "max_published": 3,
+        "avg_published": 2,
+    }
+    assert mapper.aggregate(group_by="category") == [
+        {"category": "news", "count": 3},
+        {"category": "sports", "count": 1},
+        {"category": "weather", "count": 1},
+    ]
+    assert mapper.aggregate(field("views") > 0, group_by="published", min="views") == [
+        {"published": 1, "count": 1, "min_views": 10},
+        {"published": 2, "count": 1, "min_views": 30},
+        {"published": 3, "count": 1, "min_views": 20},
+        {"published": None, "count": 1, "min_views": 5},
+    ]
+    with pytest.raises(ValueError):
+        mapper.aggregate(sum="unknown")
+
+
+@pytest.mark.parametrize("storage", ["memory", "filesystem", "sqlalchemy"])
+def test_find_many_by_pks(tmp_path, monkeypatch, storage):
+    if storage == "memory":
+        storage = MemoryStorage()
+    elif storage == "filesystem":
+        storage = FileSystemStorage(tmp_path)
+    else:
+        storage = SqlAlchemyStorage("sqlite:///:memory:")
+    members = Mapper(Member, storage=storage)
+    teams = Mapper(
+        Team,
+        storage=storage,
+        cache=IdentityMap(),
+        relations={"members": OneToManyRelation(members, strategy="selectin")},
+    )
+    storage.migrate()
+    teams.save_many(Team(id=i, name=f"Team {i}", members=[Member(id=i, name=f"Member {i}")]) for i in range(1, 5))
+
+    calls = []
+    find_by_identities = storage.find_by_identities
+    monkeypatch.setattr(storage, "find_by_identities", lambda *args: calls.append(args) or find_by_identities(*args))
+
+    # identity mapped entities are used as they are, the others found with one call, in the given order
+    second = teams.find_one_by_pk(2)
+    found = teams.find_many_by_pks([3, 2, 5, 1, 3])
+    assert [team and team.name for team in found] == ["Team 3", "Team 2", None, "Team 1", "Team 3"]
+    assert found[1] is second and found[0] is found[4]
+    assert len(calls) == 1 and 2 not in [identity["id"] for identity in calls[0][1]]
+    assert [member.name for member in found[3].members] == ["Member 1"]
+    assert teams.find_many_by_pks([]) == []
+
+
+@pytest.mark.parametrize("storage", ["memory", "filesystem", "sqlalchemy"])
+def test_typed_identities(tmp_path, storage):
+    if storage == "memory":
+        storage = MemoryStorage()
+    elif storage == "filesystem":
+        storage = FileSystemStorage(tmp_path)
+    else:
+        storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Hero, storage=storage, cache=IdentityMap())
+    storage.migrate()
+    superman = mapper.save(Hero(id=1, name="Superman"))
+
+    # primary keys are validated as values of the primary key fields, whatever the storage
+    assert superman.__state__.identity == {"id": superman.id}
+    assert mapper.find_one_by_pk(superman.id) is superman
+    assert mapper.find_one_by_pk(str(superman.id)) is superman
+    assert mapper.find_many_by_pks([str(superman.id)]) == [superman]
+
+    # found rows are identity mapped by their typed identity too
+    del superman
+    superman = mapper.find_one_by_pk(str(1))
+    assert superman.name == "Superman" and superman.__state__.identity.key == (1,)
+    assert mapper.find_one_by_pk(1) is superman and next(iter(mapper.find(name="Superman"))) is superman
+
+
+def test_second_level_cache(monkeypatch):
+    storage, cache = SqlAlchemyStorage("sqlite:///:memory:"), BoundedCache(max_entries=10)
+    mapper = Mapper(Contact, storage=storage, second_level_cache=cache)
+    storage.migrate()
+    mapper.save_many([Contact(email="clark@example.com"), Contact(email="bruce@example.com")])
+
+    queries = []
+    find_one = storage.find_one
+    monkeypatch.setattr(storage, "find_one", lambda *args: queries.append(args) or find_one(*args))
+
+    # no identity map, entities are gone, but their rows are cached
+    assert mapper.find_one_by_pk(1).email == "clark@example.com"
+    assert mapper.find_one_by_pk(1).email == "clark@example.com"
+    assert mapper.find_one_by_pk(1, only=["company"]).__state__.deferred == {"email", "city"}
+    assert len(queries) == 1
+    assert (cache.stats.hits, cache.stats.misses) == (2, 1)
+
+    # saving or deleting evicts the row
+    clark = mapper.find_one_by_pk(1)
+    clark.company = "Daily Planet"
+    mapper.save(clark)
+    assert mapper.find_one_by_pk(1).company == "Daily Planet"
+    assert len(queries) == 2
+    mapper.delete(mapper.find_one_by_pk(1))
+    assert mapper.find_one_by_pk(1) is None
+    assert len(queries) == 3 and len(cache) == 0
@@ -0,0 +1,121 @@
+import pytest
+
+from anymodel import Mapper, MemoryStorage
+from anymodel.types.queries import between, field, ge, in_, lt, matcher
+from ._models import Article
+
+ARTICLES = [
+    ("Intro", "news", 3, 10),
+    ("Draft", "news", None, 0),
+    ("Release", "blog", 1, 30),
+    ("Recap", "blog", 5, 20),
+    ("Update", "news", 4, 30),
+    ("Launch", "blog", 2, 50),
+]
+
+
+@pytest.fixture
+def storage():
+    storage = MemoryStorage()
+    mapper = Mapper(Article, storage=storage)
+    mapper.save_many(
+        Article(title=title, category=category, published=published, views=views)
+        for title, category, published, views in ARTICLES
+    )
+    return storage
+
+
+def titles(rows):
+    return [row["title"] for row in rows]
+
+
+def test_order_by_sorted_index(storage):
+    assert titles(storage.find_many("article", {}, order_by="published")) == [
+        "Release",
+        "Launch",
+        "Intro",
+        "Update",
+        "Recap",
+        "Draft",
+    ]
+    assert titles(storage.find_many("article", {}, order_by="-published", limit=3)) == ["Recap", "Update", "Intro"]
+    assert titles(storage.find_many("article", {}, order_by="-published", limit=2, offset=2)) == ["Intro", "Launch"]
+    assert titles(storage.find_many("article", {"category": "news"}, order_by="-published")) == [
+        "Update",
+        "Intro",
+        "Draft",
+    ]
+
+
+def test_range(storage):
+    assert titles(storage.find_many("article", {"published": ge(3)})) == ["Intro", "Update", "Recap"]
+    assert titles(storage.find_many("article", {"published": between(2, 4)}, order_by="-published")) == [
+        "Update",
+        "Intro",
+        "Launch",
+    ]
+    assert titles(storage.find_many("article", {"published": lt(3), "views": ge(40)})) == ["Launch"]
+    assert titles(storage.find_many("article", {"published": ge(3), "category": "blog"})) == ["Recap"]
+    assert titles(storage.find_many("article", {"views": lt(20)}, order_by="views")) == ["Draft", "Intro"]
+
+
+def test_in(storage):
+    assert titles(storage.find_many("article", {"category": in_(["blog", "sports"])})) == ["Release", "Recap", "Launch"]
+    assert titles(storage.find_many("article", {"published": in_([1, None, 5])}, order_by="published")) == [
+        "Release",
+        "Recap",
+    ]
+    assert titles(storage.find_many("article", {"views": in_([0, 10])}, order_by="views")) == ["Draft", "Intro"]
+    assert titles(storage.find_many("article", {"category": in_([])})) == []
+
+
+def test_expressions(storage):
+    category, published = field("category"), field("published")
+    expression = (category == "blog") & (published >= 2) & ((field("views") > 40) | field("title").startswith("Re"))
+    assert titles(storage.find_many("article", expression, order_by="-published")) == ["Recap", "Launch"]
+    assert titles(storage.find_many("article", published.startswith("R"))) == []
+    assert titles(storage.find_many("article", field("title").startswith("R"), order_by="title")) == [
+        "Recap",
+        "Release",
+    ]
+    assert titles(storage.find_many("article", ~(published < 4), order_by="published")) == ["Update", "Recap"]
+
+    # compiled expressions are cached
+    assert matcher(published < 4) is matcher(published < 4)
+
+
+def test_aggregates_from_indexes(storage, monkeypatch):
+    def scan(*args):
+        raise AssertionError("Rows should not be scanned.")
+
+    monkeypatch.setattr(storage, "_select", scan)
+    assert storage.count("article", {}) == 6
+    assert storage.count("article", {"category": "blog", "published": in_([1, 2, 3])}) == 2
+    assert storage.aggregate("article", {}, group_by=["category"], aggregates={"n": ("count", None)}) == [
+        {"category": "blog", "n": 3},
+        {"category": "news", "n": 3},
+    ]
+    monkeypatch.undo()
+
+    assert storage.count("article", {"published": ge(3)}) == 3
+    assert storage.aggregate("article", {"category": "news"}, aggregates={"views": ("sum", "views")}) == [{"views": 40}]
+
+
+def test_order_by_without_index(storage):
+    assert titles(storage.find_many("article", {}, order_by=("-views", "title"), limit=3)) == [
+        "Launch",
+        "Release",
+        "Update",
+    ]
+    assert titles(storage.find_many("article", {"category": "blog"}, order_by=("views",))) == [
+        "Recap",
+        "Release",
+        "Launch",
+    ]
+
+
+def test_sorted_index_follows_writes(storage):
+    storage.update("article", {"title": "Draft"}, {"published": 6})
+    storage.delete("article", {"title": "Recap"})
+    assert titles(storage.find_many("article", {}, order_by="-published", limit=2)) == ["Draft", "Update"]
+    assert titles(storage.find_many("article", {"published": ge(5)})) == ["Draft"]
@@ -7,6 +7,7 @@ def test_public_api_exports():
 
     # Test that all expected attributes are present
     expected_exports = [
+        "AsyncMapper",
         "Collection",
         "Entity",
         "Field",
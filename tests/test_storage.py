@@ -1,4 +1,7 @@
-from sqlalchemy.exc import OperationalError
+from contextlib import nullcontext
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, OperationalError
 from typing import Optional
 
 from anymodel.types.entity import Entity
@@ -6,6 +9,10 @@ from anymodel.mapper import Mapper
 from anymodel.storages.sqlalchemy import SqlAlchemyStorage
 import pytest
 
+from anymodel.types.queries import ge, in_, lt
+from anymodel.types.relations import OneToManyRelation
+from ._models import Article, Contact, Hero as PrimaryKeyHero, Member, Team
+
 
 class Hero(Entity):
     id: Optional[int] = None
@@ -16,6 +23,11 @@ class HeroMapper(Mapper[Hero]):
     pass
 
 
+class Secret(Entity):
+    id: Optional[int] = None
+    identity_id: Optional[int] = None
+
+
 def test_basics():
     storage = SqlAlchemyStorage("sqlite:///:memory:")
     mapper = HeroMapper(storage=storage)
@@ -30,3 +42,267 @@ def test_basics():
     # Test is incomplete - storage doesn't have a save method
     # hero = Hero(id=1, name="Superman")
     # hero = storage.save(hero)
+
+
+def test_insert_many():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(PrimaryKeyHero, storage=storage)
+    storage.migrate()
+
+    heroes = mapper.save_many(
+        [PrimaryKeyHero(name="Superman"), PrimaryKeyHero(id=10, name="Batman"), PrimaryKeyHero(name="Flash")]
+    )
+    assert [hero.id for hero in heroes] == [1, 10, 11]
+    assert all(hero.__state__ == {"clean"} for hero in heroes)
+
+    identities = storage.insert_many(mapper.__tablename__, [{"name": "Robin"}, {"name": "Joker"}])
+    assert [dict(identity) for identity in identities] == [{"id": 12}, {"id": 13}]
+    assert [row["name"] for row in storage.find_many(mapper.__tablename__, {})] == [
+        "Superman",
+        "Batman",
+        "Flash",
+        "Robin",
+        "Joker",
+    ]
+
+
+def test_update_many():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Secret, storage=storage)
+    storage.migrate()
+    secrets = mapper.save_many([Secret(id=1, identity_id=1), Secret(id=2, identity_id=2)])
+
+    # the parameters of the updated columns do not clash with the ones of the identity, whatever the column names
+    storage.update_many(
+        mapper.__tablename__, [({"id": secret.id}, {"identity_id": 10 + secret.id}) for secret in secrets]
+    )
+    assert [dict(row) for row in storage.find_many(mapper.__tablename__, {})] == [
+        {"id": 1, "identity_id": 11},
+        {"id": 2, "identity_id": 12},
+    ]
+
+
+def test_dirty_checking():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Contact, storage=storage)
+    storage.migrate()
+    contact = mapper.save(Contact(email="clark@example.com", company="Daily Planet"))
+
+    statements = []
+    event.listen(storage.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    # nothing changed, or fields set back to their stored values: no update
+    mapper.save(contact)
+    contact.company = "Wayne Enterprises"
+    assert mapper.is_dirty(contact) and contact.__state__ == {"dirty"}
+    contact.company = "Daily Planet"
+    assert not mapper.is_dirty(contact) and contact.__state__ == {"clean"}
+    mapper.save(contact)
+    assert statements == []
+
+    # only the changed columns are written
+    contact.city = "Metropolis"
+    contact.company = "Daily Planet"
+    mapper.save(contact)
+    assert len(statements) == 1 and "SET city=?" in statements[0]
+    assert not mapper.is_dirty(contact)
+
+
+def test_transaction(tmp_path):
+    storage = SqlAlchemyStorage(f"sqlite:///{tmp_path / 'heroes.db'}")
+    mapper = Mapper(PrimaryKeyHero, storage=storage)
+    storage.migrate()
+
+    checkouts = []
+    event.listen(storage.engine, "checkout", lambda *args: checkouts.append(args))
+
+    with mapper.transaction():
+        mapper.save(PrimaryKeyHero(name="Superman"))
+        batman = mapper.save(PrimaryKeyHero(name="Batman"))
+        batman.name = "Dark Knight"
+        mapper.save(batman)
+        assert [hero.name for hero in mapper.find()] == ["Superman", "Dark Knight"]
+    assert len(checkouts) == 1
+
+    # nested blocks are savepoints, only the failing one is rolled back
+    with mapper.transaction():
+        mapper.save(PrimaryKeyHero(name="Flash"))
+        with pytest.raises(RuntimeError), mapper.transaction():
+            mapper.save(PrimaryKeyHero(name="Joker"))
+            raise RuntimeError("Villain detected.")
+
+    # the outermost block rollbacks everything
+    with pytest.raises(RuntimeError), mapper.transaction():
+        mapper.save(PrimaryKeyHero(name="Robin"))
+        raise RuntimeError("Sidekick detected.")
+
+    assert [hero.name for hero in mapper.find()] == ["Superman", "Dark Knight", "Flash"]
+
+
+def test_indexes():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Contact, storage=storage)
+    storage.migrate()
+
+    assert {index.name: index.unique for index in storage.tables["contact"].indexes} == {
+        "ix_contact_company": False,
+        "ix_contact_email": True,
+    }
+
+    mapper.save(Contact(email="clark@dailyplanet.com"))
+    with pytest.raises(IntegrityError):
+        mapper.save(Contact(email="clark@dailyplanet.com"))
+
+
+def test_order_by_and_range():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Article, storage=storage)
+    storage.migrate()
+    mapper.save_many(
+        [
+            Article(title="Intro", published=3),
+            Article(title="Draft"),
+            Article(title="Release", published=1),
+            Article(title="Launch", published=2),
+        ]
+    )
+
+    def titles(criteria, **kwargs):
+        return [row["title"] for row in storage.find_many("article", criteria, **kwargs)]
+
+    assert titles({}, order_by="published") == ["Release", "Launch", "Intro", "Draft"]
+    assert titles({}, order_by="-published", limit=2) == ["Intro", "Launch"]
+    assert titles({"published": ge(2)}, order_by="published") == ["Launch", "Intro"]
+    assert titles({"published": lt(3)}, order_by="-published") == ["Launch", "Release"]
+    assert titles({"published": in_([1, 3, None])}, order_by="published") == ["Release", "Intro"]
+
+
+def test_relation_load_strategies():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    members = Mapper(Member, storage=storage)
+    teams = Mapper(Team, storage=storage, relations={"members": OneToManyRelation(members, strategy="joined")})
+    storage.migrate()
+    assert "members" not in storage.tables["team"].c
+
+    teams.save_many(
+        [
+            Team(name="JLA", members=[Member(name="Superman"), Member(name="Batman")]),
+            Team(name="Titans", members=[Member(name="Robin")]),
+            Team(name="Outsiders"),
+        ]
+    )
+
+    statements = []
+    event.listen(storage.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    def names(found):
+        return [(team.name, [member.name for member in team.members]) for team in found]
+
+    # parents and children in one query, limits apply to the parents
+    assert names(teams.find()) == [("JLA", ["Superman", "Batman"]), ("Titans", ["Robin"]), ("Outsiders", [])]
+    assert len(statements) == 1 and "JOIN" in statements[0]
+    assert [row["name"] for row, _ in storage.find_many_joined("team", {}, {"m": ("member", "team_id")}, limit=1)] == [
+        "JLA"
+    ]
+
+    statements.clear()
+    assert names(teams.find(load="selectin")) == names(teams.find(load="lazy"))
+    assert len(statements) == (1 + 1) + (1 + 3)
+    assert names([teams.find_one_by_pk(2)]) == [("Titans", ["Robin"])]
+
+
+@pytest.mark.parametrize("orphans", ["detach", "delete"])
+def test_relation_changes(orphans):
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    members = Mapper(Member, storage=storage)
+    teams = Mapper(Team, storage=storage, relations={"members": OneToManyRelation(members, orphans=orphans)})
+    storage.migrate()
+    teams.save(Team(name="JLA", members=[Member(name=f"Member {i}") for i in range(5000)]))
+
+    team = teams.find_one_by_pk(1)
+    statements = []
+    event.listen(storage.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    # appending to a collection does not load it, and saving only inserts the new member
+    team.members.append(Member(name="Flash"))
+    assert teams.is_dirty(team) and not team.members.loaded
+    teams.save(team)
+    assert len(statements) == 1 and statements[0].startswith("INSERT INTO member")
+    assert not teams.is_dirty(team)
+
+    # clean members are not written, modified ones are, removed ones are detached or deleted
+    first, second = team.members[:2]
+    assert len(team.members) == 5001 and team.members[-1].name == "Flash"
+    statements.clear()
+    teams.save(team)
+    assert statements == []
+
+    first.name = "Superman"
+    team.members.remove(second)
+    assert team.members.removed == [second] and teams.is_dirty(team)
+    teams.save(team)
+    assert [statement.split()[0] for statement in statements] == (
+        ["UPDATE", "UPDATE"] if orphans == "detach" else ["DELETE", "UPDATE"]
+    )
+    assert members.count(team_id=1) == 5000 and members.count() == (5001 if orphans == "detach" else 5000)
+    assert not team.members.changed and not teams.is_dirty(team)
+
+
+def test_paged_relations():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    members = Mapper(Member, storage=storage)
+    teams = Mapper(Team, storage=storage, relations={"members": OneToManyRelation(members, page_size=100)})
+    storage.migrate()
+    teams.save(Team(name="JLA", members=[Member(name=f"Member {i}") for i in range(250)]))
+
+    team = teams.find_one_by_pk(1)
+    statements = []
+    event.listen(storage.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    # slices run one limited query, len a count query (cached until the collection is modified)
+    assert [member.name for member in team.members[100:103]] == ["Member 100", "Member 101", "Member 102"]
+    assert len(statements) == 1 and "LIMIT" in statements[0]
+    assert len(team.members) == 250 and len(team.members) == 250
+    assert len(statements) == 2 and "count" in statements[1]
+    assert team.members[-1].name == "Member 249"
+    assert len(statements) == 3
+
+    # iterations fetch one page at a time, unsaved changes included
+    statements.clear()
+    assert [member.name for member in team.members] == [f"Member {i}" for i in range(250)]
+    assert len(statements) == 3
+    team.members.append(Member(name="Flash"))
+    team.members.remove(team.members[0])
+    assert len(team.members) == 250
+    names = [member.name for member in team.members]
+    assert (names[0], names[-1], len(names)) == ("Member 1", "Flash", 250)
+
+    teams.save(team)
+    assert members.count(team_id=1) == 250 and not team.members.loaded
+    assert len(team.members) == 250 and team.members[249].name == "Flash"
+
+    # indexes and slices only see stored entities, negative ones too
+    team.members.append(Member(name="Wonder Woman"))
+    assert len(team.members) == 251 and team.members[-1].name == "Flash"
+    assert [member.name for member in team.members[-2:]] == ["Member 249", "Flash"]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_streaming(tmp_path, stream):
+    storage = SqlAlchemyStorage(f"sqlite:///{tmp_path}/db.sqlite", chunk_size=2)
+    mapper = Mapper(Article, storage=storage)
+    storage.migrate()
+    mapper.save_many(Article(title=f"#{i}") for i in range(5))
+
+    options = []
+    event.listen(storage.engine, "before_cursor_execute", lambda *args: options.append(args[4].execution_options))
+
+    with storage.streaming() if stream else nullcontext():
+        rows = iter(storage.find_many("article", {}, order_by="id"))
+        assert next(rows)["title"] == "#0"
+
+        # buffered results release the connection before the first row is yielded, streamed ones hold it
+        assert storage.engine.pool.checkedout() == (1 if stream else 0)
+        assert [row["title"] for row in rows] == ["#1", "#2", "#3", "#4"]
+    assert storage.engine.pool.checkedout() == 0
+    assert options[-1].get("yield_per") == (2 if stream else None)
@@ -0,0 +1,140 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from anymodel import AsyncMapper, Mapper, OneToManyRelation
+from anymodel.storages.memory import AsyncMemoryStorage
+from anymodel.storages.sqlalchemy import SqlAlchemyStorage
+from anymodel.types.mappings import Identity
+from anymodel.unit_of_work import UnitOfWork
+from anymodel.utilities.identity_map import IdentityMap
+from ._models import Hero, Member, Node, Team
+
+
+def test_unit_of_work(monkeypatch):
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    members = Mapper(Member, storage=storage)
+    teams = Mapper(Team, storage=storage, relations={"members": OneToManyRelation(members)})
+    storage.migrate()
+
+    statements, calls = [], []
+    event.listen(storage.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    for name in ("insert_many", "update_many"):
+        method = getattr(storage, name)
+        monkeypatch.setattr(
+            storage,
+            name,
+            lambda tablename, rows, name=name, method=method: (
+                calls.append((name, tablename)) or method(tablename, rows)
+            ),
+        )
+
+    # parents are inserted first, children get their ids, same table writes are batched
+    with UnitOfWork(teams) as uow:
+        uow.add(Member(name="Flash"))
+        uow.add(Team(name="JLA", members=[Member(name="Superman"), Member(name="Batman")]))
+        uow.add(Team(name="Titans", members=[Member(name="Robin")]))
+        assert statements == []
+    assert calls == [("insert_many", "team"), ("insert_many", "member")]
+    assert [statement.split()[2] for statement in statements] == [
+        "team",
+        "team",
+        "member",
+        "member",
+        "member",
+        "member",
+    ]
+    assert [(member.name, member.team_id) for member in members.find()] == [
+        ("Flash", None),
+        ("Superman", 1),
+        ("Batman", 1),
+        ("Robin", 2),
+    ]
+
+    # only modified entities are updated, deleted children go before their parents
+    jla, titans = teams.find()
+    superman, batman = jla.members
+    (robin,) = titans.members
+    statements.clear()
+    calls.clear()
+    with UnitOfWork(teams, batch_size=10) as uow:
+        superman.name, batman.name = "Kal-El", "Bruce"
+        uow.add(jla, titans)
+        uow.delete(titans, robin)
+    assert calls == [("update_many", "member")]
+    assert [statement.split()[0] for statement in statements] == ["UPDATE", "DELETE", "DELETE"]
+    assert [team.name for team in teams.find()] == ["JLA"]
+    assert [member.name for member in members.find(team_id=1)] == ["Kal-El", "Bruce"]
+    assert not members.is_dirty(superman)
+
+    # nothing is written if the block raises
+    with pytest.raises(RuntimeError), UnitOfWork(teams) as uow:
+        uow.add(Team(name="Outsiders"))
+        raise RuntimeError()
+    assert [team.name for team in teams.find()] == ["JLA"]
+
+
+def test_unit_of_work_rollback():
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    mapper = Mapper(Hero, storage=storage)
+    storage.migrate()
+    mapper.save(Hero(id=1, name="Superman"))
+
+    # a failing write rolls back the whole flush
+    uow = UnitOfWork(mapper)
+    uow.add(Hero(id=2, name="Batman"), Hero(id=1, name="Clark"))
+    with pytest.raises(IntegrityError):
+        uow.flush()
+    assert [hero.name for hero in mapper.find()] == ["Superman"]
+
+    with pytest.raises(ValueError):
+        uow.add(Team(name="JLA"))
+    with pytest.raises(ValueError):
+        uow.delete(Hero(name="Flash"))
+    with pytest.raises(TypeError):
+        UnitOfWork(AsyncMapper(Hero, storage=AsyncMemoryStorage()))
+
+    # the states of the entities written before a failure are rolled back too, to flush them again once fixed
+    members = Mapper(Member, storage=storage, cache=IdentityMap())
+    teams = Mapper(Team, storage=storage, cache=IdentityMap(), relations={"members": OneToManyRelation(members)})
+    storage.migrate()
+    members.save(Member(id=1, name="Flash"))
+    member = Member(id=1, name="Superman")
+    team = Team(name="JLA", members=[member])
+    uow = UnitOfWork(teams)
+    uow.add(team)
+    with pytest.raises(IntegrityError):
+        uow.flush()
+    assert list(teams.find()) == [] and team.__state__.transient and member.__state__.transient
+    assert team.id is None and member.team_id is None and teams._cache.get(Identity({"id": 1})) is None
+    assert team.__pydantic_fields_set__ == {"name", "members"}
+
+    member.id = 2
+    uow.add(team)
+    uow.flush()
+    assert [(team.name, [member.name for member in team.members]) for team in teams.find()] == [("JLA", ["Superman"])]
+    assert teams.find_one_by_pk(1) is team and not teams.is_dirty(team)
+
+
+def test_unit_of_work_self_relations(monkeypatch):
+    storage = SqlAlchemyStorage("sqlite:///:memory:")
+    nodes = Mapper(Node, storage=storage, relations={"children": None})
+    nodes.relations["children"] = OneToManyRelation(nodes)
+    storage.migrate()
+
+    calls = []
+    insert_many = storage.insert_many
+    monkeypatch.setattr(storage, "insert_many", lambda *args: calls.append(len(args[1])) or insert_many(*args))
+
+    # entities of a mapper related to itself are written level by level, each level with one call
+    with UnitOfWork(nodes) as uow:
+        uow.add(
+            Node(name="root", children=[Node(name="a", children=[Node(name="a1"), Node(name="a2")]), Node(name="b")]),
+            Node(name="other"),
+        )
+    assert calls == [2, 2, 2]
+    root = nodes.find_one_by_pk(1)
+    assert [(node.name, [child.name for child in node.children]) for node in root.children] == [
+        ("a", ["a1", "a2"]),
+        ("b", []),
+    ]